@@ -0,0 +1,18 @@
+"""
+ASGI config for hw7proj project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Serve it with an ASGI server such as uvicorn or daphne to run the async views
+enabled by ASYNC_VIEWS in paper/constants.py.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "hw7proj.settings")
+
+application = get_asgi_application()
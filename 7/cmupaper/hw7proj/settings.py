@@ -49,6 +49,7 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'paper.middleware.QueryInstrumentationMiddleware',
 ]
 
 ROOT_URLCONF = 'hw7proj.urls'
@@ -77,7 +78,7 @@ WSGI_APPLICATION = 'hw7proj.wsgi.application'
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.postgresql_psycopg2',
+        'ENGINE': 'django.db.backends.postgresql',
         'NAME': getpass.getuser(),
         'USER': getpass.getuser(),
     }
@@ -0,0 +1,87 @@
+"""
+Index suggestions for the sequential scans found by the advise_indexes
+command.
+
+A scan is described by describe_plan() in bench_functions: its relation, its
+filter and the order its rows are sorted or grouped in above it. The index
+suggested for it leads with the columns the filter compares for equality,
+followed by the sort or group keys of the same relation, so that it serves
+both the lookup and the order. A scan that an existing index could already
+serve, which the planner preferred on a small table, gets no suggestion.
+"""
+import re
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+# A column compared for equality in a filter, e.g. `((username)::text = $1)`
+# or `(pid = ANY ('{1,2}'::integer[]))`
+_EQUALITY = re.compile(r'\(?(\w+)\)?(?:::[\w ]+?)? = ')
+
+# Identifiers longer than this are truncated by postgres
+_MAX_NAME_LENGTH = 63
+
+
+@dataclass(frozen=True)
+class IndexSuggestion:
+    relation: str
+    columns: tuple[str, ...]
+
+    @property
+    def name(self) -> str:
+        name = 'advisor_%s_%s' % (self.relation, '_'.join(column.split()[0] for column in self.columns))
+        return name[:_MAX_NAME_LENGTH - len('_idx')] + '_idx'
+
+    @property
+    def sql(self) -> str:
+        return 'CREATE INDEX %s ON %s (%s)' % (self.name, self.relation, ', '.join(self.columns))
+
+
+def _order_columns(order: Iterable[str], alias: str, columns: set[str]) -> list[str]:
+    """
+    The leading keys of a sort or group $order that are columns of the
+    relation scanned as $alias, e.g. ['begin_time DESC', 'pid']
+    """
+    keys = []
+    for key in order:
+        expression, _, direction = key.partition(' ')
+        qualifier, _, column = expression.rpartition('.')
+        column = column.strip('()')
+        if qualifier not in ('', alias) or column not in columns:
+            # The index can only serve a prefix of the order.
+            break
+        keys.append(column + (' DESC' if direction.startswith('DESC') else ''))
+    return keys
+
+
+def suggest_index(scan: dict, columns: set[str]) -> Optional[IndexSuggestion]:
+    """
+    Suggest an index replacing the sequential $scan of a relation with
+    $columns, or None if nothing narrows the scan down or orders its rows.
+    """
+    leading = []
+    for column in _EQUALITY.findall(scan.get('filter') or ''):
+        if column in columns and column not in leading:
+            leading.append(column)
+    ordered = [key for key in _order_columns(scan.get('order') or (), scan.get('alias'), columns)
+               if key.split()[0] not in leading]
+    if not leading and not ordered:
+        return None
+    return IndexSuggestion(scan['relation'], tuple(leading + ordered))
+
+
+def _flip(key: str) -> str:
+    return key[:-len(' DESC')] if key.endswith(' DESC') else key + ' DESC'
+
+
+def covering_index(suggestion: IndexSuggestion, indexes: dict[str, list[str]]) -> Optional[str]:
+    """
+    The name of an index among $indexes, which maps names to key columns of
+    the relation of $suggestion, that leads with the suggested columns in
+    the same or the reversed order. None if there is no such index.
+    """
+    columns = list(suggestion.columns)
+    for name, keys in indexes.items():
+        prefix = keys[:len(columns)]
+        if prefix == columns or prefix == [_flip(key) for key in columns]:
+            return name
+    return None
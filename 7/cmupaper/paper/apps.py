@@ -1,7 +1,11 @@
-
-
 from django.apps import AppConfig
 
 
 class PaperConfig(AppConfig):
     name = 'paper'
+
+    def ready(self):
+        # The partitions of the coming months have to exist whether or not
+        # anything else touches the database.
+        from .partitions import get_maintainer
+        get_maintainer()
@@ -0,0 +1,144 @@
+"""
+Async versions of the read-only db APIs behind the home, popular papers,
+search and tag pages, for the async views.
+
+Each API takes a psycopg.AsyncConnection, runs the same statement as the API
+of the same name in functions and returns the same (status, retval). See the
+docstrings there for the arguments and results. The async views call them
+through database_wrapper.call_db_async.
+"""
+from typing import Optional, Any, Callable
+from collections.abc import Sequence
+from datetime import datetime
+
+import psycopg
+
+from .constants import *
+from . import functions
+from .functions import (
+    HomeBundle, Page, Paper, _GET_LIKES_OF_PAPERS, _GET_MOST_ACTIVE_USERS, _GET_MOST_POPULAR_PAPERS,
+    _GET_MOST_POPULAR_TAG_PAIRS, _GET_MOST_POPULAR_TAGS, _GET_TAGS_OF_PAPERS, _GET_TIMELINE_ALL,
+    _home_bundle_query, _home_row, _keyword_page_query, _page_row, _page_seek, _scalar_row,
+    _split_home_bundle, _split_page, _tag_page_query, PREPARED_STATEMENTS,
+)
+
+AsyncConnection = psycopg.AsyncConnection[tuple[Any, ...]]
+"""Type of psycopg.AsyncConnection we are using"""
+
+
+async def _fetchall(conn: AsyncConnection, query: str, params: Any, row_factory: Optional[Callable] = None,
+                    prepare: Optional[bool] = None) -> tuple[int, Optional[list]]:
+    """
+    Fetch all rows of $query in a transaction of its own
+    """
+    try:
+        cursor = conn.cursor(row_factory=row_factory)
+        await cursor.execute(query, params, prepare=prepare)
+        rows = await cursor.fetchall()
+        await conn.commit()
+        return SUCCESS, rows
+    except Exception:
+        await conn.rollback()
+        return FAILURE, None
+
+
+async def _fetch_prepared(conn: AsyncConnection, name: str, params: Sequence[Any],
+                          row_factory: Optional[Callable] = None) -> tuple[int, Optional[list]]:
+    """
+    Fetch all rows of the statement registered in functions.PREPARED_STATEMENTS
+    as $name, prepared as functions._execute_prepared() does
+    """
+    return await _fetchall(conn, PREPARED_STATEMENTS[name], params, row_factory, functions.prepare_statements)
+
+
+# Vote related
+
+
+async def get_likes_of_papers(conn: AsyncConnection, pids: Sequence[int]) -> tuple[int, Optional[dict[int, int]]]:
+    status, rows = await _fetch_prepared(conn, _GET_LIKES_OF_PAPERS, (list(pids),))
+    if status != SUCCESS:
+        return status, None
+    like_counts = dict.fromkeys(pids, 0)
+    like_counts.update(rows)
+    return SUCCESS, like_counts
+
+
+async def get_tags_of_papers(conn: AsyncConnection, pids: Sequence[int])\
+        -> tuple[int, Optional[dict[int, list[str]]]]:
+    status, rows = await _fetch_prepared(conn, _GET_TAGS_OF_PAPERS, (list(pids),))
+    if status != SUCCESS:
+        return status, None
+    tags = {pid: [] for pid in pids}
+    tags.update(rows)
+    return SUCCESS, tags
+
+
+# Search related
+
+
+async def get_timeline_all(conn: AsyncConnection, count=10) -> tuple[int, Optional[list[Paper]]]:
+    return await _fetch_prepared(conn, _GET_TIMELINE_ALL, (count,))
+
+
+async def get_most_popular_papers(conn: AsyncConnection, begin_time: datetime, count=10)\
+        -> tuple[int, Optional[list[Paper]]]:
+    return await _fetch_prepared(conn, _GET_MOST_POPULAR_PAPERS, (begin_time, begin_time, count, count))
+
+
+async def get_papers_by_tag_page(conn: AsyncConnection, tag: str, count=10, cursor: Optional[str] = None)\
+        -> tuple[int, Optional[Page]]:
+    try:
+        seek, params = _page_seek(cursor, 'begin_time')
+    except ValueError:
+        return FAILURE, None
+    status, rows = await _fetchall(conn, _tag_page_query(seek), {'tag': tag, 'limit': count + 1, **params},
+                                   _page_row)
+    if status != SUCCESS:
+        return status, None
+    return SUCCESS, _split_page(rows, count, 'begin_time')
+
+
+async def get_papers_by_keyword_page(conn: AsyncConnection, keyword: str, count=10, cursor: Optional[str] = None,
+                                     ranked=False) -> tuple[int, Optional[Page]]:
+    key = 'relevance' if ranked else 'begin_time'
+    try:
+        seek, params = _page_seek(cursor, key)
+    except ValueError:
+        return FAILURE, None
+    status, rows = await _fetchall(conn, _keyword_page_query(seek, ranked),
+                                   {'keyword': keyword, 'limit': count + 1, **params}, _page_row)
+    if status != SUCCESS:
+        return status, None
+    return SUCCESS, _split_page(rows, count, key)
+
+
+async def get_home_bundle(conn: AsyncConnection, uname: str, count=10, recommended: Optional[Sequence[int]] = None)\
+        -> tuple[int, Optional[HomeBundle]]:
+    previous = conn.read_only
+    await conn.set_read_only(True)
+    try:
+        status, rows = await _fetchall(
+            conn, _home_bundle_query(recommended is not None),
+            {'uname': uname, 'count': count, 'recommended': list(recommended or ())}, _home_row
+        )
+    finally:
+        await conn.set_read_only(previous)
+    if status != SUCCESS:
+        return status, None
+    return SUCCESS, _split_home_bundle(rows)
+
+
+# Statistics related
+
+
+async def get_most_active_users(conn: AsyncConnection, count=1) -> tuple[int, Optional[list[str]]]:
+    return await _fetch_prepared(conn, _GET_MOST_ACTIVE_USERS, (count,), _scalar_row)
+
+
+async def get_most_popular_tags(conn: AsyncConnection, count=1) -> tuple[int, Optional[list[tuple[str, int]]]]:
+    return await _fetch_prepared(conn, _GET_MOST_POPULAR_TAGS, (count,))
+
+
+async def get_most_popular_tag_pairs(conn: AsyncConnection, count=1)\
+        -> tuple[int, Optional[list[tuple[str, str, int]]]]:
+    return await _fetch_prepared(conn, _GET_MOST_POPULAR_TAG_PAIRS, (count,))
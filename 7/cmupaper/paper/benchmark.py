@@ -0,0 +1,76 @@
+"""
+Helpers shared by the benchmark commands: latency summaries and JSON reports
+that can be diffed between runs.
+"""
+import json
+import math
+from typing import Sequence
+
+from django.core.management.base import CommandError
+
+from .constants import *
+
+
+def percentile(sorted_samples: Sequence[float], q: float) -> float:
+    """
+    The nearest-rank $q-th percentile of non-empty, sorted samples
+    """
+    rank = max(math.ceil(q / 100 * len(sorted_samples)), 1)
+    return sorted_samples[rank - 1]
+
+
+def summarize(samples_ms: Sequence[float], errors: int = 0, elapsed: float = None) -> dict:
+    """
+    Summarize latencies in milliseconds. Throughput is only reported if the
+    $elapsed wall time in seconds is given.
+    """
+    samples = sorted(samples_ms)
+    summary = {'count': len(samples), 'errors': errors}
+    if samples:
+        summary['latency_ms'] = {
+            'mean': round(sum(samples) / len(samples), 3),
+            'p50': round(percentile(samples, 50), 3),
+            'p95': round(percentile(samples, 95), 3),
+            'p99': round(percentile(samples, 99), 3),
+            'max': round(samples[-1], 3),
+        }
+    if elapsed:
+        summary['throughput_per_s'] = round(len(samples) / elapsed, 3)
+    return summary
+
+
+def write_report(path: str, report: dict):
+    """
+    Write a report with stable key order, so that two runs diff cleanly.
+    """
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True, default=str)
+        f.write('\n')
+
+
+def read_report(path: str) -> dict:
+    """
+    Read a report written by write_report, e.g. to compare a run with it.
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise CommandError('Cannot read report %s: %s' % (path, e))
+
+
+def confirm_reset(options):
+    """
+    Ask before a benchmark command resets the database, unless it is run with
+    --noinput.
+    """
+    if not options['interactive']:
+        return
+    answer = input('This resets the database "%s" and replaces all its data. Type "yes" to continue: ' % DBNAME)
+    if answer != 'yes':
+        raise CommandError('Benchmark cancelled')
+
+
+def add_noinput_argument(parser):
+    parser.add_argument('--noinput', '--no-input', action='store_false', dest='interactive',
+                        help='Reset the database without asking.')
@@ -0,0 +1,303 @@
+"""
+A read-through cache of the paper lists that are read far more often than
+they change: the global timeline, the timeline of a user and the papers of a
+tag.
+
+Every cached result belongs to one group, e.g. the timeline of user foo, and
+its key contains the current version of the group. A write that changes a
+group replaces its version, which makes all its entries unreachable; they
+age out of the backend by themselves. Versions are random tokens rather than
+counters, so a version evicted from the backend is simply replaced by a new
+one.
+
+Results read from a replica may predate a write the primary has committed.
+Each version carries the time it was set, and such results aren't stored in a
+group that changed more recently than the replicas may lag behind, see
+Cache.call(). Otherwise they would be served under the new version.
+
+The local backend is private to the process. With several server processes,
+the others see a write only after CACHE_TTL seconds, unless the Django backend
+is configured with a shared cache such as memcached.
+"""
+import hashlib
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Optional
+
+from .constants import *
+from . import functions
+
+_MISSING = object()
+
+
+class LocalCache:
+    """
+    An LRU cache with a time to live, holding at most `max_entries` entries.
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str, default=None):
+        with self._lock:
+            return self._get(key, default)
+
+    def set(self, key: str, value, timeout: Optional[float] = None):
+        with self._lock:
+            self._set(key, value, timeout)
+
+    def get_many(self, keys) -> dict:
+        values = {}
+        for key in keys:
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                values[key] = value
+        return values
+
+    def add(self, key: str, value, timeout: Optional[float] = None) -> bool:
+        """
+        Set $key unless it is already set. Return whether it has been set.
+        """
+        with self._lock:
+            if self._get(key, _MISSING) is not _MISSING:
+                return False
+            self._set(key, value, timeout)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _get(self, key: str, default):
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.monotonic():
+            del self._entries[key]
+            return default
+        self._entries.move_to_end(key)
+        return value
+
+    def _set(self, key: str, value, timeout: Optional[float]):
+        expires_at = None if timeout is None else time.monotonic() + timeout
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+
+def _group(name: str, value: str = '') -> str:
+    return name + ':' + value
+
+
+# Group of the result of each cached API
+READS = {
+    'get_timeline_all': lambda args: _group('timeline_all'),
+    'get_timeline': lambda args: _group('timeline', args['uname']),
+    'get_timeline_page': lambda args: _group('timeline', args['uname']),
+    'get_papers_by_tag': lambda args: _group('tag', args['tag']),
+    'get_papers_by_tag_page': lambda args: _group('tag', args['tag']),
+}
+
+
+def _paper_groups(uname: str, tags) -> list[str]:
+    return [_group('timeline_all'), _group('timeline', uname)] + [_group('tag', tag) for tag in tags]
+
+
+def _groups_of_deleted_paper(args, run) -> Optional[list[str]]:
+    status, paper = run(functions.get_paper_author_and_tags, {'pid': args['pid']})
+    return _paper_groups(*paper) if status == SUCCESS else None
+
+
+# Writes that change cached results. `before` finds the groups a write
+# changes before it runs, `after` from its arguments and its retval; None
+# means every group. The cached lists don't carry like counts, so likes don't
+# change any group, and maintaining the partitions only changes them when
+# papers are archived.
+WRITES = {
+    'add_new_paper': {'after': lambda args, retval: _paper_groups(args['uname'], args['tags'])},
+    'delete_paper': {'before': _groups_of_deleted_paper},
+    'like_paper': {'after': lambda args, retval: []},
+    'unlike_paper': {'after': lambda args, retval: []},
+    'import_papers': {'after': lambda args, retval: None},
+    'reset_db': {'after': lambda args, retval: None},
+    'maintain_partitions': {'after': lambda args, retval: None if retval[1] else []},
+}
+
+
+def _token() -> str:
+    # A new version or generation, stamped with the time of the change
+    return '%s-%.3f' % (uuid.uuid4().hex, time.time())
+
+
+def _token_time(token: str) -> float:
+    try:
+        return float(token.rpartition('-')[2])
+    except ValueError:
+        return 0.0
+
+
+def _hash(value: Any) -> str:
+    # Keys stay short and free of spaces, as memcached requires.
+    return hashlib.sha1(repr(value).encode()).hexdigest()
+
+
+class Cache:
+    """
+    Serve the APIs in READS from `backend`, which has the get, get_many, set
+    and add methods of a Django cache, and invalidate them on the APIs in
+    WRITES.
+
+    Besides its group version, every key contains a generation that is
+    replaced to invalidate all groups at once.
+    """
+
+    def __init__(self, backend, ttl: float = CACHE_TTL, prefix: str = 'paper'):
+        self.backend = backend
+        self.ttl = ttl
+        self.prefix = prefix
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def handles(self, function) -> bool:
+        return function.__name__ in READS or function.__name__ in WRITES
+
+    def call(self, function, argdict: dict, run: Callable[[Callable, dict], tuple], stale: float = 0.0):
+        """
+        Call the API $function through $run, which has the signature of
+        database_wrapper.call_db, serving it from the cache or invalidating
+        the cache as needed. The results of $run may be up to $stale seconds
+        behind the latest writes, e.g. when read from a replica: they are
+        only stored in groups that didn't change for that long.
+        """
+        name = function.__name__
+        if name in READS:
+            key, changed_at, result = self._lookup(name, argdict)
+            if result is _MISSING:
+                result = run(function, argdict)
+                self._store(name, key, result, changed_at, stale)
+            return result
+
+        rule = WRITES[name]
+        groups = rule['before'](argdict, run) if 'before' in rule else None
+        result = run(function, argdict)
+        if result[0] == SUCCESS:
+            if 'after' in rule:
+                groups = rule['after'](argdict, result[1])
+            self.invalidate(groups)
+            self._count(name, 'invalidations')
+        return result
+
+    async def acall(self, function, argdict: dict, run: Callable[[Callable, dict], Awaitable[tuple]],
+                    stale: float = 0.0):
+        """
+        The counterpart of call() for the async APIs in READS, with $run a
+        coroutine function like the one of database_wrapper.call_db_async.
+        Async APIs share their entries with the APIs of the same name.
+        """
+        name = function.__name__
+        if name not in READS:
+            raise ValueError('%s is not a cached read' % name)
+        key, changed_at, result = self._lookup(name, argdict)
+        if result is _MISSING:
+            result = await run(function, argdict)
+            self._store(name, key, result, changed_at, stale)
+        return result
+
+    def invalidate(self, groups: Optional[list[str]]):
+        """
+        Drop the cached results of $groups, or of every group if None.
+        """
+        if groups is None:
+            self.backend.set(self._generation_key(), _token(), None)
+            return
+        for group in groups:
+            self.backend.set(self._version_key(group), _token(), None)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {name: dict(counts) for name, counts in sorted(self._stats.items())}
+
+    def _lookup(self, name: str, argdict: dict) -> tuple[Optional[str], float, Any]:
+        """
+        The key of a call to the API $name, the time its group last changed
+        and its cached result, _MISSING on a miss
+        """
+        key, changed_at = self._key(name, READS[name](argdict), argdict)
+        if key is None:
+            return None, changed_at, _MISSING
+        result = self.backend.get(key, _MISSING)
+        self._count(name, 'misses' if result is _MISSING else 'hits')
+        return key, changed_at, result
+
+    def _store(self, name: str, key: Optional[str], result: tuple, changed_at: float, stale: float):
+        if key is None or result[0] != SUCCESS:
+            return
+        if stale > 0 and time.time() - changed_at < stale:
+            # The result may predate the change.
+            self._count(name, 'unsettled')
+            return
+        self.backend.set(key, result, self.ttl)
+
+    def _generation_key(self) -> str:
+        return '%s:generation' % self.prefix
+
+    def _version_key(self, group: str) -> str:
+        return '%s:version:%s' % (self.prefix, _hash(group))
+
+    def _key(self, name: str, group: str, argdict: dict) -> tuple[Optional[str], float]:
+        """
+        The key of a result under the current generation and group version,
+        and the time the later of them was set. The key is None if they can't
+        be established, in which case nothing is cached.
+        """
+        token_keys = (self._generation_key(), self._version_key(group))
+        tokens = self.backend.get_many(token_keys)
+        for token_key in token_keys:
+            if token_key not in tokens:
+                # add() keeps a token set by a concurrent invalidation. A token
+                # evicted since a change is new again.
+                self.backend.add(token_key, _token(), None)
+                token = self.backend.get(token_key)
+                if token is None:
+                    return None, time.time()
+                tokens[token_key] = token
+        generation, version = tokens[token_keys[0]], tokens[token_keys[1]]
+        key = '%s:%s:%s:%s:%s' % (self.prefix, name, generation, version, _hash(sorted(argdict.items())))
+        return key, max(_token_time(generation), _token_time(version))
+
+    def _count(self, name: str, counter: str):
+        with self._lock:
+            counts = self._stats.setdefault(name, {})
+            counts[counter] = counts.get(counter, 0) + 1
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> Optional[Cache]:
+    """
+    Get the process-wide cache configured by CACHE_BACKEND, creating it on
+    first use. Return None if caching is disabled.
+    """
+    global _cache
+    if CACHE_BACKEND is None:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                if CACHE_BACKEND == 'local':
+                    backend = LocalCache()
+                elif CACHE_BACKEND == 'django':
+                    from django.core.cache import caches
+                    backend = caches[CACHE_DJANGO_ALIAS]
+                else:
+                    raise ValueError('Unknown cache backend %r' % CACHE_BACKEND)
+                _cache = Cache(backend)
+    return _cache
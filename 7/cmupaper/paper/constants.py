@@ -13,6 +13,82 @@ DB_FILE = os.path.abspath(os.getcwd()) + "/hw7.db"
 # Postgres
 DB_DESC = "dbname=%s user=%s" % (DBNAME, DBNAME)
 
+# Connection pool
+DB_POOL_MIN_SIZE = 1
+DB_POOL_MAX_SIZE = 10
+# Seconds to wait for a free connection before giving up
+DB_POOL_TIMEOUT = 5.0
+# Seconds before an idle connection above the minimum size is closed
+DB_POOL_MAX_IDLE = 300.0
+# Seconds a connection may sit idle before it is pinged on checkout
+DB_POOL_CHECK_INTERVAL = 30.0
+
+# Replicas of DB_DESC that the read-only db APIs are sent to in turn, e.g.
+# ["host=replica1 dbname=... user=..."]; empty to send everything to DB_DESC.
+# Each one gets a connection pool of the size above.
+DB_REPLICAS = []
+# Seconds between health checks of the replicas
+DB_REPLICA_CHECK_INTERVAL = 5.0
+# Seconds after a write by a user during which the reads of that user go to
+# DB_DESC, so that replication lag doesn't hide the user's own writes
+DB_READ_YOUR_WRITES_WINDOW = 5.0
+
+# Text extraction of uploaded PDFs
+EXTRACTION_WORKERS = 2
+# Extractions queued or running at once; further uploads stay pending until
+# the extract_papers command picks them up
+EXTRACTION_QUEUE_SIZE = 32
+EXTRACTION_MAX_ATTEMPTS = 3
+# Seconds to wait before retrying a failed extraction
+EXTRACTION_RETRY_DELAY = 5.0
+
+# Seconds a snapshot of the like graph serves recommendations before it is
+# rebuilt in the background; 0 computes every recommendation in SQL instead.
+# Every process holds its own snapshot, about 30 bytes per like, and building
+# one reads the whole likes table and peaks at roughly 300 bytes per like,
+# i.e. about 3 GB per process at 10M likes
+RECOMMEND_MAX_AGE = 0.0
+
+# Seconds between refreshes of the most active user, most popular tag and tag
+# pair on the popular papers page, done in a background thread; 0 queries
+# them on every page view instead
+GLOBAL_STATS_INTERVAL = 10.0
+# Seconds a snapshot of those statistics is served at most, after which the
+# page queries them itself until the next refresh succeeds
+GLOBAL_STATS_MAX_STALENESS = 60.0
+
+# Time the db APIs and report the numbers in Server-Timing headers and on
+# /debug/db_stats/
+DB_INSTRUMENTATION = False
+# Number of requests kept for /debug/db_stats/
+DB_INSTRUMENTATION_RECENT_REQUESTS = 100
+
+# Cache of the timeline and tag pages: 'local' for an LRU cache in each
+# process, 'django' for the Django cache CACHE_DJANGO_ALIAS, or None
+CACHE_BACKEND = 'local'
+CACHE_DJANGO_ALIAS = 'default'
+# Seconds a cached page is served at most
+CACHE_TTL = 30.0
+CACHE_MAX_ENTRIES = 1024
+
+# Prepare the hot statements of the db APIs once per connection instead of
+# having the server parse and plan them on every call
+PREPARE_STATEMENTS = True
+
+# Serve the home, popular papers, search and tag pages with their async views,
+# which issue independent queries concurrently. Meant for running under ASGI.
+ASYNC_VIEWS = False
+
+# Create papers and likes in reset_db as tables partitioned by the month of
+# begin_time and like_time. Every PARTITION_MAINTENANCE_INTERVAL seconds, each
+# server process creates the partitions of the next PARTITION_PREMAKE_MONTHS
+# months and, unless PARTITION_RETAIN_MONTHS is None, archives those older than
+# that many months. The maintain_partitions command does the same once.
+PARTITIONED_TABLES = False
+PARTITION_PREMAKE_MONTHS = 2
+PARTITION_RETAIN_MONTHS = None
+PARTITION_MAINTENANCE_INTERVAL = 3600.0
+
 # Error prompt
 err_internal = "Internal error, refresh page to try again"
 err_login =  "Please login"
@@ -1,59 +1,387 @@
-import psycopg2 as psy
+import asyncio
+import threading
+import weakref
+from typing import Optional
+
+import psycopg
+from psycopg.pq import Format
 
 from .constants import *
+from . import instrumentation
+from .cache import get_cache
+from .pool import AsyncConnectionPool, ConnectionPool, PoolClosed, PoolTimeout
+from .routing import get_router, is_read, is_write
+
+# The connection pool of the primary and of each replica, by DSN
+_pools = {}
+_pool_lock = threading.Lock()
+# The async pools of each event loop, by DSN
+_async_pools = weakref.WeakKeyDictionary()
+# The pool and the replica of each checked out replica connection, by id()
+_replica_conns = {}
+
+
+class BinaryCursor(psycopg.Cursor):
+    """
+    A cursor receiving results in binary format, which saves the server
+    formatting and the client parsing numbers and timestamps as text
+    """
+
+    def __init__(self, connection, *, row_factory=None):
+        super().__init__(connection, row_factory=row_factory)
+        self.format = Format.BINARY
+
+
+class AsyncBinaryCursor(psycopg.AsyncCursor):
+    """
+    The async counterpart of BinaryCursor
+    """
+
+    def __init__(self, connection, *, row_factory=None):
+        super().__init__(connection, row_factory=row_factory)
+        self.format = Format.BINARY
+
+
+def _connect_options(generic_plans: bool) -> dict:
+    # Planning a statement on partitioned papers or likes for the values of
+    # its parameters means planning it for every partition, which takes
+    # longer than running it. The generic plan of a prepared statement prunes
+    # the partitions when it is run instead.
+    return {'options': '-c plan_cache_mode=force_generic_plan'} if generic_plans else {}
+
+
+def connect(dsn: str = DB_DESC, generic_plans: bool = PARTITIONED_TABLES) -> psycopg.Connection:
+    """
+    Open a database connection set up the way the db APIs are tested with.
+    With $generic_plans, prepared statements always use their generic plan.
+    """
+    return psycopg.connect(dsn, cursor_factory=BinaryCursor, **_connect_options(generic_plans))
+
+
+async def connect_async(dsn: str = DB_DESC, generic_plans: bool = PARTITIONED_TABLES) -> psycopg.AsyncConnection:
+    """
+    Open an async database connection set up like the ones of connect()
+    """
+    return await psycopg.AsyncConnection.connect(dsn, cursor_factory=AsyncBinaryCursor,
+                                                 **_connect_options(generic_plans))
+
 
+def get_pool(dsn: Optional[str] = None) -> ConnectionPool:
+    """
+    Get the process-wide connection pool of $dsn, the primary by default,
+    creating it on first use
+    """
+    dsn = dsn or DB_DESC
+    pool = _pools.get(dsn)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(dsn)
+            if pool is None:
+                pool = _pools[dsn] = ConnectionPool(
+                    dsn,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    check_interval=DB_POOL_CHECK_INTERVAL,
+                    connect=connect,
+                )
+    return pool
+
+
+def get_pool_stats():
+    """
+    Get counters and the current size of the connection pool of the primary
+    """
+    return get_pool().get_stats()
 
-def get_db_connection():
+
+def get_db_connection(read_only: bool = False, user: Optional[str] = None):
     """
-    Get a postgres database connection
+    Get a postgres database connection from the pool. A read-only connection
+    comes from a replica, unless none is up or $user wrote recently, see
+    routing.py.
     """
+    router = get_router() if read_only else None
+    replica = router.choose(user) if router is not None else None
+    if replica is not None:
+        try:
+            pool = get_pool(replica.dsn)
+            conn = pool.getconn()
+            _replica_conns[id(conn)] = pool, replica
+            return SUCCESS, conn
+        except psycopg.DatabaseError as e:
+            print("Error %s" % e)
+            router.mark_down(replica, e)
+        except (PoolTimeout, PoolClosed) as e:
+            # Busy rather than down: the primary takes this read.
+            print("Error %s" % e)
     try:
-        conn = psy.connect(DB_DESC)
+        conn = get_pool().getconn()
         return SUCCESS, conn
-    except psy.DatabaseError as e:
+    except (psycopg.DatabaseError, PoolTimeout, PoolClosed) as e:
         print("Error %s" % e)
         return DB_CONNECTION_ERROR, None
 
 
-def call_db_with_conn(conn, function_name, argdict):
+def _lost_replica(conn) -> bool:
+    """
+    Mark the replica of $conn down if $conn is a replica connection that was
+    lost. Return whether it was.
+    """
+    entry = _replica_conns.get(id(conn))
+    if entry is None or not conn.broken:
+        return False
+    router = get_router()
+    if router is not None:
+        router.mark_down(entry[1], psycopg.OperationalError('the connection was lost'))
+    return True
+
+
+def _note_write(function_name, user, result):
+    """
+    Start the read-your-writes window of $user after a successful write
+    """
+    if is_write(function_name) and result[0] == SUCCESS:
+        router = get_router()
+        if router is not None:
+            router.note_write(user)
+
+
+def _get_cache(function_name, user):
+    """
+    The cache to call the API $function_name through, or None. The reads of a
+    user inside the read-your-writes window skip it, so that they reach the
+    primary whatever the replicas filled it with.
+    """
+    cache = get_cache()
+    if cache is None or not cache.handles(function_name):
+        return None
+    router = get_router() if is_read(function_name) else None
+    if router is not None and router.wrote_recently(user):
+        return None
+    return cache
+
+
+def _replica_lag(replica: bool) -> float:
+    """
+    How many seconds a read from a replica may be behind the primary, if
+    $replica
+    """
+    router = get_router() if replica else None
+    return router.sticky_window if router is not None else 0.0
+
+
+def _invoke(conn, function_name, argdict):
+    if instrumentation.enabled:
+        return instrumentation.call(function_name, conn, argdict)
+    return function_name(conn, **argdict)
+
+
+def call_db_with_conn(conn, function_name, argdict, user: Optional[str] = None):
     """
-    Call a db API via the given connection
+    Call a db API via the given connection, or serve it from the cache. A
+    write starts the read-your-writes window of $user, by default its uname
+    argument, and the reads of $user skip the cache inside it.
     """
+    if user is None:
+        user = argdict.get('uname')
     try:
-        return function_name(conn, **argdict)
-    except psy.DatabaseError as e:
+        cache = _get_cache(function_name, user)
+        if cache is not None:
+            result = cache.call(function_name, argdict, lambda function, args: _invoke(conn, function, args),
+                                stale=_replica_lag(id(conn) in _replica_conns))
+        else:
+            result = _invoke(conn, function_name, argdict)
+    except psycopg.DatabaseError as e:
         print("Error %s: " % e.args[0])
-        conn.rollback()
+        if not _lost_replica(conn):
+            conn.rollback()
         return DB_ERROR, None
+    _note_write(function_name, user, result)
+    return result
 
 
 def close_db_connection(conn):
     """
-    Safely close a database connection. Ignore any error.
+    Safely give a database connection back to its pool. Ignore any error.
     """
     try:
-        conn.close()
+        pool, _ = _replica_conns.pop(id(conn), (None, None))
+        (pool or get_pool()).putconn(conn)
     except:
         pass
 
 
-def call_db(function_name, argdict):
+def call_db(function_name, argdict, user: Optional[str] = None):
     """
-    Make a one shot request to the database. Ignore any error when closing the connection.
+    Make a one shot request to the database on a pooled connection, or serve it
+    from the cache without taking a connection. Ignore any error when giving
+    the connection back.
+
+    The read-only APIs run on a replica unless $user, by default the uname
+    argument, wrote recently; if the replica is lost meanwhile, they run again
+    on the primary. Everything else runs on the primary.
     """
+    if user is None:
+        user = argdict.get('uname')
+    read_only = is_read(function_name)
     conn = None
-    try:
+
+    def run(function, args):
+        nonlocal conn
+        if conn is None:
+            res, conn = get_db_connection(read_only, user)
+            if res != SUCCESS:
+                return res, None
+        try:
+            return _invoke(conn, function, args)
+        except psycopg.OperationalError:
+            if not _lost_replica(conn):
+                raise
+        close_db_connection(conn)
+        conn = None
         res, conn = get_db_connection()
         if res != SUCCESS:
             return res, None
-        return function_name(conn, **argdict)
-    except psy.DatabaseError as e:
+        return _invoke(conn, function, args)
+
+    try:
+        cache = _get_cache(function_name, user)
+        if cache is not None:
+            result = cache.call(function_name, argdict, run, stale=_replica_lag(read_only))
+        else:
+            result = run(function_name, argdict)
+    except psycopg.DatabaseError as e:
         print("Error %s: " % e.args[0])
         conn.rollback()
         return DB_ERROR, None
     finally:
         if conn:
-            try:
-                conn.close()
-            except:
-                pass
+            close_db_connection(conn)
+    _note_write(function_name, user, result)
+    return result
+
+
+def get_async_pool(dsn: Optional[str] = None) -> AsyncConnectionPool:
+    """
+    Get the async connection pool of $dsn, the primary by default, for the
+    running event loop, creating it on first use. Under ASGI, one loop serves
+    every request of the process.
+    """
+    dsn = dsn or DB_DESC
+    loop = asyncio.get_running_loop()
+    pool = _async_pools.get(loop, {}).get(dsn)
+    if pool is None:
+        with _pool_lock:
+            pools = _async_pools.setdefault(loop, {})
+            pool = pools.get(dsn)
+            if pool is None:
+                pool = pools[dsn] = AsyncConnectionPool(
+                    dsn,
+                    min_size=DB_POOL_MIN_SIZE,
+                    max_size=DB_POOL_MAX_SIZE,
+                    timeout=DB_POOL_TIMEOUT,
+                    max_idle=DB_POOL_MAX_IDLE,
+                    check_interval=DB_POOL_CHECK_INTERVAL,
+                    connect=connect_async,
+                )
+    return pool
+
+
+async def close_async_pool():
+    """
+    Close the async connection pools of the running event loop, if any. A loop
+    that is about to be closed should call it first.
+    """
+    pools = _async_pools.pop(asyncio.get_running_loop(), {})
+    for pool in pools.values():
+        await pool.close()
+
+
+async def get_async_db_connection(read_only: bool = False, user: Optional[str] = None):
+    """
+    Get an async postgres database connection from the pools of the running
+    event loop, from a replica if read-only, see get_db_connection()
+    """
+    router = get_router() if read_only else None
+    replica = router.choose(user) if router is not None else None
+    if replica is not None:
+        try:
+            pool = get_async_pool(replica.dsn)
+            conn = await pool.getconn()
+            _replica_conns[id(conn)] = pool, replica
+            return SUCCESS, conn
+        except psycopg.DatabaseError as e:
+            print("Error %s" % e)
+            router.mark_down(replica, e)
+        except (PoolTimeout, PoolClosed) as e:
+            print("Error %s" % e)
+    try:
+        conn = await get_async_pool().getconn()
+        return SUCCESS, conn
+    except (psycopg.DatabaseError, PoolTimeout, PoolClosed) as e:
+        print("Error %s" % e)
+        return DB_CONNECTION_ERROR, None
+
+
+async def close_async_db_connection(conn):
+    """
+    Safely give an async database connection back to its pool. Ignore any error.
+    """
+    try:
+        pool, _ = _replica_conns.pop(id(conn), (None, None))
+        await (pool or get_async_pool()).putconn(conn)
+    except:
+        pass
+
+
+async def call_db_async(function_name, argdict, user: Optional[str] = None):
+    """
+    The counterpart of call_db for the APIs in async_functions. Every call
+    takes a connection of its own, so that independent calls can be awaited
+    concurrently, e.g. with asyncio.gather().
+    """
+    if user is None:
+        user = argdict.get('uname')
+    read_only = is_read(function_name)
+    conn = None
+
+    async def invoke(function, args):
+        if instrumentation.enabled:
+            return await instrumentation.acall(function, conn, args)
+        return await function(conn, **args)
+
+    async def run(function, args):
+        nonlocal conn
+        if conn is None:
+            res, conn = await get_async_db_connection(read_only, user)
+            if res != SUCCESS:
+                return res, None
+        try:
+            return await invoke(function, args)
+        except psycopg.OperationalError:
+            if not _lost_replica(conn):
+                raise
+        await close_async_db_connection(conn)
+        conn = None
+        res, conn = await get_async_db_connection()
+        if res != SUCCESS:
+            return res, None
+        return await invoke(function, args)
+
+    try:
+        cache = _get_cache(function_name, user)
+        if cache is not None:
+            result = await cache.acall(function_name, argdict, run, stale=_replica_lag(read_only))
+        else:
+            result = await run(function_name, argdict)
+    except psycopg.DatabaseError as e:
+        print("Error %s: " % e.args[0])
+        await conn.rollback()
+        return DB_ERROR, None
+    finally:
+        if conn:
+            await close_async_db_connection(conn)
+    _note_write(function_name, user, result)
+    return result
@@ -0,0 +1,184 @@
+"""
+Background text extraction of uploaded PDF files.
+
+Extracting the text of a large PDF takes seconds, so new_paper only stores the
+file and adds the paper. The text is extracted by a pool of worker processes
+and written to papers.data afterwards, which also updates the search indexes.
+"""
+import multiprocessing
+import threading
+import traceback
+from concurrent.futures import Executor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional
+
+from .constants import *
+from .database_wrapper import call_db
+from . import functions
+
+
+def extract_text(path: str) -> str:
+    """
+    Extract the text of a PDF file. Runs in a worker process.
+    """
+    import textract
+
+    text = textract.process(path)
+    # postgres text can't hold NUL characters.
+    return text.decode('utf-8', errors='replace').replace('\x00', '')
+
+
+def extract_paper(pid: int, path: str, max_attempts: int = EXTRACTION_MAX_ATTEMPTS, call=call_db) -> bool:
+    """
+    Extract the text of paper $pid in the calling process, retrying right away
+    on failure. Return whether the extraction succeeded.
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            text = extract_text(path)
+        except Exception as e:
+            error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            call(functions.record_extraction_failure,
+                 {'pid': pid, 'error': error, 'final': attempt == max_attempts})
+            continue
+        status, res = call(functions.save_extracted_text, {'pid': pid, 'text': text})
+        return status == SUCCESS
+    return False
+
+
+class ExtractionPool:
+    """
+    Run extractions on an executor, at most `queue_size` of them queued or
+    running at a time. A failed extraction is retried after `retry_delay`
+    seconds until it has been attempted `max_attempts` times.
+
+    Outcomes are recorded through `call`, which has the signature of
+    database_wrapper.call_db.
+    """
+
+    def __init__(self, workers: int = EXTRACTION_WORKERS, queue_size: int = EXTRACTION_QUEUE_SIZE,
+                 max_attempts: int = EXTRACTION_MAX_ATTEMPTS, retry_delay: float = EXTRACTION_RETRY_DELAY,
+                 extract: Callable[[str], str] = extract_text, executor: Optional[Executor] = None,
+                 call=call_db):
+        self._workers = workers
+        # Only an executor created here is replaced when a worker dies.
+        self._owns_executor = executor is None
+        if executor is None:
+            executor = self._new_executor()
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._extract = extract
+        self._executor = executor
+        self._call = call
+        self.queue_size = queue_size
+        # Number of extractions queued, running or waiting for a retry
+        self._active = 0
+        self._timers = set()
+        self._cond = threading.Condition()
+
+    def submit(self, pid: int, path: str) -> bool:
+        """
+        Extract the text of the PDF file at $path for paper $pid in the
+        background. Return False without queueing anything if the queue is full.
+        """
+        with self._cond:
+            if self._active >= self.queue_size:
+                return False
+            self._active += 1
+        try:
+            self._run(pid, path, 1)
+        except Exception:
+            self._finish()
+            raise
+        return True
+
+    def join(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait until all submitted extractions have finished. Return False if
+        some are still active after $timeout seconds.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._active == 0, timeout)
+
+    def _finish(self):
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    def _new_executor(self) -> Executor:
+        # Don't fork the web server process with its open connections.
+        return ProcessPoolExecutor(self._workers, mp_context=multiprocessing.get_context('spawn'))
+
+    def _run(self, pid: int, path: str, attempt: int):
+        executor = self._executor
+        try:
+            future = executor.submit(self._extract, path)
+        except BrokenProcessPool:
+            # A worker died, e.g. killed by the OOM killer on a huge PDF.
+            if not self._owns_executor:
+                raise
+            with self._cond:
+                if self._executor is executor:
+                    self._executor = self._new_executor()
+                executor = self._executor
+            future = executor.submit(self._extract, path)
+        future.add_done_callback(lambda f: self._done(pid, path, attempt, f))
+
+    def _done(self, pid: int, path: str, attempt: int, future):
+        try:
+            text = future.result()
+        except Exception as e:
+            final = attempt >= self.max_attempts
+            error = ''.join(traceback.format_exception_only(type(e), e)).strip()
+            self._call(functions.record_extraction_failure,
+                       {'pid': pid, 'error': error, 'final': final})
+            if final:
+                self._finish()
+            else:
+                self._retry_later(pid, path, attempt + 1)
+            return
+        self._call(functions.save_extracted_text, {'pid': pid, 'text': text})
+        self._finish()
+
+    def _retry_later(self, pid: int, path: str, attempt: int):
+        def retry():
+            with self._cond:
+                self._timers.discard(timer)
+            try:
+                self._run(pid, path, attempt)
+            except RuntimeError:
+                # The executor has been shut down.
+                self._finish()
+
+        timer = threading.Timer(self.retry_delay, retry)
+        timer.daemon = True
+        with self._cond:
+            self._timers.add(timer)
+        timer.start()
+
+    def shutdown(self, wait: bool = True):
+        """
+        Stop accepting extractions. Pending retries are dropped and stay
+        pending in the database.
+        """
+        with self._cond:
+            timers, self._timers = self._timers, set()
+        for timer in timers:
+            timer.cancel()
+        self._executor.shutdown(wait=wait)
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_extraction_pool() -> ExtractionPool:
+    """
+    Get the process-wide extraction pool, creating it on first use
+    """
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ExtractionPool()
+    return _pool
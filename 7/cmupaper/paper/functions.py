@@ -4,9 +4,13 @@ AndrewID:
 """
 from typing import Optional, Any
 from collections.abc import Sequence
+from contextlib import contextmanager
+import base64
+import json
 
-import psycopg2 as psy
 import psycopg
+from psycopg import sql
+from psycopg.rows import RowMaker
 
 from datetime import datetime
 from pytz import timezone
@@ -21,10 +25,10 @@ General rules:
     database_wrapper(...):
         conn = None
         try:
-            conn = psycopg2.connection()
+            conn = psycopg.connect()
             res = foo(conn, ...)
             return res
-        except psycopg2.DatabaseError, e:
+        except psycopg.DatabaseError, e:
             print "Error %s: " % e.argsp[0]
             conn.rollback()
             return DB_ERROR, None
@@ -49,6 +53,152 @@ Connection = psycopg.Connection[tuple[Any, ...]]
 
 Paper = tuple[int, str, str, datetime, str]
 
+Page = tuple[list[Paper], Optional[str]]
+"""A page of papers and the cursor of the next page, None on the last page"""
+
+HomeBundle = tuple[list[Paper], list[Paper], list[Paper], int, int, int]
+"""Results of get_timeline, get_papers_by_liked, get_recommend_papers,
+get_number_papers_user, get_number_liked_user and get_number_tags_user"""
+
+
+@contextmanager
+def _read_only(conn: Connection):
+    """
+    Make transactions started on the connection read-only for the duration of
+    the block. The connection must not be in a transaction when entering and
+    leaving the block.
+    """
+    previous = conn.read_only
+    conn.read_only = True
+    try:
+        yield
+    finally:
+        conn.read_only = previous
+
+
+@contextmanager
+def _autocommit(conn: Connection):
+    """
+    Make every statement executed on the connection commit by itself for the
+    duration of the block. The connection must not be in a transaction when
+    entering the block.
+    """
+    previous = conn.autocommit
+    conn.autocommit = True
+    try:
+        yield
+    finally:
+        conn.autocommit = previous
+
+
+def _page_seek(cursor: Optional[str], key: str) -> tuple[str, dict[str, Any]]:
+    """
+    Translate a page cursor into an SQL condition selecting the rows after the
+    cursor in the order of `key DESC, pid`, and the parameters of the condition.
+
+    A cursor holds the sort key and pid of the last paper on the previous page.
+    Raises ValueError if the cursor is malformed or was made for another key.
+    """
+    if cursor is None:
+        return 'TRUE', {}
+    try:
+        cursor_key, value, pid = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (TypeError, ValueError) as e:
+        raise ValueError('Malformed page cursor') from e
+    if cursor_key != key or not isinstance(pid, int):
+        raise ValueError('Page cursor is not for this listing')
+    if key == 'begin_time':
+        if not isinstance(value, str):
+            raise ValueError('Malformed page cursor')
+        value = datetime.fromisoformat(value)
+    elif not isinstance(value, (int, float)):
+        raise ValueError('Malformed page cursor')
+    # The extra `key <= value` lets an index on (key DESC, pid) seek directly.
+    condition = '{0} <= %(seek_value)s AND ({0} < %(seek_value)s OR pid > %(seek_pid)s)'.format(key)
+    return condition, {'seek_value': value, 'seek_pid': pid}
+
+
+def _scalar_row(cursor: psycopg.Cursor) -> RowMaker[Any]:
+    """
+    Row factory returning the first column of every row, e.g. for a list of tags
+    """
+    return lambda values: values[0]
+
+
+def _page_row(cursor: psycopg.Cursor) -> RowMaker[tuple[Paper, Any]]:
+    """
+    Row factory for page queries, returning the paper in the first five columns
+    of every row and the sixth column, if any
+    """
+    if len(cursor.description) > 5:
+        return lambda values: (tuple(values[:5]), values[5])
+    return lambda values: (tuple(values[:5]), None)
+
+
+def _home_row(cursor: psycopg.Cursor) -> RowMaker[tuple[int, Any]]:
+    """
+    Row factory for get_home_bundle(), returning the number of the result set
+    of every row, and either its paper or the three counts
+    """
+    return lambda values: (values[0], tuple(values[2:7]) if values[0] < 3 else tuple(values[7:]))
+
+
+def _split_page(rows: list[tuple[Paper, Any]], count: int, key: str) -> Page:
+    """
+    Split the result of a page query, which fetches $count + 1 rows with
+    _page_row(), into the papers of the page and the cursor of the next page.
+
+    For keys other than begin_time, the sort key is the sixth column of a row.
+    """
+    papers = [paper for paper, _ in rows[:count]]
+    if len(rows) <= count:
+        return papers, None
+    last, value = rows[count - 1]
+    if key == 'begin_time':
+        value = last[3].isoformat()
+    cursor = base64.urlsafe_b64encode(json.dumps([key, value, last[0]]).encode())
+    return papers, cursor.decode()
+
+
+def _copy_rows(cursor: psycopg.Cursor, table: str, columns: Sequence[str], rows) -> None:
+    """
+    Load rows into a table with COPY
+    """
+    with cursor.copy('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns))) as copy:
+        for row in rows:
+            copy.write_row(row)
+
+
+PREPARED_STATEMENTS: dict[str, str] = {}
+"""Statements prepared once per connection, by name. APIs opt in with _prepared()."""
+
+prepare_statements = PREPARE_STATEMENTS
+"""Whether _execute_prepared() prepares statements, switched off to compare"""
+
+
+def _prepared(name: str, query: str) -> str:
+    """
+    Register $query as a statement prepared once per connection and return its
+    name, to be passed to _execute_prepared(). The parameters of $query must be
+    positional.
+    """
+    if name in PREPARED_STATEMENTS:
+        raise ValueError('Statement %s is registered twice' % name)
+    if '%(' in query or '%%' in query:
+        raise ValueError('Statement %s must only have positional parameters' % name)
+    PREPARED_STATEMENTS[name] = query
+    return name
+
+
+def _execute_prepared(cursor: psycopg.Cursor, name: str, params: Sequence[Any]) -> None:
+    """
+    Execute the registered statement $name, preparing it on the connection of
+    the cursor the first time. psycopg keeps track of the statements prepared
+    on each connection, and prepares the ones not registered only after they
+    have run a few times.
+    """
+    cursor.execute(PREPARED_STATEMENTS[name], params, prepare=prepare_statements)
+
 
 def example_select_current_time(conn):
     """
@@ -70,7 +220,7 @@ def example_select_current_time(conn):
         dt = res[0]
         # return the status and result
         return 0, dt
-    except psy.DatabaseError as e:
+    except psycopg.DatabaseError as e:
         # catch any database exception and return failure status
         return 1, None
 
@@ -78,19 +228,40 @@ def example_select_current_time(conn):
 # Admin APIs
 
 
-def reset_db(conn: Connection):
+def reset_db(conn: Connection, partitioned: bool = PARTITIONED_TABLES):
     """
     Reset the entire database.
     Delete all tables and then recreate them.
 
     :param conn: A postgres database connection object
+    :param partitioned: Whether to create papers and likes as tables partitioned by month of begin_time and
+        like_time. See maintain_partitions().
     :return: (status, retval)
         (0, None)   Success
         (1, None)   Failure
     """
+    # A partitioned table can only have unique keys that include the column it
+    # is partitioned by, so no foreign key can reference papers(pid) then. The
+    # triggers created in partition_commands check likes, tags and extractions
+    # and delete the rows of a deleted paper instead. Like any deleted paper, a
+    # paper moved to another month by an UPDATE of begin_time loses its tags
+    # and likes then.
+    if partitioned:
+        paper_key, paper_partitioning = 'PRIMARY KEY(pid, begin_time)', ' PARTITION BY RANGE (begin_time)'
+        like_key, like_partitioning = 'PRIMARY KEY(pid, username, like_time)', ' PARTITION BY RANGE (like_time)'
+        paper_reference = ''
+    else:
+        paper_key, paper_partitioning = 'PRIMARY KEY(pid)', ''
+        like_key, like_partitioning = 'PRIMARY KEY(pid, username)', ''
+        paper_reference = ',\n            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE'
     commands = (
+        # Partitions archived by maintain_partitions()
         """
-        DROP TABLE IF EXISTS tags, tagnames, likes, papers, users
+        DROP SCHEMA IF EXISTS archive CASCADE
+        """,
+        """
+        DROP TABLE IF EXISTS extractions, user_tag_counts, user_stats, tag_pair_counts, tags, tagnames, likes, papers,
+            users
         """,
         """
         CREATE TABLE IF NOT EXISTS users(
@@ -99,52 +270,815 @@ def reset_db(conn: Connection):
             PRIMARY KEY(username)
         )
         """,
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS papers(
-            pid  SERIAL PRIMARY KEY,
+            pid  SERIAL,
             username VARCHAR(50) NOT NULL,
             title VARCHAR(50),
             begin_time TIMESTAMP NOT NULL,
             description VARCHAR(500),
             data TEXT,
+            like_count INT NOT NULL DEFAULT 0,
+            search_vector tsvector GENERATED ALWAYS AS (
+                setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+                setweight(to_tsvector('english', coalesce(description, '')), 'B') ||
+                setweight(to_tsvector('english', coalesce(data, '')), 'C')
+            ) STORED,
+            {paper_key},
             FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
-        );
+        ){paper_partitioning};
+        """,
+        # Secondary indexes, each matched to the predicate and the order of
+        # the APIs listed with it. See the advise_indexes command for the plans
+        # they replace.
+        # get_timeline_all and the time range of get_most_popular_papers
+        """
+        CREATE INDEX papers_begin_time_idx ON papers (begin_time DESC, pid)
+        """,
+        # get_timeline, get_timeline_page and the timeline of get_home_bundle
+        # as index-only scans, get_number_papers_user, get_number_tags_user,
+        # get_most_active_users and the cascade of deleting a user
+        """
+        CREATE INDEX papers_username_idx ON papers (username, begin_time DESC, pid) INCLUDE (title, description)
+        """,
+        # Leaderboard of liked papers bucketed by the day they are posted, kept
+        # up to date through the like_count trigger.
+        """
+        CREATE INDEX papers_popular_idx ON papers (date_trunc('day', begin_time), like_count DESC, pid)
+            WHERE like_count > 0
         """,
         """
         CREATE INDEX paper_text_idx ON papers USING gin(to_tsvector('english', data))
         """,
         """
+        CREATE INDEX papers_search_vector_idx ON papers USING gin(search_vector)
+        """,
+        """
         CREATE TABLE IF NOT EXISTS tagnames(
             tagname VARCHAR(50) NOT NULL,
             PRIMARY KEY(tagname)
         );
         """,
-        """
+        f"""
         CREATE TABLE IF NOT EXISTS likes(
             pid INT NOT NULL,
             username VARCHAR(50) NOT NULL,
             like_time TIMESTAMP NOT NULL,
-            PRIMARY KEY(pid, username),
-            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE,
-            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
-        );
+            {like_key},
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE{paper_reference}
+        ){like_partitioning};
+        """,
+        # get_number_liked_user, get_papers_by_liked, the likers of
+        # get_recommend_papers and the cascade of deleting a user
+        """
+        CREATE INDEX likes_username_idx ON likes (username, pid)
+        """,
+        # papers.like_count is kept equal to the number of likes of the paper.
+        """
+        CREATE OR REPLACE FUNCTION update_like_count() RETURNS trigger AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                UPDATE papers SET like_count = like_count + 1 WHERE pid = NEW.pid;
+            ELSIF TG_OP = 'DELETE' THEN
+                UPDATE papers SET like_count = like_count - 1 WHERE pid = OLD.pid;
+            ELSIF NEW.pid <> OLD.pid THEN
+                UPDATE papers SET like_count = like_count - 1 WHERE pid = OLD.pid;
+                UPDATE papers SET like_count = like_count + 1 WHERE pid = NEW.pid;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
         """,
         """
+        CREATE TRIGGER likes_like_count AFTER INSERT OR DELETE OR UPDATE OF pid ON likes
+            FOR EACH ROW EXECUTE FUNCTION update_like_count()
+        """,
+        f"""
         CREATE TABLE IF NOT EXISTS tags(
             pid INT NOT NULL,
             tagname VARCHAR(50) NOT NULL,
             PRIMARY KEY(pid, tagname),
-            FOREIGN KEY(pid) REFERENCES papers ON DELETE CASCADE,
-            FOREIGN KEY(tagname) REFERENCES tagnames ON DELETE CASCADE
+            FOREIGN KEY(tagname) REFERENCES tagnames ON DELETE CASCADE{paper_reference}
         );
         """,
+        # get_papers_by_tag, get_papers_by_tag_page, get_most_popular_tags as
+        # an index-only scan and the cascade of deleting a tag name
+        """
+        CREATE INDEX tags_tagname_idx ON tags (tagname, pid)
+        """,
+        # Number of papers tagged with both tag1 and tag2, where tag1 < tag2
+        """
+        CREATE TABLE IF NOT EXISTS tag_pair_counts(
+            tag1 VARCHAR(50) NOT NULL,
+            tag2 VARCHAR(50) NOT NULL,
+            pair_count INT NOT NULL,
+            PRIMARY KEY(tag1, tag2)
+        );
+        """,
+        """
+        CREATE INDEX tag_pair_counts_popular_idx ON tag_pair_counts (pair_count DESC, tag1, tag2)
+        """,
+        # tag_pair_counts is kept up to date per statement, so that the pairs
+        # among tags inserted together are counted once. The pairs of the
+        # affected papers are counted before and after the statement and the
+        # difference is added.
+        """
+        CREATE OR REPLACE FUNCTION update_tag_pair_counts() RETURNS trigger AS $$
+        DECLARE
+            old_rows TEXT := 'SELECT pid, tagname FROM tags WHERE false';
+            new_rows TEXT := 'SELECT pid, tagname FROM tags WHERE false';
+            changed BOOLEAN;
+        BEGIN
+            IF TG_OP IN ('DELETE', 'UPDATE') THEN
+                old_rows := 'SELECT pid, tagname FROM old_tags';
+            END IF;
+            IF TG_OP IN ('INSERT', 'UPDATE') THEN
+                new_rows := 'SELECT pid, tagname FROM new_tags';
+            END IF;
+            -- Statements that change no tags, like the cascade from a paper
+            -- whose tags are already deleted, change no counts.
+            EXECUTE format('SELECT EXISTS (%s UNION ALL %s)', old_rows, new_rows) INTO changed;
+            IF NOT changed THEN
+                RETURN NULL;
+            END IF;
+            EXECUTE format($q$
+                WITH old_rows AS (%s), new_rows AS (%s),
+                after AS (
+                    SELECT pid, tagname FROM tags
+                    WHERE pid IN (SELECT pid FROM old_rows UNION SELECT pid FROM new_rows)
+                ),
+                before AS (
+                    (SELECT pid, tagname FROM after EXCEPT ALL SELECT pid, tagname FROM new_rows)
+                    UNION ALL SELECT pid, tagname FROM old_rows
+                ),
+                delta AS (
+                    SELECT a.tagname AS tag1, b.tagname AS tag2, 1 AS n
+                    FROM after AS a JOIN after AS b ON a.pid = b.pid AND a.tagname < b.tagname
+                    UNION ALL
+                    SELECT a.tagname, b.tagname, -1
+                    FROM before AS a JOIN before AS b ON a.pid = b.pid AND a.tagname < b.tagname
+                )
+                INSERT INTO tag_pair_counts (tag1, tag2, pair_count)
+                SELECT tag1, tag2, SUM(n) FROM delta GROUP BY tag1, tag2 HAVING SUM(n) <> 0
+                ON CONFLICT (tag1, tag2) DO UPDATE
+                    SET pair_count = tag_pair_counts.pair_count + EXCLUDED.pair_count
+            $q$, old_rows, new_rows);
+            DELETE FROM tag_pair_counts WHERE pair_count <= 0;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER tags_pair_counts_insert AFTER INSERT ON tags
+            REFERENCING NEW TABLE AS new_tags
+            FOR EACH STATEMENT EXECUTE FUNCTION update_tag_pair_counts()
+        """,
+        """
+        CREATE TRIGGER tags_pair_counts_delete AFTER DELETE ON tags
+            REFERENCING OLD TABLE AS old_tags
+            FOR EACH STATEMENT EXECUTE FUNCTION update_tag_pair_counts()
+        """,
+        """
+        CREATE TRIGGER tags_pair_counts_update AFTER UPDATE ON tags
+            REFERENCING OLD TABLE AS old_tags NEW TABLE AS new_tags
+            FOR EACH STATEMENT EXECUTE FUNCTION update_tag_pair_counts()
+        """,
+        # The counters of every user shown on the home page: papers posted,
+        # likes given and distinct tags used. Kept up to date by the triggers
+        # below, so that the counters are single-row lookups and the most
+        # active users an index scan.
+        """
+        CREATE TABLE IF NOT EXISTS user_stats(
+            username VARCHAR(50) NOT NULL,
+            paper_count INT NOT NULL DEFAULT 0,
+            liked_count INT NOT NULL DEFAULT 0,
+            tag_count INT NOT NULL DEFAULT 0,
+            PRIMARY KEY(username),
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE INDEX user_stats_active_idx ON user_stats (paper_count DESC, username) WHERE paper_count > 0
+        """,
+        # Number of papers of username tagged with tagname, so that tag_count
+        # only changes when the first paper of a user gets a tag or the last
+        # one loses it
+        """
+        CREATE TABLE IF NOT EXISTS user_tag_counts(
+            username VARCHAR(50) NOT NULL,
+            tagname VARCHAR(50) NOT NULL,
+            paper_count INT NOT NULL,
+            PRIMARY KEY(username, tagname),
+            FOREIGN KEY(username) REFERENCES users ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE OR REPLACE FUNCTION insert_user_stats() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO user_stats (username) SELECT username FROM new_users;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER users_stats_insert AFTER INSERT ON users
+            REFERENCING NEW TABLE AS new_users
+            FOR EACH STATEMENT EXECUTE FUNCTION insert_user_stats()
+        """,
+        # Add the number of rows inserted into, or subtract the number of rows
+        # deleted from, the papers or likes of each user to the counter of
+        # user_stats named by the trigger argument. The statements are static,
+        # unlike in the functions on tags above, so that their plans are
+        # cached.
+        """
+        CREATE OR REPLACE FUNCTION update_user_stats_count() RETURNS trigger AS $$
+        DECLARE
+            changed_users VARCHAR[];
+            changed_counts INT[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT array_agg(username), array_agg(n) INTO changed_users, changed_counts
+                FROM (SELECT username, COUNT(*) AS n FROM new_rows GROUP BY username) AS delta;
+            ELSE
+                SELECT array_agg(username), array_agg(-n) INTO changed_users, changed_counts
+                FROM (SELECT username, COUNT(*) AS n FROM old_rows GROUP BY username) AS delta;
+            END IF;
+            IF TG_ARGV[0] = 'paper_count' THEN
+                UPDATE user_stats SET paper_count = paper_count + delta.n
+                FROM unnest(changed_users, changed_counts) AS delta(username, n)
+                WHERE user_stats.username = delta.username;
+            ELSE
+                UPDATE user_stats SET liked_count = liked_count + delta.n
+                FROM unnest(changed_users, changed_counts) AS delta(username, n)
+                WHERE user_stats.username = delta.username;
+            END IF;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql SET plan_cache_mode = force_generic_plan
+        """,
+        """
+        CREATE TRIGGER papers_stats_insert AFTER INSERT ON papers
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION update_user_stats_count('paper_count')
+        """,
+        """
+        CREATE TRIGGER papers_stats_delete AFTER DELETE ON papers
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION update_user_stats_count('paper_count')
+        """,
+        """
+        CREATE TRIGGER likes_stats_insert AFTER INSERT ON likes
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION update_user_stats_count('liked_count')
+        """,
+        """
+        CREATE TRIGGER likes_stats_delete AFTER DELETE ON likes
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE FUNCTION update_user_stats_count('liked_count')
+        """,
+        # user_tag_counts and tag_count are kept up to date per statement on
+        # tags, looking up the user of every tag in papers. The stats of the
+        # users affected are locked first, so that the counts read afterwards
+        # include every committed change to their tags.
+        """
+        CREATE OR REPLACE FUNCTION update_user_tag_counts() RETURNS trigger AS $$
+        DECLARE
+            changed_pids INT[];
+            changed_tags VARCHAR[];
+            changed_counts INT[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                SELECT array_agg(pid), array_agg(tagname), array_agg(1)
+                INTO changed_pids, changed_tags, changed_counts FROM new_tags;
+            ELSIF TG_OP = 'DELETE' THEN
+                SELECT array_agg(pid), array_agg(tagname), array_agg(-1)
+                INTO changed_pids, changed_tags, changed_counts FROM old_tags;
+            ELSE
+                SELECT array_agg(pid), array_agg(tagname), array_agg(n)
+                INTO changed_pids, changed_tags, changed_counts
+                FROM (
+                    SELECT pid, tagname, 1 AS n FROM new_tags UNION ALL SELECT pid, tagname, -1 FROM old_tags
+                ) AS changes;
+            END IF;
+            -- Statements that change no tags, like the cascade from a paper
+            -- whose tags are already deleted, change no counts.
+            IF changed_pids IS NULL THEN
+                RETURN NULL;
+            END IF;
+            PERFORM FROM user_stats
+            WHERE username IN (SELECT username FROM papers WHERE pid = ANY(changed_pids))
+            ORDER BY username FOR UPDATE;
+            WITH delta AS (
+                SELECT username, tagname, SUM(changes.n) AS n
+                FROM unnest(changed_pids, changed_tags, changed_counts) AS changes(pid, tagname, n)
+                JOIN papers USING (pid)
+                GROUP BY username, tagname HAVING SUM(changes.n) <> 0
+            ),
+            counts AS (
+                SELECT username, tagname, COALESCE(c.paper_count, 0) AS before,
+                    COALESCE(c.paper_count, 0) + delta.n AS after
+                FROM delta LEFT JOIN user_tag_counts AS c USING (username, tagname)
+            ),
+            upserted AS (
+                INSERT INTO user_tag_counts (username, tagname, paper_count)
+                SELECT username, tagname, after FROM counts WHERE after > 0
+                ON CONFLICT (username, tagname) DO UPDATE SET paper_count = EXCLUDED.paper_count
+            ),
+            deleted AS (
+                DELETE FROM user_tag_counts AS c USING counts
+                WHERE c.username = counts.username AND c.tagname = counts.tagname AND counts.after <= 0
+            )
+            UPDATE user_stats SET tag_count = tag_count + delta.n
+            FROM (
+                SELECT username, SUM((after > 0)::int - (before > 0)::int) AS n FROM counts GROUP BY username
+            ) AS delta
+            WHERE user_stats.username = delta.username AND delta.n <> 0;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql SET plan_cache_mode = force_generic_plan
+        """,
+        """
+        CREATE TRIGGER tags_user_counts_insert AFTER INSERT ON tags
+            REFERENCING NEW TABLE AS new_tags
+            FOR EACH STATEMENT EXECUTE FUNCTION update_user_tag_counts()
+        """,
+        """
+        CREATE TRIGGER tags_user_counts_delete AFTER DELETE ON tags
+            REFERENCING OLD TABLE AS old_tags
+            FOR EACH STATEMENT EXECUTE FUNCTION update_user_tag_counts()
+        """,
+        """
+        CREATE TRIGGER tags_user_counts_update AFTER UPDATE ON tags
+            REFERENCING OLD TABLE AS old_tags NEW TABLE AS new_tags
+            FOR EACH STATEMENT EXECUTE FUNCTION update_user_tag_counts()
+        """,
+        # The tags of a paper are deleted while the paper still exists, so that
+        # the trigger above can find whose tags they were. The foreign key of
+        # tags would delete them only after the paper.
+        """
+        CREATE OR REPLACE FUNCTION delete_paper_tags() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM tags WHERE pid = OLD.pid;
+            RETURN OLD;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER papers_delete_tags BEFORE DELETE ON papers
+            FOR EACH ROW EXECUTE FUNCTION delete_paper_tags()
+        """,
+        # Text extraction of uploaded PDFs that runs after the paper is added
+        f"""
+        CREATE TABLE IF NOT EXISTS extractions(
+            pid INT NOT NULL,
+            status VARCHAR(10) NOT NULL,
+            attempts INT NOT NULL DEFAULT 0,
+            error TEXT,
+            update_time TIMESTAMP NOT NULL,
+            PRIMARY KEY(pid){paper_reference}
+        );
+        """,
+        """
+        CREATE INDEX extractions_status_idx ON extractions (status) WHERE status <> 'done'
+        """,
+    )
+    # Trigram indexes serve substring searches on title and description. They
+    # are skipped if the pg_trgm extension isn't installed on the server.
+    optional_commands = (
+        """
+        CREATE EXTENSION IF NOT EXISTS pg_trgm
+        """,
+        """
+        CREATE INDEX papers_title_trgm_idx ON papers USING gin(title gin_trgm_ops)
+        """,
+        """
+        CREATE INDEX papers_description_trgm_idx ON papers USING gin(description gin_trgm_ops)
+        """,
+    )
+    # What the foreign keys to papers do in the plain tables. There are no
+    # default partitions, which would keep the planner from scanning the
+    # monthly partitions in order for the timelines. A row of a month without
+    # a partition is rejected, so the partitions of the coming months are
+    # created ahead, see partitions.py.
+    partition_commands = (
+        # The primary key of likes includes like_time, so the uniqueness of
+        # (pid, username) is checked here under a lock on the pair. The liked
+        # paper is locked like a foreign key would, so that it can't be
+        # deleted before the like commits.
+        """
+        CREATE OR REPLACE FUNCTION check_like() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock(hashtext(NEW.username), NEW.pid);
+            IF EXISTS (SELECT FROM likes WHERE pid = NEW.pid AND username = NEW.username) THEN
+                RAISE unique_violation USING MESSAGE = format('%s already likes paper %s', NEW.username, NEW.pid);
+            END IF;
+            PERFORM FROM papers WHERE pid = NEW.pid FOR KEY SHARE;
+            IF NOT FOUND THEN
+                RAISE foreign_key_violation USING MESSAGE = format('paper %s does not exist', NEW.pid);
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER likes_check BEFORE INSERT ON likes
+            FOR EACH ROW EXECUTE FUNCTION check_like()
+        """,
+        """
+        CREATE OR REPLACE FUNCTION check_paper_exists() RETURNS trigger AS $$
+        BEGIN
+            PERFORM FROM papers WHERE pid = NEW.pid FOR KEY SHARE;
+            IF NOT FOUND THEN
+                RAISE foreign_key_violation USING MESSAGE = format('paper %s does not exist', NEW.pid);
+            END IF;
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER extractions_check BEFORE INSERT ON extractions
+            FOR EACH ROW EXECUTE FUNCTION check_paper_exists()
+        """,
+        """
+        CREATE TRIGGER tags_check BEFORE INSERT ON tags
+            FOR EACH ROW EXECUTE FUNCTION check_paper_exists()
+        """,
+        # Tags are already deleted by papers_delete_tags.
+        """
+        CREATE OR REPLACE FUNCTION delete_paper_references() RETURNS trigger AS $$
+        BEGIN
+            DELETE FROM likes WHERE pid = OLD.pid;
+            DELETE FROM extractions WHERE pid = OLD.pid;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql
+        """,
+        """
+        CREATE TRIGGER papers_delete_references AFTER DELETE ON papers
+            FOR EACH ROW EXECUTE FUNCTION delete_paper_references()
+        """,
     )
     cur = conn.cursor()
     for command in commands:
         cur.execute(command)
+    if partitioned:
+        for command in partition_commands:
+            cur.execute(command)
+        this_month = _month_start(datetime.now())
+        _create_month_partitions(cur, this_month, _add_months(this_month, PARTITION_PREMAKE_MONTHS))
+    try:
+        cur.execute('SAVEPOINT optional_commands')
+        for command in optional_commands:
+            cur.execute(command)
+    except psycopg.Error:
+        cur.execute('ROLLBACK TO SAVEPOINT optional_commands')
     conn.commit()
     return 0, None
 
+
+def _month_start(time: datetime) -> datetime:
+    return datetime(time.year, time.month, 1)
+
+
+def _add_months(month: datetime, n: int) -> datetime:
+    year, month_index = divmod(month.year * 12 + month.month - 1 + n, 12)
+    return datetime(year, month_index + 1, 1)
+
+
+# A monthly partition of papers or likes is named after its month, e.g.
+# papers_p202401.
+def _partition_name(table: str, month: datetime) -> str:
+    return '%s_p%04d%02d' % (table, month.year, month.month)
+
+
+def _create_month_partitions(cursor: psycopg.Cursor, first: datetime, last: datetime) -> list[str]:
+    """
+    Create the monthly partitions of papers and likes from the month $first
+    up to and including the month $last that don't exist yet.
+
+    :return: The names of the partitions created
+    """
+    created = []
+    month = first
+    while month <= last:
+        end = _add_months(month, 1)
+        for table in ('papers', 'likes'):
+            name = _partition_name(table, month)
+            cursor.execute('SELECT to_regclass(%s) IS NULL', (name,))
+            if cursor.fetchone()[0]:
+                cursor.execute(
+                    sql.SQL('CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})').format(
+                        sql.Identifier(name), sql.Identifier(table), sql.Literal(month), sql.Literal(end))
+                )
+                created.append(name)
+        month = end
+    return created
+
+
+def _month_partitions(cursor: psycopg.Cursor, table: str) -> dict[datetime, str]:
+    """
+    Map the month of every monthly partition of $table to its name
+    """
+    cursor.execute(
+        "SELECT c.relname FROM pg_inherits JOIN pg_class AS c ON c.oid = inhrelid "
+        "WHERE inhparent = %s::regclass", (table,)
+    )
+    partitions = {}
+    for name, in cursor.fetchall():
+        suffix = name[len(table) + len('_p'):]
+        if name.startswith(table + '_p') and len(suffix) == 6 and suffix.isdigit():
+            partitions[datetime(int(suffix[:4]), int(suffix[4:]), 1)] = name
+    return partitions
+
+
+def maintain_partitions(conn: Connection, premake: int = PARTITION_PREMAKE_MONTHS,
+                        retain: Optional[int] = PARTITION_RETAIN_MONTHS, since: Optional[datetime] = None,
+                        now: Optional[datetime] = None) -> tuple[int, Optional[tuple[list[str], list[str]]]]:
+    """
+    Create the monthly partitions of papers and likes for the next $premake
+    months, and archive the partitions of the months before the last $retain.
+    Nothing is done if the tables aren't partitioned. Run periodically by
+    every server process, see partitions.py, and by the maintain_partitions
+    command; concurrent runs wait for each other.
+
+    An archived partition is detached from its table and moved to the archive
+    schema instead of having its rows deleted. Rows that refer to archived
+    papers, i.e. their tags, their extractions and their likes in partitions
+    that are kept, are moved to the archive schema too, as tags_pYYYYMM,
+    extractions_pYYYYMM and paper_likes_pYYYYMM after the month of the
+    papers, and the counters of user_stats drop the archived rows.
+
+    :param conn: A postgres database connection object
+    :param premake: Number of months after the current one to create partitions for
+    :param retain: Number of months before the current one to keep, or None to keep every month
+    :param since: A datetime.datetime object. Also create the partitions of the months from $since on, e.g. to
+        import older papers.
+    :param now: A datetime.datetime object of the current time
+    :return: (status, retval)
+        (0, (created, archived))    Success, where created and archived are the names of the partitions created
+                                    and archived
+        (1, None)                   Failure
+    """
+    return_status = 1
+    result = None
+    this_month = _month_start(now or datetime.now())
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('maintain_partitions'))")
+        cursor.execute("SELECT EXISTS (SELECT FROM pg_partitioned_table WHERE partrelid = to_regclass('papers'))")
+        if not cursor.fetchone()[0]:
+            conn.commit()
+            return 0, ([], [])
+        first = _month_start(since) if since is not None else this_month
+        created = _create_month_partitions(cursor, min(first, this_month), _add_months(this_month, premake))
+        archived = []
+        if retain is not None:
+            cutoff = _add_months(this_month, -retain)
+            papers = [name for month, name in sorted(_month_partitions(cursor, 'papers').items()) if month < cutoff]
+            likes = [name for month, name in sorted(_month_partitions(cursor, 'likes').items()) if month < cutoff]
+            if papers or likes:
+                _archive_partitions(cursor, papers, likes)
+                archived = papers + likes
+        conn.commit()
+        result = created, archived
+        return_status = 0
+    except Exception:
+        conn.rollback()
+    return return_status, result
+
+
+def _union(query: str, names: list[str]) -> sql.Composed:
+    """
+    The UNION ALL of $query over the tables $names, where {} in $query is the table
+    """
+    return sql.SQL(' UNION ALL ').join(sql.SQL(query).format(sql.Identifier(name)) for name in names)
+
+
+def _archive_partitions(cursor: psycopg.Cursor, papers: list[str], likes: list[str]) -> None:
+    """
+    Detach the partitions $papers of papers and $likes of likes and move them
+    to the archive schema, together with the rows that refer to them, and
+    subtract them from user_stats
+    """
+    # Likes of archived papers wait until they are archived, and then fail.
+    cursor.execute(sql.SQL('LOCK TABLE {} IN EXCLUSIVE MODE').format(
+        sql.SQL(', ').join(sql.Identifier(name) for name in papers + likes)))
+    cursor.execute('CREATE SCHEMA IF NOT EXISTS archive')
+    cursor.execute('CREATE TEMPORARY TABLE archived_pids (pid INT PRIMARY KEY) ON COMMIT DROP')
+    if papers:
+        cursor.execute(sql.SQL('INSERT INTO archived_pids {}').format(_union('SELECT pid FROM {}', papers)))
+    cursor.execute('ANALYZE archived_pids')
+    # Copies of the rows of each month's papers that are deleted below
+    for name in papers:
+        suffix = name[len('papers'):]
+        for table, query in (
+                ('tags', 'SELECT * FROM tags WHERE pid IN (SELECT pid FROM {papers})'),
+                ('extractions', 'SELECT * FROM extractions WHERE pid IN (SELECT pid FROM {papers})'),
+                ('paper_likes', 'SELECT * FROM likes WHERE pid IN (SELECT pid FROM {papers}) '
+                                'AND tableoid <> ALL({likes}::regclass[])')):
+            cursor.execute(sql.SQL('CREATE TABLE archive.{archive} AS ' + query).format(
+                archive=sql.Identifier(table + suffix), papers=sql.Identifier(name), likes=sql.Literal(likes)))
+    # Deleted through the triggers, which keep the counters up to date
+    cursor.execute('DELETE FROM tags WHERE pid IN (SELECT pid FROM archived_pids)')
+    cursor.execute('DELETE FROM extractions WHERE pid IN (SELECT pid FROM archived_pids)')
+    if likes:
+        # Likes older than their papers, which only import_papers can add.
+        # They go back into their partitions once those are detached.
+        cursor.execute('CREATE TEMPORARY TABLE early_likes (partition TEXT, LIKE likes) ON COMMIT DROP')
+        cursor.execute(sql.SQL(
+            'WITH deleted AS (DELETE FROM likes WHERE (pid, username, like_time) IN ({}) '
+            'RETURNING tableoid::regclass::text, pid, username, like_time) '
+            'INSERT INTO early_likes SELECT * FROM deleted'
+        ).format(_union(
+            'SELECT pid, username, like_time FROM {} WHERE pid NOT IN (SELECT pid FROM archived_pids)', likes)))
+    # The like counts of archived papers need no update, and updating them
+    # would look each paper up in every partition. Detaching below locks
+    # likes exclusively anyway.
+    cursor.execute('ALTER TABLE likes DISABLE TRIGGER likes_like_count')
+    cursor.execute('DELETE FROM likes WHERE pid IN (SELECT pid FROM archived_pids) AND tableoid <> ALL(%s::regclass[])',
+                   (likes,))
+    cursor.execute('ALTER TABLE likes ENABLE TRIGGER likes_like_count')
+    for column, names in (('paper_count', papers), ('liked_count', likes)):
+        if names:
+            cursor.execute(sql.SQL(
+                'UPDATE user_stats SET {column} = {column} - delta.n FROM ('
+                'SELECT username, COUNT(*) AS n FROM ({rows}) AS archived GROUP BY username'
+                ') AS delta WHERE user_stats.username = delta.username'
+            ).format(column=sql.Identifier(column), rows=_union('SELECT username FROM {}', names)))
+    for table, names in (('papers', papers), ('likes', likes)):
+        for name in names:
+            cursor.execute(sql.SQL('ALTER TABLE {} DETACH PARTITION {}').format(
+                sql.Identifier(table), sql.Identifier(name)))
+            cursor.execute(sql.SQL('ALTER TABLE {} SET SCHEMA archive').format(sql.Identifier(name)))
+    for name in likes:
+        cursor.execute(sql.SQL(
+            'INSERT INTO archive.{} (pid, username, like_time) '
+            'SELECT pid, username, like_time FROM early_likes WHERE partition = %s'
+        ).format(sql.Identifier(name)), (name,))
+    # Archived rows stand on their own: they keep neither users from being
+    # deleted or truncated nor the sequence of pids from being dropped.
+    cursor.execute(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE contype = 'f' AND conrelid = ANY(%s::regclass[])",
+        (['archive.' + name for name in papers + likes],)
+    )
+    for table, constraint in cursor.fetchall():
+        cursor.execute(sql.SQL('ALTER TABLE {} DROP CONSTRAINT {}').format(
+            sql.SQL(table), sql.Identifier(constraint)))
+    for name in papers:
+        cursor.execute(sql.SQL('ALTER TABLE archive.{} ALTER COLUMN pid DROP DEFAULT').format(sql.Identifier(name)))
+
+
+def check_like_counts(conn: Connection, repair=False) -> tuple[int, Optional[int]]:
+    """
+    Compare the like_count column of every paper with the number of rows in the likes table.
+
+    The counters are maintained by a trigger on likes, but they can drift when likes are loaded with the trigger
+    disabled or by TRUNCATE.
+
+    :param conn: A postgres database connection object
+    :param repair: Whether to overwrite wrong counters with the actual counts
+    :return: (status, retval)
+        (0, count)  Success, retval is the number of papers whose counter was wrong
+        (1, None)   Failure
+    """
+    return_status = 1
+    try:
+        cursor = conn.cursor()
+        if repair:
+            # Keep new likes out until the counters are consistent again.
+            cursor.execute('LOCK TABLE likes IN SHARE MODE')
+            cursor.execute(
+                'UPDATE papers SET like_count = COALESCE(actual.like_count, 0) '
+                'FROM papers AS p LEFT JOIN (SELECT pid, COUNT(*) AS like_count FROM likes GROUP BY pid) '
+                'AS actual USING (pid) '
+                'WHERE papers.pid = p.pid AND papers.like_count <> COALESCE(actual.like_count, 0)'
+            )
+            count = cursor.rowcount
+        else:
+            cursor.execute(
+                'SELECT COUNT(*) FROM papers LEFT JOIN '
+                '(SELECT pid, COUNT(*) AS actual_count FROM likes GROUP BY pid) AS actual USING (pid) '
+                'WHERE like_count <> COALESCE(actual_count, 0)'
+            )
+            count = cursor.fetchone()[0]
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        count = None
+    return return_status, count
+
+
+def check_tag_pair_counts(conn: Connection, repair=False) -> tuple[int, Optional[int]]:
+    """
+    Compare the tag_pair_counts table with the pairs of tags used together in the tags table.
+
+    The table is maintained by triggers on tags, but it drifts when tags are removed by TRUNCATE.
+
+    :param conn: A postgres database connection object
+    :param repair: Whether to rebuild the table from the tags table if any pair is wrong
+    :return: (status, retval)
+        (0, count)  Success, retval is the number of pairs that are missing, stale or have a wrong count
+        (1, None)   Failure
+    """
+    return_status = 1
+    try:
+        cursor = conn.cursor()
+        if repair:
+            # Keep tags from changing until the table is consistent again.
+            cursor.execute('LOCK TABLE tags IN SHARE MODE')
+        cursor.execute(
+            'SELECT COUNT(*) FROM tag_pair_counts FULL JOIN ('
+            '  SELECT tags.tagname AS tag1, t.tagname AS tag2, COUNT(*) AS actual_count '
+            '  FROM tags JOIN tags AS t ON tags.pid = t.pid AND tags.tagname < t.tagname '
+            '  GROUP BY tags.tagname, t.tagname'
+            ') AS actual USING (tag1, tag2) '
+            'WHERE pair_count IS DISTINCT FROM actual_count'
+        )
+        count = cursor.fetchone()[0]
+        if repair and count:
+            cursor.execute('DELETE FROM tag_pair_counts')
+            cursor.execute(
+                'INSERT INTO tag_pair_counts (tag1, tag2, pair_count) '
+                'SELECT tags.tagname, t.tagname, COUNT(*) '
+                'FROM tags JOIN tags AS t ON tags.pid = t.pid AND tags.tagname < t.tagname '
+                'GROUP BY tags.tagname, t.tagname'
+            )
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        count = None
+    return return_status, count
+
+
+# The tag counts and the stats every user should have
+_ACTUAL_USER_STATS = (
+    'WITH actual_tags AS ('
+    '  SELECT username, tagname, COUNT(*) AS paper_count FROM tags JOIN papers USING (pid) '
+    '  GROUP BY username, tagname'
+    '), '
+    'actual_stats AS ('
+    '  SELECT username, COALESCE(p.n, 0) AS paper_count, COALESCE(l.n, 0) AS liked_count, '
+    '  COALESCE(t.n, 0) AS tag_count FROM users '
+    '  LEFT JOIN (SELECT username, COUNT(*) AS n FROM papers GROUP BY username) AS p USING (username) '
+    '  LEFT JOIN (SELECT username, COUNT(*) AS n FROM likes GROUP BY username) AS l USING (username) '
+    '  LEFT JOIN (SELECT username, COUNT(*) AS n FROM actual_tags GROUP BY username) AS t USING (username)'
+    ') '
+)
+
+
+def check_user_stats(conn: Connection, repair=False) -> tuple[int, Optional[int]]:
+    """
+    Compare the user_stats and user_tag_counts tables with the papers, likes and tags of every user.
+
+    The tables are maintained by triggers on users, papers, likes and tags, but they drift when rows are removed by
+    TRUNCATE or a paper changes hands.
+
+    :param conn: A postgres database connection object
+    :param repair: Whether to rebuild both tables if any user is wrong
+    :return: (status, retval)
+        (0, count)  Success, retval is the number of users whose stats or tag counts are missing or wrong
+        (1, None)   Failure
+    """
+    return_status = 1
+    try:
+        cursor = conn.cursor()
+        if repair:
+            # Keep the tables counted from changing until the stats are consistent again.
+            cursor.execute('LOCK TABLE users, papers, likes, tags IN SHARE MODE')
+        cursor.execute(
+            _ACTUAL_USER_STATS +
+            'SELECT COUNT(*) FROM ('
+            '  SELECT username FROM user_stats FULL JOIN actual_stats AS a USING (username) '
+            '  WHERE (user_stats.paper_count, user_stats.liked_count, user_stats.tag_count) '
+            '  IS DISTINCT FROM (a.paper_count, a.liked_count, a.tag_count) '
+            '  UNION '
+            '  SELECT username FROM user_tag_counts FULL JOIN actual_tags AS a USING (username, tagname) '
+            '  WHERE user_tag_counts.paper_count IS DISTINCT FROM a.paper_count'
+            ') AS wrong'
+        )
+        count = cursor.fetchone()[0]
+        if repair and count:
+            cursor.execute('DELETE FROM user_tag_counts')
+            cursor.execute('DELETE FROM user_stats')
+            cursor.execute(
+                _ACTUAL_USER_STATS +
+                ', inserted_tags AS ('
+                '  INSERT INTO user_tag_counts (username, tagname, paper_count) '
+                '  SELECT username, tagname, paper_count FROM actual_tags'
+                ') '
+                'INSERT INTO user_stats (username, paper_count, liked_count, tag_count) '
+                'SELECT username, paper_count, liked_count, tag_count FROM actual_stats'
+            )
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        count = None
+    return return_status, count
+
 # Basic APIs
 
 
@@ -174,6 +1108,9 @@ def signup(conn: Connection, uname: str, pwd: str):
     return return_status, None
 
 
+_LOGIN = _prepared('login', 'SELECT password = %s FROM users WHERE username = %s')
+
+
 def login(conn: Connection, uname: str, pwd: str):
     """
     Login if user and password match.
@@ -190,7 +1127,7 @@ def login(conn: Connection, uname: str, pwd: str):
     return_status = 3
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT password = %s FROM users WHERE username = %s', (pwd, uname))
+        _execute_prepared(cursor, _LOGIN, (pwd, uname))
         res = cursor.fetchall()
         if len(res) == 0:
             return_status = 1
@@ -206,6 +1143,26 @@ def login(conn: Connection, uname: str, pwd: str):
 # Event related
 
 
+# The tags of the new paper refer to tag names inserted by the same statement,
+# which the foreign key checks at the end of the statement see. A paper
+# without text is queued for extraction by the same statement too, so that it
+# can't be left without either.
+_ADD_NEW_PAPER = _prepared(
+    'add_new_paper',
+    'WITH paper AS ('
+    'INSERT INTO papers (username, title, begin_time, description, data) '
+    'VALUES (%s, %s, %s, %s, %s) RETURNING pid, begin_time, data IS NULL AS without_text), '
+    'new_tags AS (SELECT unnest(%s::varchar[]) AS tagname), '
+    'new_tagnames AS ('
+    'INSERT INTO tagnames (tagname) SELECT tagname FROM new_tags ON CONFLICT DO NOTHING), '
+    'new_paper_tags AS (INSERT INTO tags (pid, tagname) SELECT pid, tagname FROM paper, new_tags), '
+    'new_extraction AS ('
+    "INSERT INTO extractions (pid, status, attempts, update_time) "
+    "SELECT pid, 'pending', 0, begin_time FROM paper WHERE without_text) "
+    'SELECT pid FROM paper'
+)
+
+
 def add_new_paper(conn: Connection, uname: str, title: str, desc: Optional[str],
                   text: Optional[str], tags: Sequence[str]) -> tuple[int, Optional[int]]:
     """
@@ -218,7 +1175,8 @@ def add_new_paper(conn: Connection, uname: str, title: str, desc: Optional[str],
     :param uname: A string of username
     :param title: A string of the title of the paper
     :param desc: A string of the description of the paper
-    :param text: A string of the text content of the uploaded pdf file
+    :param text: A string of the text content of the uploaded pdf file, or None to queue the paper for text
+        extraction, see get_extraction_status()
     :param tags: A list of string, each element is a tag associate to the paper
     :return: (status, retval)
         (0, pid)    Success
@@ -226,37 +1184,285 @@ def add_new_paper(conn: Connection, uname: str, title: str, desc: Optional[str],
         (1, None)   Failure
     """
     return_status = 1
+    # Tags are deduplicated here, as a tag given twice would violate the
+    # primary key of tags.
+    tags = list(dict.fromkeys(tags))
+    try:
+        # One statement inserts the paper and all its tag names and tags. It is
+        # atomic by itself, so it runs in autocommit mode and the upload takes
+        # a single round trip, without a separate COMMIT.
+        with _autocommit(conn):
+            cursor = conn.cursor(row_factory=_scalar_row)
+            _execute_prepared(cursor, _ADD_NEW_PAPER, (uname, title, datetime.now(), desc, text, tags))
+            paper_id = cursor.fetchone()
+        return_status = 0
+    except Exception:
+        paper_id = None
+    return return_status, paper_id
+
+
+def import_papers(conn: Connection, papers: Sequence[dict[str, Any]], create_users=False)\
+        -> tuple[int, Optional[tuple[int, int, int, int]]]:
+    """
+    Add many papers with their tags and likes at once.
+
+    The papers are loaded into staging tables with COPY and merged into the real tables with one INSERT ... SELECT
+    per table, in a single transaction. Papers by users that don't exist are skipped, as are likes by users that
+    don't exist and likes of one's own paper.
+
+    :param conn: A postgres database connection object
+    :param papers: A list of dicts, each with the keys
+        username    -- A string of the username of the author
+        title, description, data    -- Strings or None
+        begin_time  -- A datetime.datetime object, or None for the current time
+        tags        -- A list of strings
+        likes       -- A list of (username, like_time) pairs, like_time may be None for the current time
+        The values are expected to fit the schema, e.g. titles are at most 50 characters long.
+    :param create_users: Whether to create users that don't exist instead of skipping their papers and likes.
+        Created users get a random password.
+    :return: (status, retval)
+        (0, (paper_count, tag_count, like_count, skipped_count))
+            Success, retval holds the number of papers, tags and likes added and the number of papers skipped
+        (1, None)
+            Failure
+    """
+    return_status = 1
+    counts = None
     try:
+        now = datetime.now()
         cursor = conn.cursor()
+        # Temporary tables live as long as the (pooled) connection and are
+        # emptied at the end of every transaction.
+        cursor.execute(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS staging_papers('
+            'seq INT NOT NULL, pid INT, username VARCHAR(50) NOT NULL, title VARCHAR(50), '
+            'begin_time TIMESTAMP NOT NULL, description VARCHAR(500), data TEXT) ON COMMIT DELETE ROWS'
+        )
         cursor.execute(
-            'INSERT INTO papers (username, title, begin_time, description, data) '
-            'VALUES (%s, %s, %s, %s, %s) RETURNING pid',
-            (uname, title, datetime.now(), desc, text)
+            'CREATE TEMPORARY TABLE IF NOT EXISTS staging_tags('
+            'seq INT NOT NULL, tagname VARCHAR(50) NOT NULL) ON COMMIT DELETE ROWS'
         )
-        paper_id = cursor.fetchone()[0]
-        if len(tags):
-            cursor.executemany(
-                'INSERT INTO tagnames (tagname) VALUES (%s) ON CONFLICT DO NOTHING',
-                ((tag,) for tag in tags)
+        cursor.execute(
+            'CREATE TEMPORARY TABLE IF NOT EXISTS staging_likes('
+            'seq INT NOT NULL, username VARCHAR(50) NOT NULL, like_time TIMESTAMP NOT NULL) ON COMMIT DELETE ROWS'
+        )
+        _copy_rows(cursor, 'staging_papers', ('seq', 'username', 'title', 'begin_time', 'description', 'data'), (
+            (seq, paper['username'], paper.get('title'), paper.get('begin_time') or now,
+             paper.get('description'), paper.get('data'))
+            for seq, paper in enumerate(papers)
+        ))
+        _copy_rows(cursor, 'staging_tags', ('seq', 'tagname'), (
+            (seq, tag) for seq, paper in enumerate(papers) for tag in paper.get('tags', ())
+        ))
+        _copy_rows(cursor, 'staging_likes', ('seq', 'username', 'like_time'), (
+            (seq, username, like_time or now)
+            for seq, paper in enumerate(papers) for username, like_time in paper.get('likes', ())
+        ))
+
+        if create_users:
+            cursor.execute(
+                'INSERT INTO users (username, password) '
+                'SELECT username, md5(random()::text) FROM '
+                '(SELECT username FROM staging_papers UNION SELECT username FROM staging_likes) AS u '
+                'ON CONFLICT (username) DO NOTHING'
             )
-            cursor.executemany(
-                'INSERT INTO tags (pid, tagname) VALUES (%s, %s)',
-                ((paper_id, tag) for tag in tags)
+        # Draw pids up front in file order, so that tags and likes can be
+        # matched to their papers by seq.
+        cursor.execute(
+            "UPDATE staging_papers AS s SET pid = n.pid FROM ("
+            "  SELECT seq, nextval(pg_get_serial_sequence('papers', 'pid')) AS pid FROM ("
+            "    SELECT seq FROM staging_papers WHERE username IN (SELECT username FROM users) ORDER BY seq"
+            "  ) AS o"
+            ") AS n WHERE s.seq = n.seq"
+        )
+        cursor.execute(
+            'INSERT INTO papers (pid, username, title, begin_time, description, data) '
+            'SELECT pid, username, title, begin_time, description, data FROM staging_papers '
+            'WHERE pid IS NOT NULL ORDER BY seq'
+        )
+        paper_count = cursor.rowcount
+        cursor.execute(
+            'INSERT INTO tagnames (tagname) SELECT DISTINCT tagname FROM staging_tags '
+            'JOIN staging_papers USING (seq) WHERE pid IS NOT NULL ON CONFLICT DO NOTHING'
+        )
+        cursor.execute(
+            'INSERT INTO tags (pid, tagname) SELECT DISTINCT pid, tagname FROM staging_tags '
+            'JOIN staging_papers USING (seq) WHERE pid IS NOT NULL'
+        )
+        tag_count = cursor.rowcount
+        cursor.execute(
+            'INSERT INTO likes (pid, username, like_time) '
+            'SELECT DISTINCT ON (pid, l.username) pid, l.username, l.like_time '
+            'FROM staging_likes AS l JOIN staging_papers AS p USING (seq) '
+            'WHERE pid IS NOT NULL AND l.username <> p.username '
+            'AND l.username IN (SELECT username FROM users) '
+            'ORDER BY pid, l.username, l.like_time'
+        )
+        like_count = cursor.rowcount
+        conn.commit()
+        counts = (paper_count, tag_count, like_count, len(papers) - paper_count)
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        counts = None
+    return return_status, counts
+
+
+def delete_paper(conn: Connection, pid: int) -> tuple[int, None]:
+    """
+    Delete a paper by the given pid.
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, None)   Success
+        (1, None)   Failure
+    """
+    return_status = 1
+    try:
+        cursor = conn.cursor()
+        cursor.execute('DELETE FROM papers WHERE pid = %s', (pid,))
+        conn.commit()
+        return_status = int(cursor.rowcount != 1)
+    except Exception:
+        conn.rollback()
+    return return_status, None
+
+
+_PAPER_TAGS = _prepared('paper_tags', 'SELECT tagname FROM tags WHERE pid = %s ORDER BY tagname')
+_PAPER_EXISTS = _prepared('paper_exists', 'SELECT COUNT(*) FROM papers WHERE pid = %s')
+
+
+def get_paper_tags(conn: Connection, pid: int) -> tuple[int, Optional[list[str]]]:
+    """
+    Get all tags of a paper
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, [tag1, tag2, ...])      Success
+                                    Return a list of string. Each string is a tag of the paper.
+                                    Note that the list should be sorted in a lexical ascending order.
+                                    Example:
+                                            (0, ["database", "multi-versioned"])
+
+        (1, None)                   Failure
+    """
+    try:
+        return_status = 0
+        cursor = conn.cursor(row_factory=_scalar_row)
+        _execute_prepared(cursor, _PAPER_TAGS, (pid,))
+        tags = cursor.fetchall()
+        if not tags:
+            # Check if the paper exists.
+            _execute_prepared(cursor, _PAPER_EXISTS, (pid,))
+            if cursor.fetchone() == 0:
+                return_status = 1
+                tags = None
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        return_status = 1
+        tags = None
+    return return_status, tags
+
+
+def get_paper_author_and_tags(conn: Connection, pid: int) -> tuple[int, Optional[tuple[str, list[str]]]]:
+    """
+    Get the author and the tags of a paper, e.g. to know which cached pages a change of the paper affects.
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, (username, [tag1, tag2, ...]))
+            Success, the tags are sorted in lexical ascending order
+        (1, None)
+            Failure, or the paper doesn't exist
+    """
+    return_status = 1
+    paper = None
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'SELECT username, array_remove(array_agg(tagname ORDER BY tagname), NULL) '
+            'FROM papers LEFT JOIN tags USING (pid) WHERE pid = %s GROUP BY pid, username',
+            (pid,)
+        )
+        row = cursor.fetchone()
+        conn.commit()
+        if row is not None:
+            paper = (row[0], list(row[1]))
+            return_status = 0
+    except Exception:
+        conn.rollback()
+    return return_status, paper
+
+
+def queue_extraction(conn: Connection, pid: int) -> tuple[int, None]:
+    """
+    Mark the text of a paper as waiting to be extracted from its PDF file.
+
+    Extraction starts over if the paper was queued before.
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :return: (status, retval)
+        (0, None)   Success
+        (1, None)   Failure
+    """
+    return_status = 1
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO extractions (pid, status, attempts, update_time) VALUES (%s, 'pending', 0, %s) "
+            "ON CONFLICT (pid) DO UPDATE SET status = 'pending', attempts = 0, error = NULL, "
+            "update_time = EXCLUDED.update_time",
+            (pid, datetime.now())
+        )
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+    return return_status, None
+
+
+def save_extracted_text(conn: Connection, pid: int, text: str) -> tuple[int, None]:
+    """
+    Store the text extracted from the PDF file of a paper and mark its extraction as done.
+
+    :param conn: A postgres database connection object
+    :param pid: An int of pid
+    :param text: A string of the text content of the pdf file
+    :return: (status, retval)
+        (0, None)   Success
+        (1, None)   Failure -- e.g. the paper has been deleted in the meantime
+    """
+    return_status = 1
+    try:
+        cursor = conn.cursor()
+        cursor.execute('UPDATE papers SET data = %s WHERE pid = %s', (text, pid))
+        if cursor.rowcount == 1:
+            cursor.execute(
+                "UPDATE extractions SET status = 'done', attempts = attempts + 1, error = NULL, "
+                "update_time = %s WHERE pid = %s",
+                (datetime.now(), pid)
             )
+            return_status = 0
         conn.commit()
-        return_status = 0
     except Exception:
         conn.rollback()
-        paper_id = None
-    return return_status, paper_id
+        return_status = 1
+    return return_status, None
 
 
-def delete_paper(conn: Connection, pid: int) -> tuple[int, None]:
+def record_extraction_failure(conn: Connection, pid: int, error: str, final: bool) -> tuple[int, None]:
     """
-    Delete a paper by the given pid.
+    Record a failed attempt to extract the text of a paper.
 
     :param conn: A postgres database connection object
     :param pid: An int of pid
+    :param error: A string describing the error
+    :param final: Whether there will be no more attempts. The extraction stays pending otherwise.
     :return: (status, retval)
         (0, None)   Success
         (1, None)   Failure
@@ -264,7 +1470,11 @@ def delete_paper(conn: Connection, pid: int) -> tuple[int, None]:
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute('DELETE FROM papers WHERE pid = %s', (pid,))
+        cursor.execute(
+            'UPDATE extractions SET status = %s, attempts = attempts + 1, error = %s, update_time = %s '
+            'WHERE pid = %s',
+            ('failed' if final else 'pending', error, datetime.now(), pid)
+        )
         conn.commit()
         return_status = int(cursor.rowcount != 1)
     except Exception:
@@ -272,47 +1482,76 @@ def delete_paper(conn: Connection, pid: int) -> tuple[int, None]:
     return return_status, None
 
 
-def get_paper_tags(conn: Connection, pid: int) -> tuple[int, Optional[list[str]]]:
+def get_extraction_status(conn: Connection, pid: int) -> tuple[int, Optional[tuple[str, int, Optional[str]]]]:
     """
-    Get all tags of a paper
+    Get the state of the text extraction of a paper.
 
     :param conn: A postgres database connection object
     :param pid: An int of pid
     :return: (status, retval)
-        (0, [tag1, tag2, ...])      Success
-                                    Return a list of string. Each string is a tag of the paper.
-                                    Note that the list should be sorted in a lexical ascending order.
-                                    Example:
-                                            (0, ["database", "multi-versioned"])
-
-        (1, None)                   Failure
+        (0, (state, attempts, error))
+            Success, state is one of "pending", "done" and "failed". attempts is the number of finished attempts
+            and error describes the last failed attempt, if any. Papers whose text was given when they were added
+            are "done" with 0 attempts. Papers without text that were never queued, e.g. imported ones, are
+            "failed" with 0 attempts.
+        (1, None)
+            Failure -- e.g. the paper doesn't exist
     """
+    return_status = 1
+    extraction = None
     try:
-        return_status = 0
         cursor = conn.cursor()
         cursor.execute(
-            'SELECT tagname FROM tags WHERE pid = %s ORDER BY tagname',
+            "SELECT COALESCE(status, CASE WHEN data IS NULL THEN 'failed' ELSE 'done' END), COALESCE(attempts, 0), "
+            "COALESCE(error, CASE WHEN status IS NULL AND data IS NULL THEN 'Never queued for extraction' END) "
+            "FROM papers LEFT JOIN extractions USING (pid) WHERE pid = %s",
             (pid,)
         )
-        tags = cursor.fetchall()
-        if len(tags):
-            tags = [tag[0] for tag in tags]
-        else:
-            # Check if the paper exists.
-            cursor.execute('SELECT COUNT(*) FROM papers WHERE pid = %s', (pid,))
-            if cursor.fetchone()[0] == 0:
-                return_status = 1
-                tags = None
+        extraction = cursor.fetchone()
         conn.commit()
+        if extraction is not None:
+            extraction = tuple(extraction)
+            return_status = 0
     except Exception:
         conn.rollback()
-        return_status = 1
-        tags = None
-    return return_status, tags
+        extraction = None
+    return return_status, extraction
+
+
+def get_pending_extractions(conn: Connection, include_failed=False, count=100) -> tuple[int, Optional[list[int]]]:
+    """
+    Get at most $count papers whose text hasn't been extracted yet, oldest first.
+
+    :param conn: A postgres database connection object
+    :param include_failed: Whether to include papers whose extraction has failed for good
+    :param count: An integer
+    :return: (status, retval)
+        (0, [pid1, pid2, ...])  Success
+        (1, None)               Failure
+    """
+    return_status = 1
+    try:
+        cursor = conn.cursor(row_factory=_scalar_row)
+        cursor.execute(
+            'SELECT pid FROM extractions WHERE status = ANY(%s) ORDER BY update_time, pid LIMIT %s',
+            (['pending', 'failed'] if include_failed else ['pending'], count)
+        )
+        pids = cursor.fetchall()
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        pids = None
+    return return_status, pids
+
 
 # Vote related
 
 
+_LIKE_PAPER_IS_AUTHOR = _prepared('like_paper_is_author', 'SELECT username = %s FROM papers WHERE pid = %s')
+_LIKE_PAPER = _prepared('like_paper', 'INSERT INTO likes (username, pid, like_time) VALUES (%s, %s, %s)')
+
+
 def like_paper(conn: Connection, uname: str, pid: int) -> tuple[int, None]:
     """
     Record a like for a paper. Timestamped the like with the current timestamp
@@ -329,12 +1568,9 @@ def like_paper(conn: Connection, uname: str, pid: int) -> tuple[int, None]:
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT username = %s FROM papers WHERE pid = %s', (uname, pid))
+        _execute_prepared(cursor, _LIKE_PAPER_IS_AUTHOR, (uname, pid))
         if not cursor.fetchone()[0]:
-            cursor.execute(
-                'INSERT INTO likes (username, pid, like_time) VALUES (%s, %s, %s)',
-                (uname, pid, datetime.now())
-            )
+            _execute_prepared(cursor, _LIKE_PAPER, (uname, pid, datetime.now()))
             return_status = 0
         conn.commit()
     except Exception:
@@ -343,6 +1579,9 @@ def like_paper(conn: Connection, uname: str, pid: int) -> tuple[int, None]:
     return return_status, None
 
 
+_UNLIKE_PAPER = _prepared('unlike_paper', 'DELETE FROM likes WHERE username = %s AND pid = %s')
+
+
 def unlike_paper(conn: Connection, uname: str, pid: int) -> tuple[int, None]:
     """
     Record an unlike for a paper
@@ -359,10 +1598,7 @@ def unlike_paper(conn: Connection, uname: str, pid: int) -> tuple[int, None]:
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            'DELETE FROM likes WHERE username = %s AND pid = %s',
-            (uname, pid)
-        )
+        _execute_prepared(cursor, _UNLIKE_PAPER, (uname, pid))
         conn.commit()
         return_status = int(cursor.rowcount != 1)
     except Exception:
@@ -371,6 +1607,9 @@ def unlike_paper(conn: Connection, uname: str, pid: int) -> tuple[int, None]:
     return return_status, None
 
 
+_GET_LIKES = _prepared('get_likes', 'SELECT COALESCE((SELECT like_count FROM papers WHERE pid = %s), 0)')
+
+
 def get_likes(conn: Connection, pid: int) -> tuple[int, Optional[int]]:
     """
     Get the number of likes of a paper
@@ -385,7 +1624,7 @@ def get_likes(conn: Connection, pid: int) -> tuple[int, Optional[int]]:
     like_count = None
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM likes WHERE pid = %s', (pid,))
+        _execute_prepared(cursor, _GET_LIKES, (pid,))
         like_count = cursor.fetchone()[0]
         conn.commit()
         return_status = 0
@@ -393,9 +1632,80 @@ def get_likes(conn: Connection, pid: int) -> tuple[int, Optional[int]]:
         conn.rollback()
     return return_status, like_count
 
+
+_GET_LIKES_OF_PAPERS = _prepared('get_likes_of_papers', 'SELECT pid, like_count FROM papers WHERE pid = ANY(%s)')
+
+
+def get_likes_of_papers(conn: Connection, pids: Sequence[int]) -> tuple[int, Optional[dict[int, int]]]:
+    """
+    Get the number of likes of several papers in one query
+
+    :param conn: A postgres database connection object
+    :param pids: A list of pids
+    :return: (status, retval)
+        (0, {pid: like_count, ...})     Success, every pid in $pids is a key. Papers without likes map to 0.
+        (1, None)                       Failure
+    """
+    return_status = 1
+    like_counts = None
+    try:
+        cursor = conn.cursor()
+        _execute_prepared(cursor, _GET_LIKES_OF_PAPERS, (list(pids),))
+        like_counts = dict.fromkeys(pids, 0)
+        like_counts.update(cursor.fetchall())
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        like_counts = None
+    return return_status, like_counts
+
+
+_GET_TAGS_OF_PAPERS = _prepared(
+    'get_tags_of_papers',
+    'SELECT pid, array_agg(tagname ORDER BY tagname) FROM tags WHERE pid = ANY(%s) GROUP BY pid'
+)
+
+
+def get_tags_of_papers(conn: Connection, pids: Sequence[int]) -> tuple[int, Optional[dict[int, list[str]]]]:
+    """
+    Get all tags of several papers in one query
+
+    Unlike get_paper_tags(), a pid that doesn't exist is not an error. It simply maps to an empty list.
+
+    :param conn: A postgres database connection object
+    :param pids: A list of pids
+    :return: (status, retval)
+        (0, {pid: [tag1, tag2, ...], ...})
+            Success, every pid in $pids is a key. Each list is sorted in a lexical ascending order as in
+            get_paper_tags().
+        (1, None)
+            Failure
+    """
+    return_status = 1
+    tags = None
+    try:
+        cursor = conn.cursor()
+        _execute_prepared(cursor, _GET_TAGS_OF_PAPERS, (list(pids),))
+        tags = {pid: [] for pid in pids}
+        tags.update(cursor.fetchall())
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        tags = None
+    return return_status, tags
+
 # Search related
 
 
+_GET_TIMELINE = _prepared(
+    'get_timeline',
+    'SELECT pid, username, title, begin_time, description FROM papers '
+    'WHERE username = %s ORDER BY begin_time DESC, pid LIMIT %s'
+)
+
+
 def get_timeline(conn: Connection, uname: str, count=10)\
         -> tuple[int, Optional[list[Paper]]]:
     """
@@ -429,11 +1739,7 @@ def get_timeline(conn: Connection, uname: str, count=10)\
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            'SELECT pid, username, title, begin_time, description FROM papers '
-            'WHERE username = %s ORDER BY begin_time DESC, pid LIMIT %s',
-            (uname, count)
-        )
+        _execute_prepared(cursor, _GET_TIMELINE, (uname, count))
         papers = cursor.fetchall()
         conn.commit()
         return_status = 0
@@ -443,6 +1749,13 @@ def get_timeline(conn: Connection, uname: str, count=10)\
     return return_status, papers
 
 
+_GET_TIMELINE_ALL = _prepared(
+    'get_timeline_all',
+    'SELECT pid, username, title, begin_time, description FROM papers '
+    'ORDER BY begin_time DESC, pid LIMIT %s'
+)
+
+
 def get_timeline_all(conn: Connection, count=10)\
         -> tuple[int, Optional[list[Paper]]]:
     """
@@ -462,11 +1775,7 @@ def get_timeline_all(conn: Connection, count=10)\
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            'SELECT pid, username, title, begin_time, description FROM papers '
-            'ORDER BY begin_time DESC, pid LIMIT %s',
-            (count,)
-        )
+        _execute_prepared(cursor, _GET_TIMELINE_ALL, (count,))
         papers = cursor.fetchall()
         conn.commit()
         return_status = 0
@@ -476,6 +1785,26 @@ def get_timeline_all(conn: Connection, count=10)\
     return return_status, papers
 
 
+# Take the top $count papers of each day in the window from the leaderboard
+# index and merge them, so the cost depends on the number of days and $count
+# rather than on the number of papers in the window. The parameters are
+# begin_time twice and count twice.
+_GET_MOST_POPULAR_PAPERS = _prepared(
+    'get_most_popular_papers',
+    "SELECT pid, username, title, begin_time, description FROM generate_series("
+    "GREATEST(date_trunc('day', %s::timestamp), "
+    "(SELECT date_trunc('day', MIN(begin_time)) FROM papers)), "
+    "(SELECT date_trunc('day', MAX(begin_time)) FROM papers), "
+    "interval '1 day') AS day "
+    "CROSS JOIN LATERAL ("
+    "SELECT pid, username, title, begin_time, description, like_count FROM papers "
+    "WHERE date_trunc('day', begin_time) = day AND like_count > 0 "
+    "AND begin_time > %s "
+    "ORDER BY like_count DESC, pid LIMIT %s"
+    ") AS top ORDER BY like_count DESC, pid LIMIT %s"
+)
+
+
 def get_most_popular_papers(conn: Connection, begin_time: datetime, count=10)\
         -> tuple[int, Optional[list[Paper]]]:
     """
@@ -497,13 +1826,7 @@ def get_most_popular_papers(conn: Connection, begin_time: datetime, count=10)\
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            'SELECT pid, username, title, begin_time, description FROM papers JOIN ('
-            'SELECT pid, COUNT(*) AS like_count FROM likes '
-            'WHERE pid IN (SELECT pid FROM papers WHERE begin_time > %s) GROUP BY pid'
-            ') AS t USING (pid) ORDER BY like_count DESC, pid LIMIT %s',
-            (begin_time, count)
-        )
+        _execute_prepared(cursor, _GET_MOST_POPULAR_PAPERS, (begin_time, begin_time, count, count))
         papers = cursor.fetchall()
         conn.commit()
         return_status = 0
@@ -540,7 +1863,7 @@ def get_recommend_papers(conn: Connection, uname: str, count=10)\
             'AND pid NOT IN (SELECT * FROM liked_papers) '
             'GROUP BY pid) '
             'SELECT pid, username, title, begin_time, description FROM papers '
-            'JOIN recommended_papers USING (pid) ORDER BY like_count DESC, pid LIMIT %s',
+            'JOIN recommended_papers USING (pid) ORDER BY recommended_papers.like_count DESC, pid LIMIT %s',
             (uname, count)
         )
         papers = cursor.fetchall()
@@ -552,6 +1875,37 @@ def get_recommend_papers(conn: Connection, uname: str, count=10)\
     return return_status, papers
 
 
+def get_like_pairs(conn: Connection) -> tuple[int, Optional[list[tuple[int, str]]]]:
+    """
+    Get every like, for building the recommendation graph in recommend.py.
+
+    :param conn: A postgres database connection object
+    :return: (status, retval)
+        (0, [(pid, username), (...), ...])
+            Success, retval is a list of pairs ordered by username and pid
+        (1, None)
+            Failure
+    """
+    return_status = 1
+    try:
+        cursor = conn.cursor()
+        cursor.execute('SELECT pid, username FROM likes ORDER BY username, pid')
+        likes = cursor.fetchall()
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        likes = None
+    return return_status, likes
+
+
+_GET_PAPERS_BY_TAG = _prepared(
+    'get_papers_by_tag',
+    'SELECT pid, username, title, begin_time, description FROM papers '
+    'JOIN tags USING (pid) WHERE tagname = %s ORDER BY begin_time DESC, pid LIMIT %s'
+)
+
+
 def get_papers_by_tag(conn: Connection, tag: str, count=10) -> tuple[int, Optional[list[Paper]]]:
     """
     Get at most $count papers that have the given tag
@@ -571,11 +1925,7 @@ def get_papers_by_tag(conn: Connection, tag: str, count=10) -> tuple[int, Option
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            'SELECT pid, username, title, begin_time, description FROM papers '
-            'JOIN tags USING (pid) WHERE tagname = %s ORDER BY begin_time DESC, pid LIMIT %s',
-            (tag, count)
-        )
+        _execute_prepared(cursor, _GET_PAPERS_BY_TAG, (tag, count))
         papers = cursor.fetchall()
         conn.commit()
         return_status = 0
@@ -585,6 +1935,20 @@ def get_papers_by_tag(conn: Connection, tag: str, count=10) -> tuple[int, Option
     return return_status, papers
 
 
+# The condition a paper matches a keyword on. The queries that use it are not
+# prepared, so that the planner sees the patterns of the substring matches.
+_KEYWORD_MATCH = (
+    "title LIKE '%%' || %(keyword)s || '%%' "
+    "OR description LIKE '%%' || %(keyword)s || '%%' "
+    "OR to_tsquery('english', %(keyword)s) @@ to_tsvector('english', data)"
+)
+_GET_PAPERS_BY_KEYWORD = (
+    "SELECT pid, username, title, begin_time, description FROM papers "
+    "WHERE " + _KEYWORD_MATCH + " "
+    "ORDER BY begin_time DESC, pid LIMIT %(count)s"
+)
+
+
 def get_papers_by_keyword(conn: Connection, keyword: str, count=10)\
         -> tuple[int, Optional[list[Paper]]]:
     """
@@ -592,10 +1956,12 @@ def get_papers_by_keyword(conn: Connection, keyword: str, count=10)\
 
     The result should first be ordered by begin time (newest first). Break ties by pid (ascending).
 
-    The GIN index on the data field is so stupid. Because the index is only on
-    the data field, searches on title and description still require a full scan
-    anyway, rendering the index useless. The correct approach is to create an
-    index on concatenation of the three fields.
+    Each of the three conditions has an index, so the planner can combine them
+    with a BitmapOr instead of scanning papers: trigram indexes on title and
+    description serve the substring matches and paper_text_idx serves the
+    full-text match on data. The weighted search_vector over all three fields
+    is meant for ranking; matching data against it would also match words
+    that only appear in the title or description.
 
     :param conn: A postgres database connection object
     :param keyword: A string of keyword, e.g. "database"
@@ -610,14 +1976,7 @@ def get_papers_by_keyword(conn: Connection, keyword: str, count=10)\
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            "SELECT pid, username, title, begin_time, description FROM papers "
-            "WHERE title LIKE '%%' || %s || '%%' "
-            "OR description LIKE '%%' || %s || '%%' "
-            "OR to_tsquery('english', %s) @@ to_tsvector('english', data) "
-            "ORDER BY begin_time DESC, pid LIMIT %s",
-            (keyword, keyword, keyword, count)
-        )
+        cursor.execute(_GET_PAPERS_BY_KEYWORD, {'keyword': keyword, 'count': count})
         papers = cursor.fetchall()
         conn.commit()
         return_status = 0
@@ -661,9 +2020,263 @@ def get_papers_by_liked(conn: Connection, uname: str, count=10) -> tuple[int, Op
     return return_status, papers
 
 
+def get_timeline_page(conn: Connection, uname: str, count=10, cursor: Optional[str] = None)\
+        -> tuple[int, Optional[Page]]:
+    """
+    Get a page of the timeline of a user.
+
+    Papers are ordered as in get_timeline(). Pages are found by seeking past the last paper of the previous page
+    instead of skipping rows, so a deep page costs as much as the first one.
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param count: An int indicating the maximum number of papers on the page
+    :param cursor: The cursor returned with the previous page, or None for the first page
+    :return: (status, retval)
+        (0, ([pid, username, title, begin_time, description), (...), ...], next_cursor))
+            Success, next_cursor is an opaque string to get the next page with, or None if this is the last page
+
+        (1, None)
+            Failure
+    """
+    return_status = 1
+    page = None
+    try:
+        seek, params = _page_seek(cursor, 'begin_time')
+        cur = conn.cursor(row_factory=_page_row)
+        cur.execute(
+            'SELECT pid, username, title, begin_time, description FROM papers '
+            'WHERE username = %(uname)s AND ' + seek + ' '
+            'ORDER BY begin_time DESC, pid LIMIT %(limit)s',
+            {'uname': uname, 'limit': count + 1, **params}
+        )
+        page = _split_page(cur.fetchall(), count, 'begin_time')
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        page = None
+    return return_status, page
+
+
+def _tag_page_query(seek: str) -> str:
+    """
+    The query of get_papers_by_tag_page() for the seek condition of its cursor
+    """
+    return (
+        'SELECT pid, username, title, begin_time, description FROM papers '
+        'JOIN tags USING (pid) WHERE tagname = %(tag)s AND ' + seek + ' '
+        'ORDER BY begin_time DESC, pid LIMIT %(limit)s'
+    )
+
+
+def get_papers_by_tag_page(conn: Connection, tag: str, count=10, cursor: Optional[str] = None)\
+        -> tuple[int, Optional[Page]]:
+    """
+    Get a page of papers that have the given tag
+
+    Papers are ordered as in get_papers_by_tag(). See get_timeline_page() for how pages work.
+
+    :param conn: A postgres database connection object
+    :param tag: A string of tag
+    :param count: An int indicating the maximum number of papers on the page
+    :param cursor: The cursor returned with the previous page, or None for the first page
+    :return: (status, retval)
+        (0, ([pid, username, title, begin_time, description), (...), ...], next_cursor))
+            Success, please refer to the format defined in get_timeline_page()'s return value
+
+        (1, None)
+            Failure
+    """
+    return_status = 1
+    page = None
+    try:
+        seek, params = _page_seek(cursor, 'begin_time')
+        cur = conn.cursor(row_factory=_page_row)
+        cur.execute(_tag_page_query(seek), {'tag': tag, 'limit': count + 1, **params})
+        page = _split_page(cur.fetchall(), count, 'begin_time')
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        page = None
+    return return_status, page
+
+
+def _keyword_page_query(seek: str, ranked: bool) -> str:
+    """
+    The query of get_papers_by_keyword_page() for the seek condition of its
+    cursor and the ordering
+
+    No index provides the ranked ordering: ts_rank is computed for every
+    matching paper and the matches are sorted on every page, so each page of
+    a ranked search costs as much as the whole search. Only the ordering by
+    begin_time seeks.
+    """
+    return (
+        "SELECT pid, username, title, begin_time, description, relevance FROM ("
+        "SELECT pid, username, title, begin_time, description, "
+        + ("ts_rank(search_vector, to_tsquery('english', %(keyword)s))::float8 " if ranked else "NULL ") +
+        "AS relevance FROM papers WHERE " + _KEYWORD_MATCH +
+        ") AS matches WHERE " + seek + " "
+        "ORDER BY " + ('relevance' if ranked else 'begin_time') + " DESC, pid LIMIT %(limit)s"
+    )
+
+
+def get_papers_by_keyword_page(conn: Connection, keyword: str, count=10, cursor: Optional[str] = None,
+                               ranked=False) -> tuple[int, Optional[Page]]:
+    """
+    Get a page of papers that match a keyword
+
+    Papers match as in get_papers_by_keyword(). By default they are also ordered the same way. If $ranked is true,
+    they are ordered by relevance instead (highest first), as computed by ts_rank over the weighted search_vector of
+    title, description and data. Ties are broken by pid (ascending). See get_timeline_page() for how pages work. A
+    cursor only works with the ordering it was returned for. Ranked pages rank and sort every match, so deep pages
+    are no cheaper than the first.
+
+    :param conn: A postgres database connection object
+    :param keyword: A string of keyword, e.g. "database"
+    :param count: An int indicating the maximum number of papers on the page
+    :param cursor: The cursor returned with the previous page, or None for the first page
+    :param ranked: Whether to order papers by relevance
+    :return: (status, retval)
+        (0, ([pid, username, title, begin_time, description), (...), ...], next_cursor))
+            Success, please refer to the format defined in get_timeline_page()'s return value
+
+        (1, None)
+            Failure
+    """
+    return_status = 1
+    page = None
+    key = 'relevance' if ranked else 'begin_time'
+    try:
+        seek, params = _page_seek(cursor, key)
+        cur = conn.cursor(row_factory=_page_row)
+        cur.execute(_keyword_page_query(seek, ranked), {'keyword': keyword, 'limit': count + 1, **params})
+        page = _split_page(cur.fetchall(), count, key)
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        page = None
+    return return_status, page
+
+
+def _home_bundle_query(recommended: bool) -> str:
+    """
+    The query of get_home_bundle(), taking the recommended pids as a parameter
+    if $recommended
+    """
+    if not recommended:
+        recommended_query = (
+            'recommended_papers AS (SELECT pid, COUNT(*) AS like_count FROM likes '
+            'WHERE username IN (SELECT DISTINCT username FROM likes WHERE pid IN (SELECT * FROM liked_papers)) '
+            'AND pid NOT IN (SELECT * FROM liked_papers) '
+            'GROUP BY pid), '
+            'recommended AS ('
+            'SELECT row_number() OVER (ORDER BY recommended_papers.like_count DESC, pid) AS rn, '
+            'pid, username, title, begin_time, description FROM papers '
+            'JOIN recommended_papers USING (pid) '
+            'ORDER BY recommended_papers.like_count DESC, pid LIMIT %(count)s) '
+        )
+    else:
+        recommended_query = (
+            'recommended AS ('
+            'SELECT r.rn, pid, username, title, begin_time, description '
+            'FROM unnest(%(recommended)s::int[]) WITH ORDINALITY AS r(pid, rn) JOIN papers USING (pid) '
+            'WHERE pid NOT IN (SELECT * FROM liked_papers) ORDER BY r.rn LIMIT %(count)s) '
+        )
+    # Every result set is tagged by the first column and ordered by the second
+    # one, so that one UNION ALL can carry all of them.
+    return (
+        'WITH timeline AS ('
+        'SELECT row_number() OVER (ORDER BY begin_time DESC, pid) AS rn, '
+        'pid, username, title, begin_time, description FROM papers '
+        'WHERE username = %(uname)s ORDER BY begin_time DESC, pid LIMIT %(count)s), '
+        'liked AS ('
+        'SELECT row_number() OVER (ORDER BY begin_time DESC, pid) AS rn, '
+        'pid, papers.username, title, begin_time, description FROM papers '
+        'JOIN likes USING (pid) WHERE likes.username = %(uname)s '
+        'ORDER BY begin_time DESC, pid LIMIT %(count)s), '
+        'liked_papers AS (SELECT DISTINCT pid FROM likes WHERE username = %(uname)s), '
+        + recommended_query +
+        'SELECT 0 AS result, rn, pid, username, title, begin_time, description, '
+        'NULL::bigint, NULL::bigint, NULL::bigint FROM timeline '
+        'UNION ALL SELECT 1, rn, pid, username, title, begin_time, description, '
+        'NULL, NULL, NULL FROM liked '
+        'UNION ALL SELECT 2, rn, pid, username, title, begin_time, description, '
+        'NULL, NULL, NULL FROM recommended '
+        'UNION ALL SELECT 3, 0, NULL, NULL, NULL, NULL, NULL, '
+        'COALESCE(paper_count, 0), COALESCE(liked_count, 0), COALESCE(tag_count, 0) '
+        'FROM (SELECT) AS one LEFT JOIN user_stats ON username = %(uname)s '
+        'ORDER BY result, rn'
+    )
+
+
+def _split_home_bundle(rows: list[tuple[int, Any]]) -> HomeBundle:
+    """
+    Split the rows of the home bundle query, fetched with _home_row(), into the
+    bundle
+    """
+    paper_lists = ([], [], [])
+    num_post = num_like = num_tag = None
+    for result, value in rows:
+        if result < len(paper_lists):
+            paper_lists[result].append(value)
+        else:
+            num_post, num_like, num_tag = value
+    return (*paper_lists, num_post, num_like, num_tag)
+
+
+def get_home_bundle(conn: Connection, uname: str, count=10, recommended: Optional[Sequence[int]] = None)\
+        -> tuple[int, Optional[HomeBundle]]:
+    """
+    Get everything the home page of a user shows in one round trip.
+
+    All six results are computed by a single statement in a read-only transaction,
+    so they are consistent with each other.
+
+    :param conn: A postgres database connection object
+    :param uname: A string of username
+    :param count: An int indicating the maximum number of papers in each list
+    :param recommended: A list of pids ranked by recommend.Recommender, or None to rank the recommended papers in
+        SQL. Papers the user has liked since the ranking was computed are left out.
+    :return: (status, retval)
+        (0, (timeline, liked, recommended, num_post, num_like, num_tag))
+            Success, the elements are the retvals of get_timeline(), get_papers_by_liked(), get_recommend_papers(),
+            get_number_papers_user(), get_number_liked_user() and get_number_tags_user() respectively.
+
+        (1, None)
+            Failure
+    """
+    return_status = 1
+    bundle = None
+    try:
+        with _read_only(conn):
+            try:
+                cursor = conn.cursor(row_factory=_home_row)
+                cursor.execute(_home_bundle_query(recommended is not None),
+                               {'uname': uname, 'count': count, 'recommended': list(recommended or ())})
+                bundle = _split_home_bundle(cursor.fetchall())
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return_status = 0
+    except Exception:
+        bundle = None
+    return return_status, bundle
+
+
 # Statistics related
 
 
+_GET_MOST_ACTIVE_USERS = _prepared(
+    'get_most_active_users',
+    'SELECT username FROM user_stats WHERE paper_count > 0 ORDER BY paper_count DESC, username LIMIT %s'
+)
+
+
 def get_most_active_users(conn: Connection, count=1) -> tuple[int, Optional[list[str]]]:
     """
     Get at most $count users that post most papers.
@@ -682,13 +2295,9 @@ def get_most_active_users(conn: Connection, count=1) -> tuple[int, Optional[list
     """
     return_status = 1
     try:
-        cursor = conn.cursor()
-        cursor.execute(
-            'SELECT username FROM papers GROUP BY username '
-            'ORDER BY COUNT(*) DESC, username LIMIT %s',
-            (count,)
-        )
-        users = [row[0] for row in cursor.fetchall()]
+        cursor = conn.cursor(row_factory=_scalar_row)
+        _execute_prepared(cursor, _GET_MOST_ACTIVE_USERS, (count,))
+        users = cursor.fetchall()
         conn.commit()
         return_status = 0
     except Exception:
@@ -697,6 +2306,12 @@ def get_most_active_users(conn: Connection, count=1) -> tuple[int, Optional[list
     return return_status, users
 
 
+_GET_MOST_POPULAR_TAGS = _prepared(
+    'get_most_popular_tags',
+    'SELECT tagname, COUNT(*) as tag_count FROM tags GROUP BY tagname ORDER BY tag_count DESC, tagname LIMIT %s'
+)
+
+
 def get_most_popular_tags(conn: Connection, count=1) -> tuple[int, Optional[list[tuple[str, int]]]]:
     """
     Get at most $count many tags that gets most used among all papers
@@ -716,11 +2331,7 @@ def get_most_popular_tags(conn: Connection, count=1) -> tuple[int, Optional[list
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            'SELECT tagname, COUNT(*) as tag_count FROM tags GROUP BY tagname '
-            'ORDER BY tag_count DESC, tagname LIMIT %s',
-            (count,)
-        )
+        _execute_prepared(cursor, _GET_MOST_POPULAR_TAGS, (count,))
         tags_and_count = cursor.fetchall()
         conn.commit()
         return_status = 0
@@ -730,6 +2341,12 @@ def get_most_popular_tags(conn: Connection, count=1) -> tuple[int, Optional[list
     return return_status, tags_and_count
 
 
+_GET_MOST_POPULAR_TAG_PAIRS = _prepared(
+    'get_most_popular_tag_pairs',
+    'SELECT tag1, tag2, pair_count FROM tag_pair_counts ORDER BY pair_count DESC, tag1, tag2 LIMIT %s'
+)
+
+
 def get_most_popular_tag_pairs(conn: Connection, count=1)\
         -> tuple[int, Optional[list[tuple[str, str, int]]]]:
     """
@@ -751,12 +2368,7 @@ def get_most_popular_tag_pairs(conn: Connection, count=1)\
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            'SELECT tags.tagname, t.tagname, COUNT(*) as pair_count '
-            'FROM tags, tags AS t WHERE tags.pid = t.pid AND tags.tagname < t.tagname '
-            'GROUP BY tags.tagname, t.tagname ORDER BY pair_count DESC, tags.tagname, t.tagname LIMIT %s',
-            (count,)
-        )
+        _execute_prepared(cursor, _GET_MOST_POPULAR_TAG_PAIRS, (count,))
         tag_pairs_and_count = cursor.fetchall()
         conn.commit()
         return_status = 0
@@ -766,6 +2378,12 @@ def get_most_popular_tag_pairs(conn: Connection, count=1)\
     return return_status, tag_pairs_and_count
 
 
+_GET_NUMBER_PAPERS_USER = _prepared(
+    'get_number_papers_user',
+    'SELECT COALESCE((SELECT paper_count FROM user_stats WHERE username = %s), 0)'
+)
+
+
 def get_number_papers_user(conn: Connection, uname: str) -> tuple[int, Optional[int]]:
     """
     Get the number of papers posted by a given user.
@@ -781,7 +2399,7 @@ def get_number_papers_user(conn: Connection, uname: str) -> tuple[int, Optional[
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM papers WHERE username = %s', (uname,))
+        _execute_prepared(cursor, _GET_NUMBER_PAPERS_USER, (uname,))
         count = cursor.fetchone()[0]
         conn.commit()
         return_status = 0
@@ -791,6 +2409,12 @@ def get_number_papers_user(conn: Connection, uname: str) -> tuple[int, Optional[
     return return_status, count
 
 
+_GET_NUMBER_LIKED_USER = _prepared(
+    'get_number_liked_user',
+    'SELECT COALESCE((SELECT liked_count FROM user_stats WHERE username = %s), 0)'
+)
+
+
 def get_number_liked_user(conn: Connection, uname: str) -> tuple[int, Optional[int]]:
     """
     Get the number of likes liked by the user
@@ -806,7 +2430,7 @@ def get_number_liked_user(conn: Connection, uname: str) -> tuple[int, Optional[i
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute('SELECT COUNT(*) FROM likes WHERE username = %s', (uname,))
+        _execute_prepared(cursor, _GET_NUMBER_LIKED_USER, (uname,))
         count = cursor.fetchone()[0]
         conn.commit()
         return_status = 0
@@ -816,6 +2440,12 @@ def get_number_liked_user(conn: Connection, uname: str) -> tuple[int, Optional[i
     return return_status, count
 
 
+_GET_NUMBER_TAGS_USER = _prepared(
+    'get_number_tags_user',
+    'SELECT COALESCE((SELECT tag_count FROM user_stats WHERE username = %s), 0)'
+)
+
+
 def get_number_tags_user(conn: Connection, uname: str) -> tuple[int, Optional[int]]:
     """
     Get the number of distinct tagnames used by the user.
@@ -833,11 +2463,7 @@ def get_number_tags_user(conn: Connection, uname: str) -> tuple[int, Optional[in
     return_status = 1
     try:
         cursor = conn.cursor()
-        cursor.execute(
-            'SELECT COUNT(DISTINCT tagname) FROM tags JOIN papers USING (pid) '
-            'WHERE username = %s',
-            (uname,)
-        )
+        _execute_prepared(cursor, _GET_NUMBER_TAGS_USER, (uname,))
         count = cursor.fetchone()[0]
         conn.commit()
         return_status = 0
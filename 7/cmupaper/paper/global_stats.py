@@ -0,0 +1,161 @@
+"""
+The global statistics of the popular papers page, refreshed in the background.
+
+The most active user, the most popular tag and the most popular tag pair
+barely change from one page view to the next, yet each of them is a query.
+A daemon thread recomputes them every GLOBAL_STATS_INTERVAL seconds into a
+snapshot that the views read instead. A snapshot older than
+GLOBAL_STATS_MAX_STALENESS seconds, e.g. because the database was unreachable
+for a while, is not served, and the views query the statistics themselves.
+"""
+import threading
+import time
+from dataclasses import dataclass
+from typing import Callable, Optional
+
+from .constants import *
+from .database_wrapper import call_db
+from . import functions
+
+
+@dataclass(frozen=True)
+class Snapshot:
+    active_users: list[str]
+    popular_tags: list[tuple[str, int]]
+    popular_tag_pairs: list[tuple[str, str, int]]
+    taken_at: float
+    """time.monotonic() when the statistics were read"""
+
+
+def load_snapshot(call=call_db) -> Optional[Snapshot]:
+    """
+    Read the statistics from the database. Return None on failure.
+    """
+    taken_at = time.monotonic()
+    results = []
+    for function in (functions.get_most_active_users, functions.get_most_popular_tags,
+                     functions.get_most_popular_tag_pairs):
+        status, result = call(function, {})
+        if status != SUCCESS:
+            return None
+        results.append(result)
+    return Snapshot(*results, taken_at=taken_at)
+
+
+class StatsRefresher:
+    """
+    Refresh a Snapshot every `interval` seconds in a daemon thread, started by
+    start(), and serve it while it is at most `max_staleness` seconds old.
+    """
+
+    def __init__(self, interval: float = GLOBAL_STATS_INTERVAL, max_staleness: float = GLOBAL_STATS_MAX_STALENESS,
+                 load: Callable[[], Optional[Snapshot]] = load_snapshot):
+        self.interval = interval
+        self.max_staleness = max_staleness
+        self._load = load
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'refresh_ms_last': None,
+            'refresh_ms_max': 0.0,
+            'refresh_ms_total': 0.0,
+            'snapshot_reads': 0,
+            'stale_reads': 0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='global-stats', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def get_snapshot(self) -> Optional[Snapshot]:
+        """
+        Return the latest snapshot, or None if there is none yet or it is too
+        stale to serve
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or time.monotonic() - snapshot.taken_at > self.max_staleness:
+                self._stats['stale_reads'] += 1
+                return None
+            self._stats['snapshot_reads'] += 1
+            return snapshot
+
+    def refresh(self) -> Optional[Snapshot]:
+        """
+        Read the statistics now. Keep the old snapshot if that fails.
+        """
+        start = time.perf_counter()
+        snapshot = self._load()
+        elapsed_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            stats = self._stats
+            stats['refreshes'] += 1
+            stats['refresh_ms_last'] = elapsed_ms
+            stats['refresh_ms_max'] = max(stats['refresh_ms_max'], elapsed_ms)
+            stats['refresh_ms_total'] += elapsed_ms
+            if snapshot is None:
+                stats['refresh_errors'] += 1
+            elif self._snapshot is None or snapshot.taken_at > self._snapshot.taken_at:
+                self._snapshot = snapshot
+            return self._snapshot
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            snapshot = self._snapshot
+        stats['refresh_ms_mean'] = stats['refresh_ms_total'] / stats['refreshes'] if stats['refreshes'] else None
+        stats['snapshot_age_s'] = time.monotonic() - snapshot.taken_at if snapshot is not None else None
+        stats['interval_s'] = self.interval
+        stats['max_staleness_s'] = self.max_staleness
+        return stats
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                # The next round tries again; until then the views fall back
+                # to live queries once the snapshot gets too stale.
+                with self._lock:
+                    self._stats['refresh_errors'] += 1
+            self._stopped.wait(self.interval)
+
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def get_refresher() -> Optional[StatsRefresher]:
+    """
+    Get the process-wide refresher, starting it on first use. Return None if
+    the statistics are configured to be queried on every page view.
+    """
+    global _refresher
+    if GLOBAL_STATS_INTERVAL <= 0:
+        return None
+    if _refresher is None:
+        with _refresher_lock:
+            if _refresher is None:
+                _refresher = StatsRefresher()
+                _refresher.start()
+    return _refresher
+
+
+def get_snapshot() -> Optional[Snapshot]:
+    """
+    Get a snapshot fresh enough to serve, or None if the views should query the
+    statistics themselves
+    """
+    refresher = get_refresher()
+    return refresher.get_snapshot() if refresher is not None else None
@@ -0,0 +1,303 @@
+"""
+Timing of the db APIs called through database_wrapper.
+
+When DB_INSTRUMENTATION is on, every call made through call_db,
+call_db_with_conn or call_db_async is timed, and the statements it executes,
+rows it fetches and commits it makes are counted. The numbers are aggregated
+per API over the life of the process, and per request by
+QueryInstrumentationMiddleware. When it is off, the wrapper only checks the
+`enabled` flag.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextvars import ContextVar
+from typing import Optional
+
+from .constants import *
+
+enabled = DB_INSTRUMENTATION
+
+# Upper bounds in milliseconds of the latency histogram buckets. The last
+# bucket counts everything slower.
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+class CallStats:
+    """
+    Counters of one API, or of all calls to one API during a request.
+    """
+    __slots__ = ('calls', 'errors', 'queries', 'rows', 'commits', 'total_ms', 'max_ms', 'histogram')
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.queries = 0
+        self.rows = 0
+        self.commits = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+
+    def add(self, call: 'CallStats'):
+        self.calls += call.calls
+        self.errors += call.errors
+        self.queries += call.queries
+        self.rows += call.rows
+        self.commits += call.commits
+        self.total_ms += call.total_ms
+        self.max_ms = max(self.max_ms, call.max_ms)
+        for i, n in enumerate(call.histogram):
+            self.histogram[i] += n
+
+    def to_dict(self) -> dict:
+        bounds = ['le_%d' % bound for bound in LATENCY_BUCKETS_MS] + ['inf']
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'queries': self.queries,
+            'rows': self.rows,
+            'commits': self.commits,
+            'total_ms': round(self.total_ms, 3),
+            'max_ms': round(self.max_ms, 3),
+            'histogram': dict(zip(bounds, self.histogram)),
+        }
+
+
+class RequestStats:
+    """
+    Calls made while serving one request, by API name.
+    """
+
+    def __init__(self):
+        self.functions = {}
+
+    @property
+    def total(self) -> CallStats:
+        total = CallStats()
+        for stats in self.functions.values():
+            total.add(stats)
+        return total
+
+
+_lock = threading.Lock()
+_functions = {}
+_recent_requests = deque(maxlen=DB_INSTRUMENTATION_RECENT_REQUESTS)
+_current_request: ContextVar[Optional[RequestStats]] = ContextVar('current_request', default=None)
+
+
+class _CursorProxy:
+    """
+    Count the statements executed and rows fetched through a cursor.
+    """
+
+    def __init__(self, cursor, call: CallStats):
+        self._cursor = cursor
+        self._call = call
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._call.rows += 1
+            yield row
+
+    def execute(self, *args, **kwargs):
+        self._call.queries += 1
+        return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, query, params_seq, *args, **kwargs):
+        params_seq = list(params_seq)
+        self._call.queries += len(params_seq)
+        return self._cursor.executemany(query, params_seq, *args, **kwargs)
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._call.rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._call.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._call.rows += len(rows)
+        return rows
+
+
+class _ConnectionProxy:
+    """
+    Hand out counting cursors and count commits. Other attributes, including
+    assignments like `read_only`, go to the connection.
+    """
+
+    def __init__(self, conn, call: CallStats):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_call', call)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def cursor(self, *args, **kwargs):
+        return _CursorProxy(self._conn.cursor(*args, **kwargs), self._call)
+
+    def commit(self):
+        self._call.commits += 1
+        return self._conn.commit()
+
+
+class _AsyncCursorProxy(_CursorProxy):
+    """
+    The counterpart of _CursorProxy for async cursors.
+    """
+
+    async def __aiter__(self):
+        async for row in self._cursor:
+            self._call.rows += 1
+            yield row
+
+    async def execute(self, *args, **kwargs):
+        self._call.queries += 1
+        return await self._cursor.execute(*args, **kwargs)
+
+    async def executemany(self, query, params_seq, *args, **kwargs):
+        params_seq = list(params_seq)
+        self._call.queries += len(params_seq)
+        return await self._cursor.executemany(query, params_seq, *args, **kwargs)
+
+    async def fetchone(self):
+        row = await self._cursor.fetchone()
+        if row is not None:
+            self._call.rows += 1
+        return row
+
+    async def fetchmany(self, *args, **kwargs):
+        rows = await self._cursor.fetchmany(*args, **kwargs)
+        self._call.rows += len(rows)
+        return rows
+
+    async def fetchall(self):
+        rows = await self._cursor.fetchall()
+        self._call.rows += len(rows)
+        return rows
+
+
+class _AsyncConnectionProxy(_ConnectionProxy):
+    """
+    The counterpart of _ConnectionProxy for async connections.
+    """
+
+    def cursor(self, *args, **kwargs):
+        return _AsyncCursorProxy(self._conn.cursor(*args, **kwargs), self._call)
+
+    async def commit(self):
+        self._call.commits += 1
+        return await self._conn.commit()
+
+
+def call(function, conn, argdict):
+    """
+    Call the db API $function like call_db_with_conn does and record it.
+    """
+    stats = CallStats()
+    start = time.perf_counter()
+    try:
+        return _check(stats, function(_ConnectionProxy(conn, stats), **argdict))
+    except Exception:
+        stats.errors = 1
+        raise
+    finally:
+        _finish(function.__name__, stats, start)
+
+
+async def acall(function, conn, argdict):
+    """
+    Call the async db API $function like call_db_async does and record it.
+    """
+    stats = CallStats()
+    start = time.perf_counter()
+    try:
+        return _check(stats, await function(_AsyncConnectionProxy(conn, stats), **argdict))
+    except Exception:
+        stats.errors = 1
+        raise
+    finally:
+        _finish(function.__name__, stats, start)
+
+
+def _check(stats: CallStats, result):
+    if isinstance(result, tuple) and result and result[0] != SUCCESS:
+        stats.errors = 1
+    return result
+
+
+def _finish(name: str, stats: CallStats, start: float):
+    elapsed = (time.perf_counter() - start) * 1000
+    stats.calls = 1
+    stats.total_ms = stats.max_ms = elapsed
+    stats.histogram[bisect_left(LATENCY_BUCKETS_MS, elapsed)] = 1
+    _record(name, stats)
+
+
+def _record(name: str, stats: CallStats):
+    with _lock:
+        _functions.setdefault(name, CallStats()).add(stats)
+    request = _current_request.get()
+    if request is not None:
+        request.functions.setdefault(name, CallStats()).add(stats)
+
+
+def start_request() -> RequestStats:
+    """
+    Collect the calls made from now on in this context into a RequestStats.
+    """
+    request = RequestStats()
+    _current_request.set(request)
+    return request
+
+
+def finish_request(request: RequestStats, method: str, path: str, status: int):
+    """
+    Stop collecting calls into $request and keep it among the recent requests.
+    """
+    _current_request.set(None)
+    total = request.total
+    with _lock:
+        _recent_requests.append({
+            'method': method,
+            'path': path,
+            'status': status,
+            'db_ms': round(total.total_ms, 3),
+            'calls': total.calls,
+            'queries': total.queries,
+            'functions': {name: stats.to_dict() for name, stats in request.functions.items()},
+        })
+
+
+def get_stats() -> dict:
+    """
+    Get the counters of every API and the most recent requests.
+    """
+    with _lock:
+        return {
+            'enabled': enabled,
+            'functions': {name: stats.to_dict() for name, stats in sorted(_functions.items())},
+            'recent_requests': list(_recent_requests),
+        }
+
+
+def reset():
+    """
+    Clear all counters.
+    """
+    with _lock:
+        _functions.clear()
+        _recent_requests.clear()
@@ -0,0 +1,153 @@
+import time
+from dataclasses import asdict
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paper.advisor import IndexSuggestion, covering_index, suggest_index
+from paper.benchmark import add_noinput_argument, confirm_reset, write_report
+from paper.constants import SUCCESS
+from paper.database_wrapper import close_db_connection, get_db_connection
+from paper.management.commands.bench_functions import UNDOES, benchmark_api, order_apis, shared_workload
+from paper.synthetic import DatasetConfig, SyntheticDataset, load_dataset
+from simple_checker import ALL_FUNCS
+
+
+class Command(BaseCommand):
+    help = ('Replay the workload of every API on a synthetic dataset, report the statements that scan whole '
+            'tables and suggest indexes for them. Every suggested index is created in turn to measure the '
+            'latency of the APIs it affects before and after, then dropped unless --keep is given. '
+            'The database is reset first.')
+
+    def add_arguments(self, parser):
+        DatasetConfig.add_arguments(parser)
+        parser.add_argument('--skip-load', action='store_true',
+                            help='Reuse the data loaded by an earlier run with the same dataset parameters.')
+        parser.add_argument('--repeat', type=int, default=20, help='Number of timed calls per API.')
+        parser.add_argument('--funcs', nargs='+', choices=ALL_FUNCS, default=ALL_FUNCS,
+                            help='APIs to replay. reset_db is never replayed.')
+        parser.add_argument('--keep', action='store_true', help='Keep the suggested indexes.')
+        parser.add_argument('--output', default='advise_indexes.json', help='Where to write the JSON report.')
+        add_noinput_argument(parser)
+
+    def handle(self, *args, **options):
+        config = DatasetConfig.from_options(options)
+        dataset = SyntheticDataset(config)
+        funcs = order_apis([name for name in options['funcs'] if name != 'reset_db'])
+        if not options['skip_load']:
+            confirm_reset(options)
+
+        status, conn = get_db_connection()
+        if status != SUCCESS:
+            raise CommandError('Cannot connect to the database')
+        try:
+            if not options['skip_load']:
+                start = time.monotonic()
+                load_dataset(conn, dataset, batch_size=5000)
+                self.stdout.write('Loaded %d papers in %.1f s' % (config.papers, time.monotonic() - start))
+            before = self.replay(conn, dataset, funcs, options['repeat'])
+            scans, suggestions = self.suggest(conn, before)
+            report = {
+                'dataset': asdict(config),
+                'repeat': options['repeat'],
+                'p50_ms': {name: result['timing']['latency_ms']['p50'] for name, result in before.items()},
+                'scans': scans,
+                'suggestions': [
+                    self.measure(conn, dataset, suggestion, apis, before, options['repeat'], options['keep'])
+                    for suggestion, apis in suggestions.items()
+                ],
+            }
+        finally:
+            close_db_connection(conn)
+
+        write_report(options['output'], report)
+        for scan in scans:
+            self.stdout.write(self.style.WARNING('seq scan: %s on %s%s' % (
+                scan['api'], scan['relation'],
+                ', though %s could serve it' % scan['covered_by'] if scan['covered_by'] else '')))
+        for suggestion in report['suggestions']:
+            self.stdout.write(suggestion['sql'])
+            for name, result in suggestion['apis'].items():
+                self.stdout.write('    %-28s p50 %8.2f ms -> %8.2f ms%s' % (
+                    name, result['before_ms'], result['after_ms'], '' if result['uses_index'] else ', unused'))
+        self.stdout.write(self.style.SUCCESS('Wrote %s' % options['output']))
+
+    @staticmethod
+    def replay(conn, dataset: SyntheticDataset, funcs: list[str], repeat: int) -> dict:
+        """
+        Run the workload of $funcs, with the same arguments on every replay
+        """
+        workloads = {}
+        return {name: benchmark_api(conn, name, shared_workload(workloads, dataset, name), repeat)
+                for name in funcs}
+
+    @staticmethod
+    def suggest(conn, results: dict) -> tuple[list[dict], dict[IndexSuggestion, list[str]]]:
+        """
+        List the sequential scans in $results and the index suggested for each,
+        and map every suggestion to the APIs it would affect
+        """
+        cursor = conn.cursor()
+        cursor.execute('SELECT table_name, column_name FROM information_schema.columns '
+                       'WHERE table_schema = current_schema()')
+        columns = {}
+        for table, column in cursor.fetchall():
+            columns.setdefault(table, set()).add(column)
+        # The key columns of every index, with their direction
+        cursor.execute(
+            "SELECT t.relname, c.relname, array_agg(a.attname || CASE WHEN i.indoption[k.n - 1] & 1 = 1 "
+            "THEN ' DESC' ELSE '' END ORDER BY k.n) "
+            "FROM pg_index AS i JOIN pg_class AS t ON t.oid = i.indrelid JOIN pg_class AS c ON c.oid = i.indexrelid "
+            "CROSS JOIN LATERAL unnest(i.indkey) WITH ORDINALITY AS k(attnum, n) "
+            "JOIN pg_attribute AS a ON a.attrelid = t.oid AND a.attnum = k.attnum "
+            "WHERE t.relnamespace = current_schema()::regnamespace AND k.n <= i.indnkeyatts "
+            "GROUP BY t.relname, c.relname"
+        )
+        indexes = {}
+        for table, index, keys in cursor.fetchall():
+            indexes.setdefault(table, {})[index] = keys
+        conn.commit()
+
+        scans = []
+        suggestions = {}
+        for name, result in results.items():
+            for statement in result['statements']:
+                for scan in statement.get('scans', ()):
+                    suggestion = suggest_index(scan, columns.get(scan['relation'], set()))
+                    covered_by = suggestion and covering_index(suggestion, indexes.get(scan['relation'], {}))
+                    scans.append(dict(scan, api=name, sql=statement['sql'], covered_by=covered_by,
+                                      suggestion=suggestion.sql if suggestion and not covered_by else None))
+                    if suggestion is None or covered_by:
+                        continue
+                    if name not in suggestions.setdefault(suggestion, []):
+                        suggestions[suggestion].append(name)
+        return scans, suggestions
+
+    def measure(self, conn, dataset: SyntheticDataset, suggestion: IndexSuggestion, apis: list[str],
+                before: dict, repeat: int, keep: bool) -> dict:
+        """
+        Create the index of $suggestion and replay the APIs it affects, along
+        with the writes they undo
+        """
+        cursor = conn.cursor()
+        cursor.execute(suggestion.sql)
+        cursor.execute('ANALYZE %s' % suggestion.relation)
+        conn.commit()
+        try:
+            funcs = order_apis(set(apis) | {UNDOES[name] for name in apis if name in UNDOES})
+            after = self.replay(conn, dataset, funcs, repeat)
+        finally:
+            if not keep:
+                cursor.execute('DROP INDEX %s' % suggestion.name)
+                conn.commit()
+        return {
+            'sql': suggestion.sql,
+            'apis': {
+                name: {
+                    'before_ms': before[name]['timing']['latency_ms']['p50'],
+                    'after_ms': after[name]['timing']['latency_ms']['p50'],
+                    'uses_index': any(suggestion.name in statement.get('plan', '')
+                                      for statement in after[name]['statements']),
+                }
+                for name in apis
+            },
+        }
@@ -0,0 +1,131 @@
+import random
+import time
+from dataclasses import asdict
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.benchmark import add_noinput_argument, confirm_reset, summarize, write_report
+from paper.constants import SUCCESS
+from paper.database_wrapper import close_db_connection, get_db_connection
+from paper.synthetic import DatasetConfig, SyntheticDataset, load_dataset
+
+
+def add_new_paper_per_tag(conn, uname, title, desc, text, tags):
+    """
+    add_new_paper as it was before it became a single statement: the paper,
+    then one statement per tag name and per tag, 1 + 2N statements in all
+    """
+    return_status = 1
+    try:
+        cursor = conn.cursor()
+        cursor.execute(
+            'INSERT INTO papers (username, title, begin_time, description, data) '
+            'VALUES (%s, %s, %s, %s, %s) RETURNING pid',
+            (uname, title, datetime.now(), desc, text)
+        )
+        paper_id = cursor.fetchone()[0]
+        if len(tags):
+            cursor.executemany(
+                'INSERT INTO tagnames (tagname) VALUES (%s) ON CONFLICT DO NOTHING',
+                ((tag,) for tag in tags)
+            )
+            cursor.executemany(
+                'INSERT INTO tags (pid, tagname) VALUES (%s, %s)',
+                ((paper_id, tag) for tag in tags)
+            )
+        conn.commit()
+        return_status = 0
+    except Exception:
+        conn.rollback()
+        paper_id = None
+    return return_status, paper_id
+
+
+VARIANTS = {
+    'per_tag': add_new_paper_per_tag,
+    'single_statement': functions.add_new_paper,
+}
+
+
+class Command(BaseCommand):
+    help = ('Time uploads with 1 to 100 tags through add_new_paper and through the statement-per-tag version '
+            'it replaced, on a synthetic dataset. The papers added are deleted again. '
+            'The database is reset first.')
+
+    def add_arguments(self, parser):
+        DatasetConfig.add_arguments(parser)
+        parser.add_argument('--skip-load', action='store_true',
+                            help='Reuse the data loaded by an earlier run with the same dataset parameters.')
+        parser.add_argument('--tag-counts', type=int, nargs='+', default=[1, 2, 5, 10, 20, 50, 100],
+                            help='Numbers of tags per upload.')
+        parser.add_argument('--repeat', type=int, default=200,
+                            help='Number of timed uploads per tag count and variant.')
+        parser.add_argument('--output', default='bench_add_paper.json', help='Where to write the JSON report.')
+        add_noinput_argument(parser)
+
+    def handle(self, *args, **options):
+        config = DatasetConfig.from_options(options)
+        dataset = SyntheticDataset(config)
+        if max(options['tag_counts']) > config.tags:
+            raise CommandError('The dataset has only %d tags' % config.tags)
+        if not options['skip_load']:
+            confirm_reset(options)
+
+        status, conn = get_db_connection()
+        if status != SUCCESS:
+            raise CommandError('Cannot connect to the database')
+        try:
+            if not options['skip_load']:
+                start = time.monotonic()
+                load_dataset(conn, dataset, batch_size=5000)
+                self.stdout.write('Loaded %d papers in %.1f s' % (config.papers, time.monotonic() - start))
+            rng = random.Random(config.seed)
+            report = {
+                'dataset': asdict(config),
+                'repeat': options['repeat'],
+                'tag_counts': {
+                    str(n): self.benchmark(conn, dataset, rng, n, options['repeat'])
+                    for n in options['tag_counts']
+                },
+            }
+        finally:
+            close_db_connection(conn)
+
+        write_report(options['output'], report)
+        self.stdout.write('%6s %16s %16s %8s' % ('tags', 'p50 per tag ms', 'p50 single ms', 'speedup'))
+        for n, result in report['tag_counts'].items():
+            self.stdout.write('%6s %16.3f %16.3f %7.2fx' % (
+                n, result['per_tag']['latency_ms']['p50'], result['single_statement']['latency_ms']['p50'],
+                result['speedup']))
+        self.stdout.write(self.style.SUCCESS('Wrote %s' % options['output']))
+
+    @staticmethod
+    def benchmark(conn, dataset: SyntheticDataset, rng: random.Random, tag_count: int, repeat: int) -> dict:
+        """
+        Time $repeat uploads with $tag_count tags in each variant. Uploads
+        alternate between the variants with the same arguments, and every paper
+        is deleted after it is timed, so that both see the same data.
+        """
+        samples = {name: [] for name in VARIANTS}
+        errors = dict.fromkeys(VARIANTS, 0)
+        for i in range(repeat):
+            argdict = {
+                'uname': dataset.random_user(rng),
+                'title': 'bench %d' % i,
+                'desc': ' '.join(dataset.random_word(rng) for _ in range(10)),
+                'text': ' '.join(dataset.random_word(rng) for _ in range(dataset.config.words_per_paper)),
+                'tags': rng.sample(dataset.tagnames, tag_count),
+            }
+            for name, function in VARIANTS.items():
+                start = time.perf_counter()
+                status, pid = function(conn, **argdict)
+                samples[name].append((time.perf_counter() - start) * 1000)
+                errors[name] += status != SUCCESS
+                if status == SUCCESS:
+                    functions.delete_paper(conn, pid)
+        result = {name: summarize(samples[name], errors[name]) for name in VARIANTS}
+        result['speedup'] = round(
+            result['per_tag']['latency_ms']['p50'] / result['single_statement']['latency_ms']['p50'], 3)
+        return result
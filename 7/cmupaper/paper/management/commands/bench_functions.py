@@ -0,0 +1,333 @@
+import json
+import random
+import time
+from dataclasses import asdict, replace
+from datetime import datetime, timedelta
+from typing import Optional
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.benchmark import add_noinput_argument, confirm_reset, read_report, summarize, write_report
+from paper.constants import SUCCESS
+from paper.database_wrapper import close_db_connection, get_db_connection
+from paper.synthetic import DatasetConfig, SyntheticDataset, load_dataset
+from simple_checker import ALL_FUNCS
+
+# Statements that EXPLAIN accepts
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'VALUES', 'EXECUTE')
+# Relations small enough by design that a sequential scan is fine
+SMALL_RELATIONS = ('tagnames',)
+
+
+class Workload:
+    """
+    Arguments for every API in simple_checker.ALL_FUNCS. Papers added by
+    add_new_paper are the ones deleted by delete_paper, and likes are undone
+    by unlike_paper, so repeated runs leave the dataset as it was.
+    """
+
+    def __init__(self, dataset: SyntheticDataset, seed: int):
+        self.dataset = dataset
+        self.rng = random.Random(seed)
+        self.added_pids = []
+        self.liked = []
+        self.signups = 0
+
+    def random_pid(self) -> int:
+        # reset_db restarts pids at 1.
+        return self.rng.randint(1, self.dataset.config.papers)
+
+    def arguments(self, name: str) -> dict:
+        d, rng = self.dataset, self.rng
+        if name in ('get_timeline', 'get_papers_by_liked', 'get_recommend_papers'):
+            return {'uname': d.random_user(rng), 'count': 10}
+        if name in ('get_number_papers_user', 'get_number_tags_user', 'get_number_liked_user'):
+            return {'uname': d.random_user(rng)}
+        if name in ('get_timeline_all', 'get_most_popular_tag_pairs', 'get_most_popular_tags',
+                    'get_most_active_users'):
+            return {'count': 10}
+        if name in ('get_paper_tags', 'get_likes'):
+            return {'pid': self.random_pid()}
+        if name == 'get_papers_by_keyword':
+            return {'keyword': d.random_word(rng), 'count': 10}
+        if name == 'get_papers_by_tag':
+            return {'tag': d.random_tag(rng), 'count': 10}
+        if name == 'get_most_popular_papers':
+            return {'begin_time': datetime.now() - timedelta(days=14), 'count': 10}
+        if name == 'login':
+            uname = d.random_user(rng)
+            return {'uname': uname, 'pwd': uname}
+        if name == 'signup':
+            self.signups += 1
+            return {'uname': 'bench_signup%d_%d' % (self.signups, rng.randrange(10 ** 9)), 'pwd': 'bench'}
+        if name == 'add_new_paper':
+            return {'uname': d.random_user(rng), 'title': 'bench %s' % d.random_word(rng),
+                    'desc': ' '.join(d.random_word(rng) for _ in range(10)),
+                    'text': ' '.join(d.random_word(rng) for _ in range(d.config.words_per_paper)),
+                    'tags': [d.random_tag(rng) for _ in range(d.config.tags_per_paper)]}
+        if name == 'delete_paper':
+            return {'pid': self.added_pids.pop() if self.added_pids else -1}
+        if name == 'like_paper':
+            like = {'uname': d.random_user(rng), 'pid': self.random_pid()}
+            self.liked.append(like)
+            return like
+        if name == 'unlike_paper':
+            return self.liked.pop() if self.liked else {'uname': '', 'pid': -1}
+        if name == 'reset_db':
+            return {}
+        raise CommandError('No workload for %s' % name)
+
+    def returned(self, name: str, result):
+        if name == 'add_new_paper' and result[0] == SUCCESS:
+            self.added_pids.append(result[1])
+
+
+# reset_db drops the dataset, so it runs last. Writes are undone by the API
+# that comes after them, which shares their workload.
+ORDER = ['add_new_paper', 'delete_paper', 'like_paper', 'unlike_paper']
+UNDOES = {'delete_paper': 'add_new_paper', 'unlike_paper': 'like_paper'}
+
+
+class _ExplainingConnection:
+    """
+    Run EXPLAIN (ANALYZE, BUFFERS) on every statement executed through the
+    connection's cursors, before the statement itself. Statements that write
+    are explained inside a savepoint that is rolled back.
+    """
+
+    def __init__(self, conn, plans: list):
+        object.__setattr__(self, '_conn', conn)
+        object.__setattr__(self, '_plans', plans)
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._conn, name, value)
+
+    def cursor(self, *args, **kwargs):
+        return _ExplainingCursor(self._conn.cursor(*args, **kwargs), self._plans)
+
+
+class _ExplainingCursor:
+    def __init__(self, cursor, plans: list):
+        self._cursor = cursor
+        self._plans = plans
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def execute(self, query, params=None, **kwargs):
+        self._explain(query, params)
+        return self._cursor.execute(query, params, **kwargs)
+
+    def executemany(self, query, params_seq):
+        params_seq = list(params_seq)
+        if params_seq:
+            self._explain(query, params_seq[0])
+        return self._cursor.executemany(query, params_seq)
+
+    def _explain(self, query, params):
+        statement = ' '.join(query.split())
+        if not statement.upper().startswith(EXPLAINABLE):
+            return
+        # A cursor of its own, as the row factory of the API's one might not fit.
+        cursor = self._cursor.connection.cursor()
+        cursor.execute('SAVEPOINT explain')
+        try:
+            cursor.execute('EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) ' + query, params)
+            plan = cursor.fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            self._plans.append(describe_plan(statement, plan[0]))
+        except Exception as e:
+            self._plans.append({'sql': statement, 'error': str(e).strip()})
+        finally:
+            cursor.execute('ROLLBACK TO SAVEPOINT explain')
+            cursor.execute('RELEASE SAVEPOINT explain')
+
+
+def describe_plan(statement: str, explained: dict) -> dict:
+    """
+    Reduce the output of EXPLAIN (FORMAT JSON) to what is compared between
+    runs: the shape of the plan, its sequential scans and its cost. Every
+    sequential scan is also described by its filter and the order its rows
+    are sorted or grouped in above it, for paper.advisor.
+    """
+    seq_scans = []
+    scans = []
+
+    def shape(node: dict, order: Optional[list[str]] = None) -> str:
+        label = node['Node Type']
+        if 'Index Name' in node:
+            label += ' using %s' % node['Index Name']
+        elif 'Relation Name' in node:
+            label += ' on %s' % node['Relation Name']
+        order = node.get('Sort Key') or node.get('Group Key') or order
+        if node['Node Type'] == 'Seq Scan' and node.get('Relation Name') not in SMALL_RELATIONS \
+                and not node.get('Relation Name', '').startswith('staging_'):
+            seq_scans.append(node['Relation Name'])
+            scans.append({'relation': node['Relation Name'], 'alias': node.get('Alias'),
+                          'filter': node.get('Filter'), 'order': order})
+        children = node.get('Plans', ())
+        if children:
+            label += '(%s)' % ', '.join(shape(child, order) for child in children)
+        return label
+
+    plan = explained['Plan']
+    return {
+        'sql': statement,
+        'plan': shape(plan),
+        'seq_scans': seq_scans,
+        'scans': scans,
+        'planning_ms': explained.get('Planning Time'),
+        'execution_ms': explained.get('Execution Time'),
+        'shared_hit_blocks': plan.get('Shared Hit Blocks'),
+        'shared_read_blocks': plan.get('Shared Read Blocks'),
+    }
+
+
+def order_apis(names) -> list[str]:
+    """
+    Order the APIs $names so that each write comes right before the API that
+    undoes it, and reset_db comes last
+    """
+    ordered = [name for name in ORDER if name in names]
+    ordered += sorted(name for name in names if name not in ORDER and name != 'reset_db')
+    if 'reset_db' in names:
+        ordered.append('reset_db')
+    return ordered
+
+
+def shared_workload(workloads: dict, dataset: SyntheticDataset, name: str) -> Workload:
+    """
+    The workload of the API $name in $workloads, created on first use. An API
+    that undoes a write gets the workload of the write.
+    """
+    key = UNDOES.get(name, name)
+    if key not in workloads:
+        workloads[key] = Workload(dataset, dataset.config.seed)
+    return workloads[key]
+
+
+def benchmark_api(conn, name: str, workload: Workload, repeat: int) -> dict:
+    """
+    Capture the plans of one call of the API $name, then time $repeat calls
+    without EXPLAIN. The APIs are called directly, bypassing the cache of the
+    wrapper.
+    """
+    function = getattr(functions, name)
+    plans = []
+    calls = 1 if name == 'reset_db' else repeat
+    argdict = workload.arguments(name)
+    workload.returned(name, function(_ExplainingConnection(conn, plans), **argdict))
+    samples = []
+    errors = 0
+    for _ in range(calls):
+        argdict = workload.arguments(name)
+        start = time.perf_counter()
+        result = function(conn, **argdict)
+        samples.append((time.perf_counter() - start) * 1000)
+        workload.returned(name, result)
+        errors += result[0] != SUCCESS
+    return {'timing': summarize(samples, errors), 'statements': plans}
+
+
+class Command(BaseCommand):
+    help = ('Time every API listed in simple_checker.ALL_FUNCS on synthetic datasets of increasing size and '
+            'capture the plan of every statement with EXPLAIN (ANALYZE, BUFFERS). Sequential scans are '
+            'flagged, and so are plan changes and slowdowns against a baseline report. '
+            'The database is reset first.')
+
+    def add_arguments(self, parser):
+        DatasetConfig.add_arguments(parser)
+        parser.add_argument('--scales', type=int, nargs='+', default=[1000, 10000, 100000],
+                            help='Numbers of papers to benchmark at. Users and likes scale along with the '
+                                 'papers, keeping the ratios given by --papers, --users and --likes.')
+        parser.add_argument('--repeat', type=int, default=20, help='Number of timed calls per API.')
+        parser.add_argument('--funcs', nargs='+', choices=ALL_FUNCS, default=ALL_FUNCS,
+                            help='APIs to benchmark.')
+        parser.add_argument('--output', default='bench_functions.json', help='Where to write the JSON report.')
+        parser.add_argument('--baseline', help='A report of an earlier run to compare with.')
+        parser.add_argument('--threshold', type=float, default=0.5,
+                            help='Relative p50 slowdown against the baseline reported as a regression.')
+        parser.add_argument('--fail-on-regression', action='store_true',
+                            help='Exit with status 1 if there is any regression.')
+        add_noinput_argument(parser)
+
+    def handle(self, *args, **options):
+        base = DatasetConfig.from_options(options)
+        baseline = read_report(options['baseline']) if options['baseline'] else None
+        funcs = order_apis(options['funcs'])
+        confirm_reset(options)
+
+        report = {'repeat': options['repeat'], 'scales': {}}
+        status, conn = get_db_connection()
+        if status != SUCCESS:
+            raise CommandError('Cannot connect to the database')
+        try:
+            for scale in options['scales']:
+                config = replace(
+                    base, papers=scale,
+                    users=max(round(base.users * scale / base.papers), 10),
+                    likes=round(base.likes * scale / base.papers),
+                )
+                dataset = SyntheticDataset(config)
+                start = time.monotonic()
+                load_dataset(conn, dataset, batch_size=5000)
+                self.stdout.write('Loaded %d papers in %.1f s' % (scale, time.monotonic() - start))
+                workloads = {}
+                report['scales'][str(scale)] = {
+                    'dataset': asdict(config),
+                    'functions': {
+                        name: self.benchmark(conn, name, shared_workload(workloads, dataset, name),
+                                             options['repeat'])
+                        for name in funcs
+                    },
+                }
+        finally:
+            close_db_connection(conn)
+
+        report['flags'] = flags = self.flag(report, baseline, options['threshold'])
+        write_report(options['output'], report)
+        for flag in flags:
+            self.stdout.write(self.style.WARNING(flag))
+        self.stdout.write(self.style.SUCCESS('Wrote %s' % options['output']))
+        if options['fail_on_regression'] and any(not flag.startswith('seq scan') for flag in flags):
+            raise CommandError('Regressions against %s' % options['baseline'])
+
+    def benchmark(self, conn, name: str, workload: Workload, repeat: int) -> dict:
+        result = benchmark_api(conn, name, workload, repeat)
+        self.stdout.write('%-28s p50 %8.2f ms' % (name, result['timing']['latency_ms']['p50']))
+        return result
+
+    @staticmethod
+    def flag(report: dict, baseline, threshold: float) -> list[str]:
+        """
+        List sequential scans, and plan changes and slowdowns against $baseline.
+        """
+        flags = []
+        for scale, results in report['scales'].items():
+            for name, result in results['functions'].items():
+                for statement in result['statements']:
+                    for relation in statement.get('seq_scans', ()):
+                        flags.append('seq scan: %s on %s at %s papers' % (name, relation, scale))
+                if baseline is None:
+                    continue
+                before = baseline.get('scales', {}).get(scale, {}).get('functions', {}).get(name)
+                if before is None:
+                    continue
+                plans = [statement.get('plan') for statement in result['statements']]
+                plans_before = [statement.get('plan') for statement in before['statements']]
+                if plans != plans_before:
+                    flags.append('plan changed: %s at %s papers' % (name, scale))
+                p50 = result['timing'].get('latency_ms', {}).get('p50')
+                p50_before = before['timing'].get('latency_ms', {}).get('p50')
+                if p50 and p50_before and p50 > p50_before * (1 + threshold):
+                    flags.append('slower: %s at %s papers, p50 %.2f ms -> %.2f ms' % (
+                        name, scale, p50_before, p50))
+        return flags
@@ -0,0 +1,205 @@
+import random
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.benchmark import add_noinput_argument, confirm_reset, summarize, write_report
+from paper.constants import SUCCESS
+from paper.database_wrapper import close_db_connection, connect, get_db_connection
+
+LAYOUTS = {'plain': False, 'partitioned': True}
+
+
+def scanned_relations(explained: dict, prefix: str) -> list[str]:
+    """
+    The relations starting with $prefix that the plan of EXPLAIN (ANALYZE,
+    FORMAT JSON) actually scanned, i.e. the partitions left after pruning
+    """
+    relations = []
+
+    def visit(node: dict):
+        name = node.get('Relation Name', '')
+        if name.startswith(prefix) and node.get('Actual Loops', 0) > 0 and name not in relations:
+            relations.append(name)
+        for child in node.get('Plans', ()):
+            visit(child)
+
+    visit(explained['Plan'])
+    return relations
+
+
+class Command(BaseCommand):
+    help = ('Compare plain and monthly partitioned papers and likes on the same generated data: the latency of '
+            'the time-ranged reads and of liking, the partitions the reads scan, and the time to drop the oldest '
+            'month, by DELETE from the plain tables and by archiving the partitions. The database is reset first.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--papers', type=int, default=200_000)
+        parser.add_argument('--likes', type=int, default=10_000_000,
+                            help='Number of likes, spread evenly over the papers.')
+        parser.add_argument('--months', type=int, default=24, help='Number of months the papers are posted over.')
+        parser.add_argument('--repeat', type=int, default=50, help='Number of timed calls per API.')
+        parser.add_argument('--output', default='bench_partitions.json', help='Where to write the JSON report.')
+        add_noinput_argument(parser)
+
+    def handle(self, *args, **options):
+        if options['likes'] // options['papers'] >= options['users'] - 1:
+            raise CommandError('Too many likes per paper for %d users' % options['users'])
+        confirm_reset(options)
+
+        now = datetime.now()
+        report = {
+            'dataset': {name: options[name] for name in ('users', 'papers', 'likes', 'months')},
+            'repeat': options['repeat'],
+            'layouts': {},
+        }
+        for layout, partitioned in LAYOUTS.items():
+            start = time.monotonic()
+            with self.connection() as conn:
+                self.load(conn, partitioned, options, now)
+            self.stdout.write('Loaded the %s tables in %.1f s' % (layout, time.monotonic() - start))
+            # The partitioned tables are read the way a connection of the app
+            # reads them with PARTITIONED_TABLES on.
+            with connect(generic_plans=partitioned) as conn:
+                report['layouts'][layout] = self.benchmark(conn, partitioned, options, now)
+
+        write_report(options['output'], report)
+        self.stdout.write('%-12s %12s %12s %12s %12s %12s %14s' % (
+            'layout', 'popular ms', 'timeline ms', 'like ms', 'unlike ms', 'partitions', 'drop month ms'))
+        for layout, result in report['layouts'].items():
+            self.stdout.write('%-12s %12.3f %12.3f %12.3f %12.3f %12d %14.1f' % (
+                layout, *(result[name]['latency_ms']['p50']
+                          for name in ('get_most_popular_papers', 'get_timeline_all', 'like_paper', 'unlike_paper')),
+                len(result['popular_papers_scans']), result['drop_month_ms']))
+        self.stdout.write(self.style.SUCCESS('Wrote %s' % options['output']))
+
+    @staticmethod
+    @contextmanager
+    def connection():
+        status, conn = get_db_connection()
+        if status != SUCCESS:
+            raise CommandError('Cannot connect to the database')
+        try:
+            yield conn
+        finally:
+            close_db_connection(conn)
+
+    @staticmethod
+    def load(conn, partitioned: bool, options: dict, now: datetime):
+        """
+        Reset the database and generate the data in a few set-based statements,
+        with the counter triggers disabled and the counters rebuilt afterwards.
+        Paper i is posted by user i % users, evenly spread over the months,
+        and liked by the next likes / papers users.
+        """
+        first = functions._add_months(functions._month_start(now), -options['months'] + 1)
+        functions.reset_db(conn, partitioned=partitioned)
+        if partitioned:
+            status, _ = functions.maintain_partitions(conn, since=first, now=now)
+            if status != SUCCESS:
+                raise CommandError('Cannot create the partitions')
+        users, papers = options['users'], options['papers']
+        cursor = conn.cursor()
+        cursor.execute("INSERT INTO users (username, password) "
+                       "SELECT 'user' || i, 'user' FROM generate_series(0, %s - 1) AS i", (users,))
+        cursor.execute("INSERT INTO tagnames (tagname) SELECT 'tag' || i FROM generate_series(0, 49) AS i")
+        conn.commit()
+        cursor.execute('ALTER TABLE papers DISABLE TRIGGER USER')
+        cursor.execute('ALTER TABLE likes DISABLE TRIGGER USER')
+        cursor.execute('ALTER TABLE tags DISABLE TRIGGER USER')
+        cursor.execute('SELECT setseed(0.415)')
+        cursor.execute(
+            "INSERT INTO papers (pid, username, title, begin_time, description) "
+            "SELECT i, 'user' || i %% %(users)s, 'paper ' || i, "
+            "%(first)s + (%(now)s - %(first)s) * (i::float / %(papers)s), 'generated' "
+            "FROM generate_series(1, %(papers)s) AS i",
+            {'users': users, 'papers': papers, 'first': first, 'now': now}
+        )
+        cursor.execute("SELECT setval(pg_get_serial_sequence('papers', 'pid'), %s)", (papers,))
+        cursor.execute(
+            "INSERT INTO tags (pid, tagname) SELECT pid, 'tag' || (pid + k * (1 + pid / 50 % 49)) % 50 "
+            "FROM papers CROSS JOIN generate_series(0, 1) AS k"
+        )
+        cursor.execute(
+            "INSERT INTO likes (pid, username, like_time) "
+            "SELECT pid, 'user' || (pid + 1 + j) %% %(users)s, begin_time + (%(now)s - begin_time) * random() "
+            "FROM papers CROSS JOIN generate_series(0, %(per_paper)s - 1) AS j",
+            {'users': users, 'per_paper': options['likes'] // papers, 'now': now}
+        )
+        cursor.execute('ALTER TABLE papers ENABLE TRIGGER USER')
+        cursor.execute('ALTER TABLE likes ENABLE TRIGGER USER')
+        cursor.execute('ALTER TABLE tags ENABLE TRIGGER USER')
+        conn.commit()
+        for check in (functions.check_like_counts, functions.check_tag_pair_counts, functions.check_user_stats):
+            if check(conn, repair=True)[0] != SUCCESS:
+                raise CommandError('Cannot rebuild the counters')
+        with functions._autocommit(conn):
+            cursor.execute('VACUUM ANALYZE')
+
+    @staticmethod
+    def benchmark(conn, partitioned: bool, options: dict, now: datetime) -> dict:
+        """
+        Time the reads and likes, then drop the oldest month
+        """
+        rng = random.Random(415)
+        users, papers, repeat = options['users'], options['papers'], options['repeat']
+        week_ago = now - timedelta(days=7)
+        result = {}
+        calls = {
+            'get_most_popular_papers': lambda: functions.get_most_popular_papers(conn, week_ago),
+            'get_timeline_all': lambda: functions.get_timeline_all(conn),
+        }
+        for name, call in calls.items():
+            # Untimed, to read the indexes in after loading
+            for _ in range(repeat):
+                call()
+            samples, errors = [], 0
+            for _ in range(repeat):
+                start = time.perf_counter()
+                status, _ = call()
+                samples.append((time.perf_counter() - start) * 1000)
+                errors += status != SUCCESS
+            result[name] = summarize(samples, errors)
+
+        # A user who doesn't like the paper yet likes and unlikes it
+        samples = {'like_paper': [], 'unlike_paper': []}
+        errors = dict.fromkeys(samples, 0)
+        for _ in range(repeat):
+            pid = rng.randint(1, papers)
+            uname = 'user%d' % ((pid + users - 1) % users)
+            for name in samples:
+                start = time.perf_counter()
+                status, _ = getattr(functions, name)(conn, uname, pid)
+                samples[name].append((time.perf_counter() - start) * 1000)
+                errors[name] += status != SUCCESS
+        for name in samples:
+            result[name] = summarize(samples[name], errors[name])
+
+        cursor = conn.cursor()
+        query = functions.PREPARED_STATEMENTS[functions._GET_MOST_POPULAR_PAPERS]
+        cursor.execute('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, (week_ago, week_ago, 10, 10))
+        result['popular_papers_scans'] = scanned_relations(cursor.fetchone()[0][0], 'papers')
+        conn.rollback()
+
+        # The oldest month, with the likes and tags of its papers
+        cutoff = functions._add_months(functions._month_start(now), -(options['months'] - 2))
+        cursor.execute('SELECT COUNT(*) FROM papers WHERE begin_time < %s', (cutoff,))
+        result['dropped_papers'] = cursor.fetchone()[0]
+        conn.rollback()
+        start = time.perf_counter()
+        if partitioned:
+            status, (_, archived) = functions.maintain_partitions(conn, retain=options['months'] - 2, now=now)
+            if status != SUCCESS:
+                raise CommandError('Cannot archive the oldest month')
+        else:
+            cursor.execute('DELETE FROM papers WHERE begin_time < %s', (cutoff,))
+            conn.commit()
+        result['drop_month_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        for check in (functions.check_like_counts, functions.check_tag_pair_counts, functions.check_user_stats):
+            result.setdefault('counters_wrong_after_drop', 0)
+            result['counters_wrong_after_drop'] += check(conn)[1]
+        return result
@@ -0,0 +1,118 @@
+import re
+import time
+from dataclasses import asdict
+from unittest import mock
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.benchmark import add_noinput_argument, confirm_reset, summarize, write_report
+from paper.constants import SUCCESS
+from paper.database_wrapper import close_db_connection, get_db_connection
+from paper.management.commands.bench_functions import Workload
+from paper.synthetic import DatasetConfig, SyntheticDataset, load_dataset
+
+# Read-only APIs whose statements are in functions.PREPARED_STATEMENTS, so
+# that both variants see the same data
+FUNCS = [
+    'login', 'get_likes', 'get_paper_tags', 'get_timeline', 'get_timeline_all', 'get_papers_by_tag',
+    'get_number_papers_user', 'get_number_liked_user', 'get_number_tags_user',
+]
+
+
+class Command(BaseCommand):
+    help = ('Time the APIs that use prepared statements with and without preparing them, on a synthetic '
+            'dataset, and report how often the server reused a generic plan instead of planning again. '
+            'The database is reset first.')
+
+    def add_arguments(self, parser):
+        DatasetConfig.add_arguments(parser)
+        parser.add_argument('--skip-load', action='store_true',
+                            help='Reuse the data loaded by an earlier run with the same dataset parameters.')
+        parser.add_argument('--repeat', type=int, default=500, help='Number of timed calls per API and variant.')
+        parser.add_argument('--funcs', nargs='+', choices=FUNCS, default=FUNCS, help='APIs to benchmark.')
+        parser.add_argument('--output', default='bench_prepared.json', help='Where to write the JSON report.')
+        add_noinput_argument(parser)
+
+    def handle(self, *args, **options):
+        config = DatasetConfig.from_options(options)
+        dataset = SyntheticDataset(config)
+        if not options['skip_load']:
+            confirm_reset(options)
+
+        status, conn = get_db_connection()
+        if status != SUCCESS:
+            raise CommandError('Cannot connect to the database')
+        try:
+            if not options['skip_load']:
+                start = time.monotonic()
+                load_dataset(conn, dataset, batch_size=5000)
+                self.stdout.write('Loaded %d papers in %.1f s' % (config.papers, time.monotonic() - start))
+            report = {
+                'dataset': asdict(config),
+                'repeat': options['repeat'],
+                'functions': {
+                    name: self.benchmark(conn, name, Workload(dataset, config.seed), options['repeat'])
+                    for name in options['funcs']
+                },
+                'statements': self.plan_counts(conn),
+            }
+        finally:
+            close_db_connection(conn)
+
+        write_report(options['output'], report)
+        self.stdout.write('%-24s %14s %14s %8s' % ('function', 'p50 plain ms', 'p50 prep ms', 'speedup'))
+        for name, result in report['functions'].items():
+            self.stdout.write('%-24s %14.3f %14.3f %7.2fx' % (
+                name, result['unprepared']['latency_ms']['p50'], result['prepared']['latency_ms']['p50'],
+                result['speedup']))
+        self.stdout.write(self.style.SUCCESS('Wrote %s' % options['output']))
+
+    @staticmethod
+    def benchmark(conn, name: str, workload: Workload, repeat: int) -> dict:
+        """
+        Time $repeat calls of the API $name in each variant. Calls alternate
+        between the variants with the same arguments, so that both see the
+        same caches. The APIs are called directly, bypassing the cache of the
+        wrapper.
+        """
+        function = getattr(functions, name)
+        arguments = [workload.arguments(name) for _ in range(repeat)]
+        samples = {False: [], True: []}
+        errors = {False: 0, True: 0}
+        # Prepare the statements outside of the timed calls.
+        function(conn, **arguments[0])
+        for argdict in arguments:
+            for prepare in (False, True):
+                with mock.patch.object(functions, 'prepare_statements', prepare):
+                    start = time.perf_counter()
+                    result = function(conn, **argdict)
+                    samples[prepare].append((time.perf_counter() - start) * 1000)
+                errors[prepare] += result[0] != SUCCESS
+        unprepared = summarize(samples[False], errors[False])
+        prepared = summarize(samples[True], errors[True])
+        return {
+            'unprepared': unprepared,
+            'prepared': prepared,
+            'speedup': round(unprepared['latency_ms']['p50'] / prepared['latency_ms']['p50'], 3),
+        }
+
+    @staticmethod
+    def plan_counts(conn) -> dict:
+        """
+        How many times each registered statement prepared on $conn was run with
+        the generic plan, which skips planning, or planned anew for its
+        parameters
+        """
+        # psycopg names the statements itself, so they are told apart by their
+        # text, with parameters numbered as psycopg sends them.
+        names = {}
+        for name, query in functions.PREPARED_STATEMENTS.items():
+            numbers = iter(range(1, query.count('%s') + 1))
+            names[re.sub('%s', lambda _: '$%d' % next(numbers), query)] = name
+        cursor = conn.cursor()
+        cursor.execute('SELECT statement, generic_plans, custom_plans FROM pg_prepared_statements')
+        counts = {names[statement]: {'generic_plans': generic, 'custom_plans': custom}
+                  for statement, generic, custom in cursor.fetchall() if statement in names}
+        conn.commit()
+        return counts
@@ -0,0 +1,170 @@
+import random
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import asdict
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.test import Client, override_settings
+
+from paper.benchmark import add_noinput_argument, confirm_reset, summarize, write_report
+from paper.constants import SUCCESS
+from paper.database_wrapper import close_db_connection, get_db_connection
+from paper.extraction import get_extraction_pool
+from paper.synthetic import DatasetConfig, SyntheticDataset, load_dataset
+
+# The smallest PDF that pdftotext reads, one empty page
+EMPTY_PDF = (
+    b'%PDF-1.1\n1 0 obj<</Type/Catalog/Pages 2 0 R>>endobj\n'
+    b'2 0 obj<</Type/Pages/Kids[3 0 R]/Count 1>>endobj\n'
+    b'3 0 obj<</Type/Page/MediaBox[0 0 612 792]/Parent 2 0 R>>endobj\n'
+    b'trailer<</Root 1 0 R>>\n%%EOF\n'
+)
+
+
+def request_home(client, dataset, rng):
+    return client.get('/home/')
+
+
+def request_popular_papers(client, dataset, rng):
+    return client.get('/popular_papers/')
+
+
+def request_search_view(client, dataset, rng):
+    return client.get('/search_view/', {'keywords': dataset.random_word(rng)})
+
+
+def request_tag_view(client, dataset, rng):
+    return client.get('/tag_view/%s' % dataset.random_tag(rng))
+
+
+def request_like(client, dataset, rng):
+    # reset_db restarts pids at 1.
+    return client.get('/like/%d/popular/' % rng.randint(1, dataset.config.papers))
+
+
+def request_new_paper(client, dataset, rng):
+    return client.post('/new_paper/', {
+        'title': 'benchmark %s' % dataset.random_word(rng),
+        'desc': ' '.join(dataset.random_word(rng) for _ in range(10)),
+        'tags': ', '.join(dataset.random_tag(rng) for _ in range(dataset.config.tags_per_paper)),
+        'post_pdf': SimpleUploadedFile('benchmark.pdf', EMPTY_PDF, content_type='application/pdf'),
+    })
+
+
+ENDPOINTS = {
+    'home': request_home,
+    'popular_papers': request_popular_papers,
+    'search_view': request_search_view,
+    'tag_view': request_tag_view,
+    'like': request_like,
+    'new_paper': request_new_paper,
+}
+
+
+class Command(BaseCommand):
+    help = ('Load a synthetic dataset and measure the latency and throughput of the views under concurrent load. '
+            'The database is reset first.')
+
+    def add_arguments(self, parser):
+        DatasetConfig.add_arguments(parser)
+        parser.add_argument('--skip-load', action='store_true',
+                            help='Reuse the data loaded by an earlier run with the same dataset parameters.')
+        parser.add_argument('--requests', type=int, default=200, help='Number of requests per endpoint.')
+        parser.add_argument('--concurrency', type=int, default=8, help='Number of concurrent clients.')
+        parser.add_argument('--endpoints', nargs='+', choices=sorted(ENDPOINTS), default=sorted(ENDPOINTS),
+                            help='Endpoints to request.')
+        parser.add_argument('--output', default='bench_views.json', help='Where to write the JSON report.')
+        add_noinput_argument(parser)
+
+    def handle(self, *args, **options):
+        config = DatasetConfig.from_options(options)
+        dataset = SyntheticDataset(config)
+        if not options['skip_load']:
+            confirm_reset(options)
+            self.load(dataset)
+
+        # Requests are mixed, with the same order for the same seed.
+        rng = random.Random(config.seed)
+        jobs = [name for name in options['endpoints'] for _ in range(options['requests'])]
+        rng.shuffle(jobs)
+        jobs = [(name, random.Random(rng.random())) for name in jobs]
+
+        # Keep uploads out of the media directory.
+        upload_dir = tempfile.mkdtemp(prefix='bench_views')
+        try:
+            with override_settings(BASE_DIR=upload_dir, MEDIA_ROOT=upload_dir + '/media',
+                                   ALLOWED_HOSTS=settings.ALLOWED_HOSTS + ['testserver']):
+                results, elapsed = self.run(dataset, jobs, options['concurrency'])
+                get_extraction_pool().join(timeout=60)
+        finally:
+            shutil.rmtree(upload_dir, ignore_errors=True)
+
+        report = {
+            'dataset': asdict(config),
+            'requests': options['requests'],
+            'concurrency': options['concurrency'],
+            'total': summarize([ms for samples, _ in results.values() for ms in samples],
+                               sum(errors for _, errors in results.values()), elapsed),
+            'endpoints': {
+                name: summarize(samples, errors, elapsed) for name, (samples, errors) in results.items()
+            },
+        }
+        write_report(options['output'], report)
+
+        self.stdout.write('%-16s %8s %8s %10s %10s %10s %10s' % ('endpoint', 'requests', 'errors', 'p50 ms',
+                                                                 'p95 ms', 'p99 ms', 'req/s'))
+        for name, summary in sorted(report['endpoints'].items()):
+            latency = summary['latency_ms']
+            self.stdout.write('%-16s %8d %8d %10.1f %10.1f %10.1f %10.1f' % (
+                name, summary['count'], summary['errors'], latency['p50'], latency['p95'], latency['p99'],
+                summary['throughput_per_s']))
+        self.stdout.write(self.style.SUCCESS('Wrote %s' % options['output']))
+
+    def load(self, dataset: SyntheticDataset):
+        status, conn = get_db_connection()
+        if status != SUCCESS:
+            raise CommandError('Cannot connect to the database')
+        try:
+            start = time.monotonic()
+            papers, tags, likes = load_dataset(
+                conn, dataset, progress=lambda n: self.stdout.write('Loaded %d papers' % n))
+        finally:
+            close_db_connection(conn)
+        self.stdout.write('Loaded %d papers, %d tags and %d likes in %.1f s' % (
+            papers, tags, likes, time.monotonic() - start))
+
+    def run(self, dataset: SyntheticDataset, jobs, concurrency: int):
+        """
+        Send the requests from $concurrency threads, each with its own client.
+        Return the latencies and error count per endpoint, and the wall time.
+        """
+        local = threading.local()
+        results = {name: ([], 0) for name, _ in jobs}
+        lock = threading.Lock()
+
+        def send(job):
+            name, rng = job
+            if not hasattr(local, 'client'):
+                local.client = Client()
+            local.client.cookies['uname'] = dataset.random_user(rng)
+            start = time.perf_counter()
+            try:
+                failed = ENDPOINTS[name](local.client, dataset, rng).status_code >= 400
+            except Exception as e:
+                self.stderr.write('%s failed: %s' % (name, e))
+                failed = True
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                samples, errors = results[name]
+                samples.append(elapsed)
+                results[name] = (samples, errors + failed)
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(send, jobs))
+        return results, time.monotonic() - start
@@ -0,0 +1,31 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.constants import SUCCESS
+from paper.database_wrapper import call_db
+from paper.extraction import extract_paper
+from paper.views import get_upload_file_path
+
+
+class Command(BaseCommand):
+    help = ('Extract the text of uploaded papers that are still pending, e.g. because the server restarted '
+            'or the extraction queue was full.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--retry-failed', action='store_true',
+                            help='Also retry papers whose extraction has failed for good.')
+        parser.add_argument('--limit', type=int, default=100,
+                            help='Maximum number of papers to process.')
+
+    def handle(self, *args, **options):
+        status, pids = call_db(functions.get_pending_extractions,
+                               {'include_failed': options['retry_failed'], 'count': options['limit']})
+        if status != SUCCESS:
+            raise CommandError('Failed to get pending extractions')
+        done = 0
+        for pid in pids:
+            if extract_paper(pid, get_upload_file_path(pid)):
+                done += 1
+            else:
+                self.stderr.write('Failed to extract the text of paper %d' % pid)
+        self.stdout.write('Extracted %d of %d papers' % (done, len(pids)))
@@ -0,0 +1,168 @@
+import csv
+import json
+import sys
+import time
+from datetime import datetime
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.constants import SUCCESS
+from paper.database_wrapper import call_db_with_conn, close_db_connection, get_db_connection
+from paper.models import Paper, TagName, User
+
+
+def split_list(value) -> list:
+    """
+    Tags and likes are given as lists in JSON and comma separated in CSV, like
+    in the upload form
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(',')
+    return [item.strip() if isinstance(item, str) else item for item in value if item]
+
+
+def parse_time(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    value = value.strip()
+    return datetime.fromisoformat(value) if value else None
+
+
+def parse_paper(record: dict) -> dict:
+    """
+    Turn a JSON object or CSV row into the dict taken by functions.import_papers.
+    Raise ValueError if it doesn't fit the schema.
+    """
+    username = record.get('username')
+    if not username or len(username) > User.USERNAME_MAX_LENGTH:
+        raise ValueError('invalid username %r' % username)
+    title = record.get('title') or None
+    if title is not None and len(title) > Paper.TITLE_MAX_LENGTH:
+        raise ValueError('title longer than %d characters' % Paper.TITLE_MAX_LENGTH)
+    description = record.get('description') or None
+    if description is not None and len(description) > Paper.DESCRIPTION_MAX_LENGTH:
+        raise ValueError('description longer than %d characters' % Paper.DESCRIPTION_MAX_LENGTH)
+    data = record.get('data') or None
+    if data is not None:
+        # postgres text can't hold NUL characters.
+        data = data.replace('\x00', '')
+
+    tags = split_list(record.get('tags'))
+    for tag in tags:
+        if len(tag) > TagName.TAG_MAX_LENGTH:
+            raise ValueError('tag longer than %d characters' % TagName.TAG_MAX_LENGTH)
+    likes = []
+    for like in split_list(record.get('likes')):
+        if isinstance(like, dict):
+            like = (like.get('username'), parse_time(like.get('like_time')))
+        elif isinstance(like, str):
+            like = (like, None)
+        else:
+            like = (like[0], parse_time(like[1]))
+        if not like[0] or len(like[0]) > User.USERNAME_MAX_LENGTH:
+            raise ValueError('invalid liker %r' % like[0])
+        likes.append(like)
+
+    return {
+        'username': username,
+        'title': title,
+        'description': description,
+        'data': data,
+        'begin_time': parse_time(record.get('begin_time')),
+        'tags': tags,
+        'likes': likes,
+    }
+
+
+def rate(count: int, elapsed: float) -> float:
+    return count / elapsed if elapsed > 0 else 0.0
+
+
+def read_records(file, file_format: str):
+    if file_format == 'csv':
+        yield from csv.DictReader(file)
+    else:
+        for line in file:
+            if line.strip():
+                yield json.loads(line)
+
+
+class Command(BaseCommand):
+    help = ('Import papers with their tags and likes from a JSON Lines or CSV file. '
+            'Each record has the fields username, title, description, data, begin_time, tags and likes. '
+            'In CSV, tags and likes are comma separated lists; in JSON they are lists, and a like may be '
+            'an object with the fields username and like_time.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('file', help='The file to import, or - for standard input.')
+        parser.add_argument('--format', choices=('jsonl', 'csv'),
+                            help='Format of the file. Guessed from its extension by default.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of papers imported per transaction.')
+        parser.add_argument('--create-users', action='store_true',
+                            help="Create authors and likers that don't exist, with a random password, "
+                                 "instead of skipping their papers and likes.")
+
+    def handle(self, *args, **options):
+        file_format = options['format']
+        if file_format is None:
+            file_format = 'csv' if options['file'].lower().endswith('.csv') else 'jsonl'
+        if options['batch_size'] < 1:
+            raise CommandError('The batch size must be positive')
+
+        if options['file'] == '-':
+            self.import_file(sys.stdin, file_format, options)
+        else:
+            try:
+                file = open(options['file'], newline='', encoding='utf-8')
+            except OSError as e:
+                raise CommandError('Cannot open %s: %s' % (options['file'], e))
+            with file:
+                self.import_file(file, file_format, options)
+
+    def import_file(self, file, file_format: str, options):
+        status, conn = get_db_connection()
+        if status != SUCCESS:
+            raise CommandError('Cannot connect to the database')
+        totals = [0, 0, 0, 0]
+        invalid = 0
+        start = time.monotonic()
+        try:
+            records = enumerate(read_records(file, file_format), 1)
+            while True:
+                chunk = list(islice(records, options['batch_size']))
+                if not chunk:
+                    break
+                batch = []
+                for number, record in chunk:
+                    try:
+                        batch.append(parse_paper(record))
+                    except (ValueError, TypeError, AttributeError, IndexError) as e:
+                        invalid += 1
+                        self.stderr.write('Skipping record %d: %s' % (number, e))
+                if not batch:
+                    continue
+                status, counts = call_db_with_conn(conn, functions.import_papers, {
+                    'papers': batch, 'create_users': options['create_users'],
+                })
+                if status != SUCCESS:
+                    raise CommandError('Failed to import the batch ending at record %d' % number)
+                totals = [total + count for total, count in zip(totals, counts)]
+                elapsed = time.monotonic() - start
+                self.stdout.write('%d papers imported, %.0f papers/s' % (totals[0], rate(totals[0], elapsed)))
+        except json.JSONDecodeError as e:
+            raise CommandError('Invalid JSON: %s' % e)
+        finally:
+            close_db_connection(conn)
+
+        elapsed = time.monotonic() - start
+        self.stdout.write(self.style.SUCCESS(
+            'Imported %d papers, %d tags and %d likes in %.2f s (%.0f papers/s, %.0f likes/s). '
+            'Skipped %d papers by unknown users and %d invalid records.' % (
+                totals[0], totals[1], totals[2], elapsed, rate(totals[0], elapsed), rate(totals[2], elapsed),
+                totals[3], invalid)
+        ))
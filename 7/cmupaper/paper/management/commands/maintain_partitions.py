@@ -0,0 +1,36 @@
+from datetime import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.constants import PARTITION_PREMAKE_MONTHS, PARTITION_RETAIN_MONTHS, SUCCESS
+from paper.database_wrapper import call_db
+
+
+class Command(BaseCommand):
+    help = ('Create the monthly partitions of papers and likes for the coming months and archive the ones older '
+            'than the retention period. Does nothing unless the tables are partitioned. Meant to be run daily, '
+            'e.g. from cron.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--premake', type=int, default=PARTITION_PREMAKE_MONTHS,
+                            help='Number of months after the current one to create partitions for.')
+        parser.add_argument('--retain', type=int, default=PARTITION_RETAIN_MONTHS,
+                            help='Number of months before the current one to keep. Older partitions are detached '
+                                 'and moved to the archive schema. By default every month is kept.')
+        parser.add_argument('--since', type=datetime.fromisoformat,
+                            help='Also create the partitions of the months from this date on, e.g. 2024-01-01, '
+                                 'before importing older papers.')
+
+    def handle(self, *args, **options):
+        status, result = call_db(functions.maintain_partitions, {
+            'premake': options['premake'], 'retain': options['retain'], 'since': options['since'],
+        })
+        if status != SUCCESS:
+            raise CommandError('Failed to maintain the partitions')
+        created, archived = result
+        for name in created:
+            self.stdout.write('Created %s' % name)
+        for name in archived:
+            self.stdout.write('Archived %s' % name)
+        self.stdout.write(self.style.SUCCESS('Created %d and archived %d partitions' % (len(created), len(archived))))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.constants import SUCCESS
+from paper.database_wrapper import call_db
+
+
+class Command(BaseCommand):
+    help = 'Verify the per-paper like counters against the likes table and repair them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Only report the number of wrong counters. Exit with status 1 if there are any."
+        )
+
+    def handle(self, *args, **options):
+        status, count = call_db(functions.check_like_counts, {'repair': not options['check']})
+        if status != SUCCESS:
+            raise CommandError('Failed to check like counters')
+        if options['check']:
+            if count:
+                raise CommandError('%d papers have a wrong like counter' % count)
+            self.stdout.write('All like counters are consistent')
+        else:
+            self.stdout.write(self.style.SUCCESS('Repaired %d like counters' % count))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.constants import SUCCESS
+from paper.database_wrapper import call_db
+
+
+class Command(BaseCommand):
+    help = 'Verify the tag pair counts against the tags table and rebuild them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Only report the number of wrong pairs. Exit with status 1 if there are any."
+        )
+
+    def handle(self, *args, **options):
+        status, count = call_db(functions.check_tag_pair_counts, {'repair': not options['check']})
+        if status != SUCCESS:
+            raise CommandError('Failed to check tag pair counts')
+        if options['check']:
+            if count:
+                raise CommandError('%d tag pairs have a wrong count' % count)
+            self.stdout.write('All tag pair counts are consistent')
+        else:
+            self.stdout.write(self.style.SUCCESS('Repaired %d tag pair counts' % count))
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from paper import functions
+from paper.constants import SUCCESS
+from paper.database_wrapper import call_db
+
+
+class Command(BaseCommand):
+    help = 'Verify the per-user stats against the papers, likes and tags tables and rebuild them.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check', action='store_true',
+            help="Only report the number of users with wrong stats. Exit with status 1 if there are any."
+        )
+
+    def handle(self, *args, **options):
+        status, count = call_db(functions.check_user_stats, {'repair': not options['check']})
+        if status != SUCCESS:
+            raise CommandError('Failed to check user stats')
+        if options['check']:
+            if count:
+                raise CommandError('%d users have wrong stats' % count)
+            self.stdout.write('All user stats are consistent')
+        else:
+            self.stdout.write(self.style.SUCCESS('Repaired the stats of %d users' % count))
@@ -0,0 +1,107 @@
+"""
+The upkeep of the monthly partitions of papers and likes.
+
+Papers and likes of a month without a partition are rejected, so the
+partitions have to exist before the month starts. With PARTITIONED_TABLES on,
+every server process runs maintain_partitions() in a daemon thread when it
+starts and every PARTITION_MAINTENANCE_INTERVAL seconds after, which creates
+the partitions of the coming months and archives the expired ones. The runs of
+several processes wait for each other in the database. A failed run is
+retried on the next round, which is months before a missing partition
+matters.
+"""
+import threading
+from typing import Callable, Optional
+
+from .constants import *
+from .database_wrapper import call_db
+from . import functions
+
+
+def run_maintenance(call=call_db) -> tuple[int, Optional[tuple[list[str], list[str]]]]:
+    """
+    Run maintain_partitions() with the configured premake and retention
+    """
+    return call(functions.maintain_partitions, {})
+
+
+class PartitionMaintainer:
+    """
+    Run `maintain` right away and then every `interval` seconds in a daemon
+    thread, started by start()
+    """
+
+    def __init__(self, interval: float = PARTITION_MAINTENANCE_INTERVAL,
+                 maintain: Callable[[], tuple[int, Optional[tuple[list[str], list[str]]]]] = run_maintenance):
+        self.interval = interval
+        self._maintain = maintain
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {
+            'runs': 0,
+            'run_errors': 0,
+            'partitions_created': 0,
+            'partitions_archived': 0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='partition-maintenance', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def maintain(self) -> bool:
+        """
+        Maintain the partitions now. Return whether that succeeded.
+        """
+        try:
+            status, result = self._maintain()
+        except Exception:
+            status, result = DB_ERROR, None
+        with self._lock:
+            stats = self._stats
+            stats['runs'] += 1
+            if status != SUCCESS:
+                stats['run_errors'] += 1
+                return False
+            created, archived = result
+            stats['partitions_created'] += len(created)
+            stats['partitions_archived'] += len(archived)
+            return True
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+        stats['interval_s'] = self.interval
+        return stats
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self.maintain()
+            self._stopped.wait(self.interval)
+
+
+_maintainer = None
+_maintainer_lock = threading.Lock()
+
+
+def get_maintainer() -> Optional[PartitionMaintainer]:
+    """
+    Get the process-wide maintainer, starting it on first use. Return None if
+    the tables aren't partitioned.
+    """
+    global _maintainer
+    if not PARTITIONED_TABLES:
+        return None
+    if _maintainer is None:
+        with _maintainer_lock:
+            if _maintainer is None:
+                _maintainer = PartitionMaintainer()
+                _maintainer.start()
+    return _maintainer
@@ -0,0 +1,445 @@
+"""
+A bounded, thread-safe pool of long-lived database connections.
+
+Opening a postgres connection costs a TCP handshake, authentication and the
+fork of a backend process, which is far more than most of our API calls. The
+pool keeps connections open between requests and hands them out one at a time.
+
+AsyncConnectionPool does the same for asyncio connections.
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+
+import psycopg
+from psycopg.pq import TransactionStatus
+
+
+class PoolTimeout(Exception):
+    """
+    Raised when no connection becomes available within the checkout timeout.
+    """
+
+
+class PoolClosed(Exception):
+    """
+    Raised when a connection is requested from a closed pool.
+    """
+
+
+class _BasePool:
+    """
+    The settings, bookkeeping and counters shared by both pools. The methods
+    here don't lock; the pools call them under their own lock.
+    """
+
+    def __init__(self, dsn: str, min_size: int, max_size: int, timeout: float,
+                 max_idle: float, check_interval: float, connect: Callable):
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError("Invalid pool size: min_size=%d, max_size=%d" % (min_size, max_size))
+        self.dsn = dsn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.check_interval = check_interval
+        self._connect = connect
+
+        # Idle connections as (connection, time returned) pairs. Connections
+        # are reused LIFO so that the ones at the bottom can be reaped.
+        self._idle = deque()
+        # ids of connections currently checked out
+        self._used = set()
+        # Number of connections being opened outside of the lock
+        self._opening = 0
+        self._closed = False
+        self._stats = {
+            'connections_num': 0,
+            'connections_errors': 0,
+            'connections_lost': 0,
+            'connections_reaped': 0,
+            'requests_num': 0,
+            'requests_waiting': 0,
+            'requests_wait_ms': 0,
+            'requests_errors': 0,
+            'returns_bad': 0,
+        }
+
+    @property
+    def size(self) -> int:
+        """
+        Number of connections currently open, whether idle or checked out.
+        """
+        return len(self._idle) + len(self._used) + self._opening
+
+    def _reap(self) -> list:
+        """
+        Remove expired idle connections. Must be called with the lock held.
+        """
+        to_close = []
+        now = time.monotonic()
+        while self._idle and self.size > self.min_size \
+                and now - self._idle[0][1] >= self.max_idle:
+            to_close.append(self._idle.popleft()[0])
+        self._stats['connections_reaped'] += len(to_close)
+        return to_close
+
+    def _snapshot(self) -> dict:
+        stats = dict(self._stats)
+        stats['pool_min'] = self.min_size
+        stats['pool_max'] = self.max_size
+        stats['pool_size'] = self.size
+        stats['pool_available'] = len(self._idle)
+        stats['pool_used'] = len(self._used)
+        return stats
+
+
+class ConnectionPool(_BasePool):
+    """
+    A pool holding between `min_size` and `max_size` connections.
+
+    Connections are checked out with `getconn()` and given back with `putconn()`.
+    A connection that has been idle for longer than `check_interval` seconds is
+    pinged before it is handed out, and broken connections are replaced
+    transparently. Connections idle for longer than `max_idle` seconds are closed
+    as long as the pool stays at or above `min_size`.
+    """
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 5.0, max_idle: float = 300.0,
+                 check_interval: float = 30.0,
+                 connect: Callable[[str], Any] = psycopg.connect):
+        super().__init__(dsn, min_size, max_size, timeout, max_idle, check_interval, connect)
+        self._cond = threading.Condition()
+        for _ in range(min_size):
+            self._idle.append((self._new_connection(), time.monotonic()))
+
+    def getconn(self, timeout: Optional[float] = None):
+        """
+        Check out a connection, waiting at most $timeout seconds for one to
+        become available.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        with self._cond:
+            self._stats['requests_num'] += 1
+            waiting = False
+            while True:
+                if self._closed:
+                    raise PoolClosed("The connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    self._used.add(id(conn))
+                    break
+                if self.size < self.max_size:
+                    conn, returned_at = None, None
+                    self._opening += 1
+                    break
+                if not waiting:
+                    waiting = True
+                    self._stats['requests_waiting'] += 1
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._cond.wait(remaining):
+                    if self._idle or self.size < self.max_size:
+                        continue
+                    self._stats['requests_errors'] += 1
+                    raise PoolTimeout("Couldn't get a connection after %.2f sec" % timeout)
+            if waiting:
+                self._stats['requests_wait_ms'] += int((time.monotonic() - start) * 1000)
+
+        if conn is None:
+            # Open a new connection without holding the lock.
+            try:
+                conn = self._new_connection()
+            except Exception:
+                with self._cond:
+                    self._opening -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._opening -= 1
+                self._used.add(id(conn))
+            return conn
+
+        if self._is_broken(conn) or (
+                time.monotonic() - returned_at >= self.check_interval and not self._ping(conn)):
+            with self._cond:
+                self._stats['connections_lost'] += 1
+                self._used.discard(id(conn))
+                self._opening += 1
+            self._close_quietly(conn)
+            try:
+                conn = self._new_connection()
+            except Exception:
+                with self._cond:
+                    self._opening -= 1
+                    self._cond.notify()
+                raise
+            with self._cond:
+                self._opening -= 1
+                self._used.add(id(conn))
+        return conn
+
+    def putconn(self, conn, discard: bool = False) -> None:
+        """
+        Return a connection to the pool. Connections which are not checked out
+        from this pool are ignored, so it is safe to return a connection twice.
+
+        A connection left inside a transaction is rolled back. A connection which
+        is broken, or which the caller asks to $discard, is closed instead.
+        """
+        with self._cond:
+            if id(conn) not in self._used:
+                return
+        if not discard and not self._is_broken(conn):
+            try:
+                if conn.info.transaction_status != TransactionStatus.IDLE:
+                    conn.rollback()
+            except psycopg.Error:
+                discard = True
+        else:
+            discard = True
+
+        to_close = []
+        with self._cond:
+            self._used.discard(id(conn))
+            if discard or self._closed:
+                self._stats['returns_bad'] += int(discard)
+                to_close.append(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            to_close.extend(self._reap())
+            self._cond.notify()
+        for c in to_close:
+            self._close_quietly(c)
+
+    def reap(self) -> int:
+        """
+        Close connections idle for longer than `max_idle`, keeping at least
+        `min_size` connections open. Return the number of connections closed.
+        """
+        with self._cond:
+            to_close = self._reap()
+        for conn in to_close:
+            self._close_quietly(conn)
+        return len(to_close)
+
+    def get_stats(self) -> dict:
+        """
+        Return a snapshot of the pool counters and its current size.
+        """
+        with self._cond:
+            return self._snapshot()
+
+    def close(self) -> None:
+        """
+        Close all idle connections. Connections still checked out are closed
+        when they are returned.
+        """
+        with self._cond:
+            self._closed = True
+            to_close = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in to_close:
+            self._close_quietly(conn)
+
+    def _new_connection(self):
+        try:
+            conn = self._connect(self.dsn)
+        except Exception:
+            with self._cond:
+                self._stats['connections_errors'] += 1
+            raise
+        with self._cond:
+            self._stats['connections_num'] += 1
+        return conn
+
+    @staticmethod
+    def _is_broken(conn) -> bool:
+        return bool(conn.closed)
+
+    @staticmethod
+    def _ping(conn) -> bool:
+        try:
+            cursor = conn.cursor()
+            cursor.execute('SELECT 1')
+            cursor.fetchone()
+            conn.rollback()
+            return True
+        except psycopg.Error:
+            return False
+
+    @staticmethod
+    def _close_quietly(conn) -> None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+class AsyncConnectionPool(_BasePool):
+    """
+    The asyncio counterpart of ConnectionPool, holding psycopg.AsyncConnection
+    objects, with the same settings and counters.
+
+    No connection is opened up front, since a constructor can't await, so
+    `min_size` only bounds reaping. asyncio connections can't move between
+    event loops, so a pool must only be used from one loop.
+    """
+
+    def __init__(self, dsn: str, min_size: int = 1, max_size: int = 10,
+                 timeout: float = 5.0, max_idle: float = 300.0,
+                 check_interval: float = 30.0,
+                 connect: Callable[[str], Awaitable[Any]] = psycopg.AsyncConnection.connect):
+        super().__init__(dsn, min_size, max_size, timeout, max_idle, check_interval, connect)
+        self._cond = asyncio.Condition()
+
+    async def getconn(self, timeout: Optional[float] = None):
+        """
+        Check out a connection, waiting at most $timeout seconds for one to
+        become available.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        async with self._cond:
+            self._stats['requests_num'] += 1
+            waiting = False
+            while True:
+                if self._closed:
+                    raise PoolClosed("The connection pool is closed")
+                if self._idle:
+                    conn, returned_at = self._idle.pop()
+                    self._used.add(id(conn))
+                    break
+                if self.size < self.max_size:
+                    conn, returned_at = None, None
+                    self._opening += 1
+                    break
+                if not waiting:
+                    waiting = True
+                    self._stats['requests_waiting'] += 1
+                try:
+                    await asyncio.wait_for(self._cond.wait(), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    if self._idle or self.size < self.max_size:
+                        continue
+                    self._stats['requests_errors'] += 1
+                    raise PoolTimeout("Couldn't get a connection after %.2f sec" % timeout)
+            if waiting:
+                self._stats['requests_wait_ms'] += int((time.monotonic() - start) * 1000)
+
+        if conn is not None:
+            if not self._is_broken(conn) and (
+                    time.monotonic() - returned_at < self.check_interval or await self._ping(conn)):
+                return conn
+            self._stats['connections_lost'] += 1
+            self._used.discard(id(conn))
+            self._opening += 1
+            await self._close_quietly(conn)
+
+        # Open a new connection without holding the lock.
+        try:
+            conn = await self._new_connection()
+        except BaseException:
+            async with self._cond:
+                self._opening -= 1
+                self._cond.notify()
+            raise
+        self._opening -= 1
+        self._used.add(id(conn))
+        return conn
+
+    async def putconn(self, conn, discard: bool = False) -> None:
+        """
+        Return a connection to the pool, like ConnectionPool.putconn().
+        """
+        if id(conn) not in self._used:
+            return
+        if not discard and not self._is_broken(conn):
+            try:
+                if conn.info.transaction_status != TransactionStatus.IDLE:
+                    await conn.rollback()
+            except psycopg.Error:
+                discard = True
+        else:
+            discard = True
+
+        to_close = []
+        async with self._cond:
+            self._used.discard(id(conn))
+            if discard or self._closed:
+                self._stats['returns_bad'] += int(discard)
+                to_close.append(conn)
+            else:
+                self._idle.append((conn, time.monotonic()))
+            to_close.extend(self._reap())
+            self._cond.notify()
+        for c in to_close:
+            await self._close_quietly(c)
+
+    async def reap(self) -> int:
+        """
+        Close connections idle for longer than `max_idle`, keeping at least
+        `min_size` connections open. Return the number of connections closed.
+        """
+        to_close = self._reap()
+        for conn in to_close:
+            await self._close_quietly(conn)
+        return len(to_close)
+
+    def get_stats(self) -> dict:
+        """
+        Return a snapshot of the pool counters and its current size.
+        """
+        return self._snapshot()
+
+    async def close(self) -> None:
+        """
+        Close all idle connections. Connections still checked out are closed
+        when they are returned.
+        """
+        async with self._cond:
+            self._closed = True
+            to_close = [conn for conn, _ in self._idle]
+            self._idle.clear()
+            self._cond.notify_all()
+        for conn in to_close:
+            await self._close_quietly(conn)
+
+    async def _new_connection(self):
+        try:
+            conn = await self._connect(self.dsn)
+        except Exception:
+            self._stats['connections_errors'] += 1
+            raise
+        self._stats['connections_num'] += 1
+        return conn
+
+    @staticmethod
+    def _is_broken(conn) -> bool:
+        return bool(conn.closed)
+
+    @staticmethod
+    async def _ping(conn) -> bool:
+        try:
+            cursor = conn.cursor()
+            await cursor.execute('SELECT 1')
+            await cursor.fetchone()
+            await conn.rollback()
+            return True
+        except psycopg.Error:
+            return False
+
+    @staticmethod
+    async def _close_quietly(conn) -> None:
+        try:
+            await conn.close()
+        except Exception:
+            pass
@@ -0,0 +1,177 @@
+"""
+Recommendations served from an in-memory snapshot of the likes table.
+
+get_recommend_papers ranks the papers liked by co-likers, i.e. users who
+liked a paper the user liked, by how many co-likers liked them. Evaluating
+that in SQL on every home page view touches the likes of every co-liker. The
+snapshot keeps the like graph in compact arrays instead, and it is rebuilt in
+the background once it is older than RECOMMEND_MAX_AGE seconds.
+
+The snapshot only saves the round trip and the query; ranking still visits
+the likes of every co-liker. It also costs every process memory in proportion
+to the likes table, and each rebuild loads the whole table again, so it is
+off by default and suits sites whose likes fit comfortably in memory.
+"""
+import heapq
+import threading
+import time
+from array import array
+from typing import Callable, Iterable, Optional
+
+from .constants import *
+from .database_wrapper import call_db
+from . import functions
+
+
+class CoLikeGraph:
+    """
+    The bipartite graph of users and the papers they like, stored as two
+    adjacency lists in compressed sparse row form: the papers liked by user u
+    are paper_ids[user_ptr[u]:user_ptr[u + 1]] and the likers of paper p are
+    user_ids[paper_ptr[p]:paper_ptr[p + 1]].
+
+    Papers are numbered in ascending pid order, so ties between papers can be
+    broken on their numbers.
+    """
+
+    def __init__(self, likes: Iterable[tuple[int, str]]):
+        likes = list(likes)
+        self.pids = array('q', sorted({pid for pid, _ in likes}))
+        paper_index = {pid: i for i, pid in enumerate(self.pids)}
+        self._uids = {}
+        user_likes = []
+        for pid, username in likes:
+            uid = self._uids.setdefault(username, len(self._uids))
+            if uid == len(user_likes):
+                user_likes.append([])
+            user_likes[uid].append(paper_index[pid])
+
+        self.user_ptr = array('q', [0])
+        self.paper_ids = array('l')
+        paper_likes = [[] for _ in self.pids]
+        for uid, papers in enumerate(user_likes):
+            papers.sort()
+            self.paper_ids.extend(papers)
+            self.user_ptr.append(len(self.paper_ids))
+            for p in papers:
+                paper_likes[p].append(uid)
+        self.paper_ptr = array('q', [0])
+        self.user_ids = array('l')
+        for users in paper_likes:
+            self.user_ids.extend(users)
+            self.paper_ptr.append(len(self.user_ids))
+
+    def __len__(self) -> int:
+        """
+        Number of likes in the graph
+        """
+        return len(self.paper_ids)
+
+    def recommend(self, uname: str, count: int = 10) -> list[int]:
+        """
+        Return the pids of at most $count papers for user $uname, with the same
+        order as functions.get_recommend_papers: by the number of co-likers who
+        liked the paper, descending, then by pid.
+        """
+        uid = self._uids.get(uname)
+        if uid is None:
+            return []
+        mine = self.paper_ids[self.user_ptr[uid]:self.user_ptr[uid + 1]]
+        co_likers = set()
+        for p in mine:
+            co_likers.update(self.user_ids[self.paper_ptr[p]:self.paper_ptr[p + 1]])
+        mine = set(mine)
+        scores = {}
+        for v in co_likers:
+            for q in self.paper_ids[self.user_ptr[v]:self.user_ptr[v + 1]]:
+                if q not in mine:
+                    scores[q] = scores.get(q, 0) + 1
+        top = heapq.nsmallest(count, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [self.pids[p] for p, _ in top]
+
+
+def load_graph(call=call_db) -> Optional[CoLikeGraph]:
+    """
+    Build a graph from the likes table. Return None on failure.
+    """
+    status, likes = call(functions.get_like_pairs, {})
+    if status != SUCCESS:
+        return None
+    return CoLikeGraph(likes)
+
+
+class Recommender:
+    """
+    Serve recommendations from a CoLikeGraph at most `max_age` seconds old.
+
+    The first call builds the graph synchronously. Afterwards a stale graph is
+    still served while a newer one is built in a background thread.
+    """
+
+    def __init__(self, max_age: float = RECOMMEND_MAX_AGE,
+                 load: Callable[[], Optional[CoLikeGraph]] = load_graph):
+        self.max_age = max_age
+        self._load = load
+        self._graph = None
+        self._built_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()
+
+    def recommend(self, uname: str, count: int = 10) -> Optional[list[int]]:
+        """
+        Return the pids recommended to user $uname, or None if no graph could
+        be built.
+        """
+        graph = self.get_graph()
+        if graph is None:
+            return None
+        return graph.recommend(uname, count)
+
+    def get_graph(self) -> Optional[CoLikeGraph]:
+        with self._lock:
+            graph, built_at = self._graph, self._built_at
+            stale = graph is not None and time.monotonic() - built_at >= self.max_age
+            if stale and not self._refreshing:
+                self._refreshing = True
+                thread = threading.Thread(target=self._refresh_in_background, daemon=True)
+                thread.start()
+        if graph is None:
+            graph = self.refresh()
+        return graph
+
+    def refresh(self) -> Optional[CoLikeGraph]:
+        """
+        Rebuild the graph now. Keep the old graph if the rebuild fails.
+        """
+        built_at = time.monotonic()
+        graph = self._load()
+        with self._lock:
+            if graph is not None and (self._built_at is None or built_at > self._built_at):
+                self._graph, self._built_at = graph, built_at
+            return self._graph
+
+    def _refresh_in_background(self):
+        try:
+            self.refresh()
+        finally:
+            with self._lock:
+                self._refreshing = False
+
+
+_recommender = None
+_recommender_lock = threading.Lock()
+
+
+def get_recommender() -> Optional[Recommender]:
+    """
+    Get the process-wide recommender, creating it on first use. Return None if
+    recommendations are configured to come straight from SQL.
+    """
+    global _recommender
+    if RECOMMEND_MAX_AGE <= 0:
+        return None
+    if _recommender is None:
+        with _recommender_lock:
+            if _recommender is None:
+                _recommender = Recommender()
+    return _recommender
@@ -0,0 +1,227 @@
+"""
+Read/write splitting between the primary database, DB_DESC, and the replicas
+in DB_REPLICAS.
+
+The db APIs in READS only read, and tolerate data a moment old: they are sent
+to the replicas in turn. Everything else, including reads that must see the
+latest writes, such as login and the extraction status, goes to the primary.
+
+A replica that fails to give a connection or loses one is marked down and left
+out until a health check, run every DB_REPLICA_CHECK_INTERVAL seconds in a
+daemon thread, connects to it again. With no replica up, reads go to the
+primary.
+
+Replicas lag behind the primary. For DB_READ_YOUR_WRITES_WINDOW seconds after
+a user writes, the reads of that user go to the primary, so that the user
+sees their own paper or like on the next page. Only the db APIs in WRITES
+start a window, and only for a known user: the writes of the commands and the
+extraction workers don't hold reads back. The window is kept in each process;
+with several server processes, a user may briefly see an older page from
+another one.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Optional
+
+import psycopg
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+
+from .constants import *
+
+READS = frozenset({
+    'get_paper_tags', 'get_paper_author_and_tags', 'get_likes', 'get_likes_of_papers', 'get_tags_of_papers',
+    'get_timeline', 'get_timeline_all', 'get_most_popular_papers', 'get_recommend_papers', 'get_like_pairs',
+    'get_papers_by_tag', 'get_papers_by_keyword', 'get_papers_by_liked', 'get_timeline_page',
+    'get_papers_by_tag_page', 'get_papers_by_keyword_page', 'get_home_bundle', 'get_most_active_users',
+    'get_most_popular_tags', 'get_most_popular_tag_pairs', 'get_number_papers_user', 'get_number_liked_user',
+    'get_number_tags_user',
+})
+
+# The db APIs after which the reads of their user go to the primary for a while
+WRITES = frozenset({
+    'signup', 'add_new_paper', 'import_papers', 'delete_paper', 'like_paper', 'unlike_paper', 'reset_db',
+})
+
+
+def is_read(function) -> bool:
+    return function.__name__ in READS
+
+
+def is_write(function) -> bool:
+    return function.__name__ in WRITES
+
+
+def check_connection(dsn: str) -> None:
+    """
+    Connect to $dsn and run a trivial query. Raise psycopg.Error on failure.
+    """
+    with psycopg.connect(dsn, connect_timeout=max(int(DB_POOL_TIMEOUT), 1)) as conn:
+        conn.execute('SELECT 1')
+
+
+class Replica:
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.up = True
+        self.reads = 0
+        self.failures = 0
+        self.last_error = None
+
+    def describe(self) -> dict:
+        """
+        The replica and its counters, without the password of its DSN
+        """
+        params = conninfo_to_dict(self.dsn)
+        params.pop('password', None)
+        return {
+            'dsn': make_conninfo(**params),
+            'up': self.up,
+            'reads': self.reads,
+            'failures': self.failures,
+            'last_error': self.last_error,
+        }
+
+
+class Router:
+    """
+    Pick the replica for each read, in turn among those up, and keep track of
+    the users who wrote recently. Health checks run in a daemon thread started
+    by start().
+    """
+
+    def __init__(self, dsns: list[str], check_interval: float = DB_REPLICA_CHECK_INTERVAL,
+                 sticky_window: float = DB_READ_YOUR_WRITES_WINDOW,
+                 check: Callable[[str], None] = check_connection, clock: Callable[[], float] = time.monotonic):
+        self.replicas = [Replica(dsn) for dsn in dsns]
+        self.check_interval = check_interval
+        self.sticky_window = sticky_window
+        self._check = check
+        self._clock = clock
+        self._next = 0
+        # User -> end of the window, oldest first
+        self._recent_writers = OrderedDict()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {
+            'primary_reads': 0,
+            'sticky_reads': 0,
+            'writes': 0,
+        }
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='replica-checks', daemon=True)
+                self._thread.start()
+
+    def stop(self, timeout: Optional[float] = None):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def choose(self, user: Optional[str] = None) -> Optional[Replica]:
+        """
+        The replica to send a read by $user to, or None for the primary
+        """
+        with self._lock:
+            if user is not None and self._is_recent_writer(user):
+                self._stats['sticky_reads'] += 1
+                return None
+            for i in range(len(self.replicas)):
+                replica = self.replicas[(self._next + i) % len(self.replicas)]
+                if replica.up:
+                    self._next = (self._next + i + 1) % len(self.replicas)
+                    replica.reads += 1
+                    return replica
+            self._stats['primary_reads'] += 1
+            return None
+
+    def mark_down(self, replica: Replica, error: Exception):
+        """
+        Leave $replica out until a health check succeeds
+        """
+        with self._lock:
+            replica.up = False
+            replica.failures += 1
+            replica.last_error = str(error).strip() or type(error).__name__
+
+    def note_write(self, user: Optional[str]):
+        """
+        Send the reads of $user to the primary for the window
+        """
+        with self._lock:
+            self._stats['writes'] += 1
+            if user is None:
+                return
+            self._recent_writers.pop(user, None)
+            self._recent_writers[user] = self._clock() + self.sticky_window
+
+    def wrote_recently(self, user: Optional[str]) -> bool:
+        """
+        Whether $user is inside the window of a write
+        """
+        if user is None:
+            return False
+        with self._lock:
+            return self._is_recent_writer(user)
+
+    def check_replicas(self) -> int:
+        """
+        Run the health check of every replica, bringing up the ones that
+        pass and marking down the ones that fail. Return the number up.
+        """
+        for replica in self.replicas:
+            try:
+                self._check(replica.dsn)
+            except Exception as e:
+                self.mark_down(replica, e)
+            else:
+                with self._lock:
+                    replica.up = True
+        with self._lock:
+            return sum(replica.up for replica in self.replicas)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['replicas'] = [replica.describe() for replica in self.replicas]
+            stats['recent_writers'] = len(self._recent_writers)
+        stats['check_interval_s'] = self.check_interval
+        stats['sticky_window_s'] = self.sticky_window
+        return stats
+
+    def _is_recent_writer(self, user: str) -> bool:
+        now = self._clock()
+        # Windows end in the order they start, so the expired ones are first.
+        while self._recent_writers:
+            oldest, end = next(iter(self._recent_writers.items()))
+            if end > now:
+                break
+            del self._recent_writers[oldest]
+        return user in self._recent_writers
+
+    def _run(self):
+        while not self._stopped.wait(self.check_interval):
+            self.check_replicas()
+
+
+_router = None
+_router_lock = threading.Lock()
+
+
+def get_router() -> Optional[Router]:
+    """
+    Get the process-wide router, starting its health checks on first use.
+    Return None if there are no replicas.
+    """
+    global _router
+    if not DB_REPLICAS:
+        return None
+    if _router is None:
+        with _router_lock:
+            if _router is None:
+                _router = Router(DB_REPLICAS)
+                _router.start()
+    return _router
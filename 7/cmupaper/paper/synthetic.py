@@ -0,0 +1,171 @@
+"""
+Synthetic datasets for the benchmark commands.
+
+Authors, liked papers, tags and words are drawn from Zipf distributions, so
+that a few users post most papers, a few papers get most likes and a few tags
+and words are everywhere, like on the real site. A dataset is determined by
+its parameters and seed, so runs on different commits can be compared.
+"""
+import bisect
+import itertools
+import random
+from dataclasses import asdict, dataclass
+from datetime import datetime, timedelta
+from typing import Iterator, Optional
+
+from .constants import *
+from .database_wrapper import call_db_with_conn
+from . import functions
+
+
+@dataclass
+class DatasetConfig:
+    users: int = 1000
+    papers: int = 10000
+    likes: int = 100000
+    tags: int = 200
+    tags_per_paper: int = 3
+    words: int = 5000
+    words_per_paper: int = 200
+    # Exponent of the Zipf distributions
+    skew: float = 1.1
+    # Papers are posted over this many days before now
+    days: int = 30
+    seed: int = 415
+
+    @classmethod
+    def add_arguments(cls, parser):
+        """
+        Add an option for every parameter to a management command parser.
+        """
+        for name, default in asdict(cls()).items():
+            parser.add_argument('--' + name.replace('_', '-'), type=type(default), default=default,
+                                help='Dataset parameter (default: %s)' % default)
+
+    @classmethod
+    def from_options(cls, options: dict) -> 'DatasetConfig':
+        return cls(**{name: options[name] for name in asdict(cls())})
+
+
+class ZipfSampler:
+    """
+    Draw ranks 0..n-1 with probability proportional to 1 / (rank + 1) ** skew.
+    """
+
+    def __init__(self, n: int, skew: float, rng: random.Random):
+        self._cum_weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(n)))
+        self._rng = rng
+
+    def sample(self, rng: Optional[random.Random] = None) -> int:
+        x = (rng or self._rng).random() * self._cum_weights[-1]
+        return bisect.bisect_right(self._cum_weights, x, hi=len(self._cum_weights) - 1)
+
+    def sample_distinct(self, k: int) -> list[int]:
+        """
+        Draw up to $k distinct ranks, giving up after a few collisions.
+        """
+        ranks = []
+        for _ in range(k * 4):
+            rank = self.sample()
+            if rank not in ranks:
+                ranks.append(rank)
+                if len(ranks) == k:
+                    break
+        return ranks
+
+
+class SyntheticDataset:
+    """
+    The users, tags, words and papers of a dataset. Popularity ranks are
+    shuffled, so the most liked papers aren't simply the oldest ones.
+    """
+
+    def __init__(self, config: DatasetConfig):
+        self.config = config
+        self.usernames = ['user%d' % i for i in range(config.users)]
+        self.tagnames = ['tag%d' % i for i in range(config.tags)]
+        self.words = ['word%d' % i for i in range(config.words)]
+        self._rng = random.Random(config.seed)
+        self.user_sampler = ZipfSampler(config.users, config.skew, self._rng)
+        self.tag_sampler = ZipfSampler(config.tags, config.skew, self._rng)
+        self.word_sampler = ZipfSampler(config.words, config.skew, self._rng)
+        self._author_of_rank = self._rng.sample(self.usernames, len(self.usernames))
+
+    # Workloads pass their own $rng, so that they don't change the dataset.
+
+    def random_user(self, rng: Optional[random.Random] = None) -> str:
+        return self._author_of_rank[self.user_sampler.sample(rng)]
+
+    def random_tag(self, rng: Optional[random.Random] = None) -> str:
+        return self.tagnames[self.tag_sampler.sample(rng)]
+
+    def random_word(self, rng: Optional[random.Random] = None) -> str:
+        return self.words[self.word_sampler.sample(rng)]
+
+    def papers(self, now: Optional[datetime] = None) -> Iterator[dict]:
+        """
+        Generate the papers in the form taken by functions.import_papers, posted
+        over the days before $now.
+        """
+        config = self.config
+        rng = self._rng
+        # Spread the likes over the papers, then give every paper that many
+        # distinct likers.
+        paper_sampler = ZipfSampler(config.papers, config.skew, rng)
+        paper_of_rank = rng.sample(range(config.papers), config.papers)
+        like_counts = [0] * config.papers
+        for _ in range(config.likes):
+            like_counts[paper_of_rank[paper_sampler.sample()]] += 1
+
+        now = now or datetime.now()
+        start = now - timedelta(days=config.days)
+        for i in range(config.papers):
+            begin_time = start + (now - start) * (i / max(config.papers, 1))
+            likers = rng.sample(self.usernames, min(like_counts[i], len(self.usernames)))
+            yield {
+                'username': self.random_user(),
+                'title': 'paper %d %s' % (i, self.random_word()),
+                'description': ' '.join(self.random_word() for _ in range(10)),
+                'data': ' '.join(self.random_word() for _ in range(config.words_per_paper)),
+                'begin_time': begin_time,
+                'tags': [self.tagnames[rank] for rank in self.tag_sampler.sample_distinct(config.tags_per_paper)],
+                'likes': [(liker, begin_time + timedelta(minutes=rng.randrange(60 * 24))) for liker in likers],
+            }
+
+
+def load_dataset(conn, dataset: SyntheticDataset, batch_size: int = 1000, progress=None) -> tuple[int, int, int]:
+    """
+    Reset the database behind $conn and fill it with $dataset. Call
+    $progress with the number of papers loaded after every batch. Return the
+    number of papers, tags and likes loaded.
+    """
+    status, _ = call_db_with_conn(conn, functions.reset_db, {})
+    if status != SUCCESS:
+        raise RuntimeError('Failed to reset the database')
+    # The partitions of the days the papers are posted over, if partitioned
+    status, _ = call_db_with_conn(conn, functions.maintain_partitions, {
+        'since': datetime.now() - timedelta(days=dataset.config.days)})
+    if status != SUCCESS:
+        raise RuntimeError('Failed to create the partitions')
+    for username in dataset.usernames:
+        status, _ = call_db_with_conn(conn, functions.signup, {'uname': username, 'pwd': username})
+        if status != SUCCESS:
+            raise RuntimeError('Failed to sign up %s' % username)
+
+    totals = [0, 0, 0]
+    papers = dataset.papers()
+    while True:
+        batch = list(itertools.islice(papers, batch_size))
+        if not batch:
+            break
+        status, counts = call_db_with_conn(conn, functions.import_papers, {'papers': batch})
+        if status != SUCCESS:
+            raise RuntimeError('Failed to import papers')
+        totals = [total + count for total, count in zip(totals, counts)]
+        if progress is not None:
+            progress(totals[0])
+    # Give the planner statistics of the new data, and set the visibility map
+    # so that covering indexes are scanned without visiting the table.
+    with functions._autocommit(conn):
+        conn.cursor().execute('VACUUM ANALYZE')
+    return totals[0], totals[1], totals[2]
@@ -1,22 +1,53 @@
+import asyncio
+import base64
+import json
+import os
+import random
+import re
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from typing import Optional
+from unittest import mock
 
 import psycopg
-from django.test import TransactionTestCase
+from psycopg.pq import TransactionStatus
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TransactionTestCase, override_settings
 from django.conf import settings
+from django.core.cache import caches
+from django.urls import reverse
 from django.utils import timezone
 
-from paper import functions, models
+from paper import async_functions, database_wrapper, functions, instrumentation, models, views
+from paper.advisor import IndexSuggestion, covering_index, suggest_index
+from paper.benchmark import summarize
+from paper.cache import Cache, LocalCache
+from paper.database_wrapper import call_db, call_db_with_conn, close_async_pool, close_db_connection, connect, \
+    connect_async, get_db_connection
+from paper.extraction import ExtractionPool
+from paper.global_stats import Snapshot, StatsRefresher, load_snapshot
+from paper.management.commands.bench_functions import Command as BenchFunctionsCommand, describe_plan
+from paper.middleware import QueryInstrumentationMiddleware
+from paper.partitions import PartitionMaintainer
+from paper.pool import AsyncConnectionPool, ConnectionPool, PoolTimeout
+from paper.recommend import CoLikeGraph, Recommender
+from paper.routing import Router, check_connection
+from paper.synthetic import DatasetConfig, SyntheticDataset
 
 
 class DbApiTestCase(TransactionTestCase):
+    partitioned = False
+    """Whether reset_db creates partitioned papers and likes"""
     _conn: Optional[psycopg.Connection[tuple]] = None
     _uploader: Optional[models.User] = None
     _paper: Optional[models.Paper] = None
 
     @classmethod
     def setUpClass(cls):
-        cls._conn = psycopg.connect('dbname=' + settings.DATABASES['default']['NAME'])
-        functions.reset_db(cls._conn)
+        cls._conn = connect('dbname=' + settings.DATABASES['default']['NAME'], generic_plans=cls.partitioned)
+        functions.reset_db(cls._conn, partitioned=cls.partitioned)
 
         cls._uploader = models.User(username='uploader', password='uploader')
         cls._paper = models.Paper(
@@ -41,7 +72,8 @@ class DbApiEmptyTableTestCase(DbApiTestCase):
     correctness?
     """
     def tearDown(self):
-        self._conn.cursor().execute('TRUNCATE tags, tagnames, likes, papers, users')
+        self._conn.cursor().execute('TRUNCATE extractions, user_tag_counts, user_stats, tag_pair_counts, tags, '
+                                     'tagnames, likes, papers, users')
         self._conn.commit()
         super().tearDown()
 
@@ -155,6 +187,19 @@ class DbApiEmptyTableTestCase(DbApiTestCase):
         for tag in models.TagName.objects.all():
             self.assertIn(tag.tagname, test_paper['tags'])
 
+        # Tags given twice are added once, next to existing and new tag names.
+        return_status, paper_id = functions.add_new_paper(
+            self._conn, test_user_name, 'A Paper with Repeated Tags', None, None, ('mmap', 'os', 'mmap')
+        )
+        self.assertEqual(return_status, 0)
+        self.assertEqual(functions.get_paper_tags(self._conn, paper_id), (0, ['mmap', 'os']))
+        self.assertEqual(functions.check_tag_pair_counts(self._conn), (0, 0))
+
+        # Nothing is left behind by a paper of an unknown user.
+        assert_insertion_fail(functions.add_new_paper(self._conn, 'nobody', 'A Paper', None, None, ('new tag',)))
+        self.assertEqual(models.Paper.objects.count(), 3)
+        self.assertFalse(models.TagName.objects.filter(tagname='new tag').exists())
+
     def test_deleting_paper(self):
         # Delete a paper that doesn't exist.
         self.assertEqual(functions.delete_paper(self._conn, 100)[0], 1)
@@ -228,6 +273,328 @@ class DbApiEmptyTableTestCase(DbApiTestCase):
         self.assertEqual(functions.unlike_paper(self._conn, liker.username, self._paper.pid)[0], 0)
         self.assertEqual(models.Like.objects.count(), 0)
 
+    def test_checking_like_counts(self):
+        self._uploader.save()
+        self._paper.save()
+        liker = models.User.objects.create(username='liker', password='liker')
+        self.assertEqual(functions.like_paper(self._conn, liker.username, self._paper.pid)[0], 0)
+        self.assertEqual(functions.get_likes(self._conn, self._paper.pid), (0, 1))
+        self.assertEqual(functions.check_like_counts(self._conn), (0, 0))
+
+        # Likes removed behind the trigger's back leave a stale counter.
+        cursor = self._conn.cursor()
+        cursor.execute('TRUNCATE likes')
+        self._conn.commit()
+        self.assertEqual(functions.check_like_counts(self._conn), (0, 1))
+        self.assertEqual(functions.check_like_counts(self._conn, repair=True), (0, 1))
+        self.assertEqual(functions.check_like_counts(self._conn), (0, 0))
+        self.assertEqual(functions.get_likes(self._conn, self._paper.pid), (0, 0))
+
+    def test_maintaining_tag_pair_counts(self):
+        self._uploader.save()
+        uname = self._uploader.username
+        status, first = functions.add_new_paper(self._conn, uname, 'first', None, None, ('a', 'b', 'c'))
+        self.assertEqual(status, 0)
+        status, second = functions.add_new_paper(self._conn, uname, 'second', None, None, ('b', 'c'))
+        self.assertEqual(status, 0)
+        self.assertEqual(
+            functions.get_most_popular_tag_pairs(self._conn, count=5),
+            (0, [('b', 'c', 2), ('a', 'b', 1), ('a', 'c', 1)])
+        )
+
+        # Tags changed outside of the APIs are counted as well.
+        cursor = self._conn.cursor()
+        cursor.execute("DELETE FROM tags WHERE pid = %s AND tagname = 'a'", (first,))
+        cursor.execute("UPDATE tags SET tagname = 'a' WHERE pid = %s AND tagname = 'c'", (second,))
+        self._conn.commit()
+        self.assertEqual(
+            functions.get_most_popular_tag_pairs(self._conn, count=5),
+            (0, [('a', 'b', 1), ('b', 'c', 1)])
+        )
+
+        self.assertEqual(functions.delete_paper(self._conn, first)[0], 0)
+        self.assertEqual(functions.get_most_popular_tag_pairs(self._conn, count=5), (0, [('a', 'b', 1)]))
+        self.assertEqual(functions.check_tag_pair_counts(self._conn), (0, 0))
+
+        cursor.execute('TRUNCATE tag_pair_counts')
+        self._conn.commit()
+        self.assertEqual(functions.check_tag_pair_counts(self._conn), (0, 1))
+        self.assertEqual(functions.check_tag_pair_counts(self._conn, repair=True), (0, 1))
+        self.assertEqual(functions.get_most_popular_tag_pairs(self._conn, count=5), (0, [('a', 'b', 1)]))
+
+    def test_maintaining_user_stats(self):
+        self._uploader.save()
+        uname = self._uploader.username
+        liker = models.User.objects.create(username='liker', password='liker')
+        status, first = functions.add_new_paper(self._conn, uname, 'first', None, None, ('a', 'b', 'c'))
+        self.assertEqual(status, 0)
+        status, second = functions.add_new_paper(self._conn, uname, 'second', None, None, ('b', 'd'))
+        self.assertEqual(status, 0)
+        self.assertEqual(functions.add_new_paper(self._conn, liker.username, 'third', None, None, ('a',))[0], 0)
+        self.assertEqual(functions.like_paper(self._conn, liker.username, first)[0], 0)
+        self.assertEqual(functions.like_paper(self._conn, liker.username, second)[0], 0)
+
+        def stats(username):
+            return tuple(function(self._conn, username)[1] for function in (
+                functions.get_number_papers_user, functions.get_number_liked_user, functions.get_number_tags_user))
+
+        self.assertEqual(stats(uname), (2, 0, 4))
+        self.assertEqual(stats(liker.username), (1, 2, 1))
+        self.assertEqual(stats('nobody'), (0, 0, 0))
+        self.assertEqual(functions.get_most_active_users(self._conn, count=5), (0, [uname, liker.username]))
+
+        # A tag used by another paper of the user still counts.
+        self.assertEqual(functions.delete_paper(self._conn, second)[0], 0)
+        self.assertEqual(stats(uname), (1, 0, 3))
+        self.assertEqual(stats(liker.username), (1, 1, 1))
+        self.assertEqual(functions.unlike_paper(self._conn, liker.username, first)[0], 0)
+        self.assertEqual(stats(liker.username), (1, 0, 1))
+
+        # Tags changed outside of the APIs are counted as well.
+        cursor = self._conn.cursor()
+        cursor.execute("UPDATE tags SET tagname = 'd' WHERE pid = %s AND tagname = 'c'", (first,))
+        cursor.execute("INSERT INTO tagnames (tagname) VALUES ('e')")
+        cursor.execute("INSERT INTO tags (pid, tagname) VALUES (%s, 'e')", (first,))
+        cursor.execute("DELETE FROM tagnames WHERE tagname = 'b'")
+        self._conn.commit()
+        self.assertEqual(stats(uname), (1, 0, 3))
+        self.assertEqual(functions.check_user_stats(self._conn), (0, 0))
+
+        models.User.objects.create(username='idle', password='idle')
+        self.assertEqual(functions.get_most_active_users(self._conn, count=5), (0, [liker.username, uname]))
+
+        # Likes removed behind the triggers' back leave stale stats, and so
+        # does a missing row.
+        self.assertEqual(functions.like_paper(self._conn, liker.username, first)[0], 0)
+        cursor.execute('TRUNCATE likes')
+        cursor.execute("DELETE FROM user_stats WHERE username = 'idle'")
+        self._conn.commit()
+        self.assertEqual(functions.check_user_stats(self._conn), (0, 2))
+        self.assertEqual(functions.check_user_stats(self._conn, repair=True), (0, 2))
+        self.assertEqual(functions.check_user_stats(self._conn), (0, 0))
+        self.assertEqual(stats(liker.username), (1, 0, 1))
+
+    def test_co_like_graph_parity(self):
+        """Recommendations from the like graph are ordered exactly like the SQL ones, ties included."""
+        rng = random.Random(415)
+        self._uploader.save()
+        users = [models.User.objects.create(username='user%d' % i, password='user') for i in range(8)]
+        papers = [
+            models.Paper.objects.create(username=self._uploader, title=str(i), begin_time=timezone.now())
+            for i in range(15)
+        ]
+        for user in users:
+            for paper in rng.sample(papers, rng.randrange(6)):
+                models.Like.objects.create(pid=paper, username=user, like_time=timezone.now())
+
+        graph = CoLikeGraph(functions.get_like_pairs(self._conn)[1])
+        for user in users:
+            papers = functions.get_recommend_papers(self._conn, user.username, count=20)[1]
+            self.assertEqual(graph.recommend(user.username, 20), [paper[0] for paper in papers])
+
+    def test_caching_timeline(self):
+        self._uploader.save()
+        cache = Cache(LocalCache())
+        with mock.patch('paper.database_wrapper.get_cache', return_value=cache):
+            self.assertEqual(call_db_with_conn(self._conn, functions.get_timeline_all, {}), (0, []))
+            status, pid = call_db_with_conn(self._conn, functions.add_new_paper, {
+                'uname': self._uploader.username, 'title': 'new', 'desc': None, 'text': None, 'tags': ['tag'],
+            })
+            self.assertEqual(status, 0)
+            timeline = call_db_with_conn(self._conn, functions.get_timeline_all, {})
+            self.assertEqual([paper[0] for paper in timeline[1]], [pid])
+            self.assertEqual(call_db_with_conn(self._conn, functions.get_timeline_all, {}), timeline)
+            self.assertEqual(call_db_with_conn(self._conn, functions.delete_paper, {'pid': pid})[0], 0)
+            self.assertEqual(call_db_with_conn(self._conn, functions.get_timeline_all, {}), (0, []))
+        self.assertEqual(cache.get_stats()['get_timeline_all'], {'hits': 1, 'misses': 3})
+
+    def test_importing_papers(self):
+        self._uploader.save()
+        models.User.objects.create(username='liker', password='liker')
+        papers = [
+            {'username': self._uploader.username, 'title': 'first', 'tags': ['a', 'b', 'a'],
+             'likes': [('liker', None), ('liker', None), (self._uploader.username, None), ('nobody', None)]},
+            {'username': 'nobody', 'title': 'skipped', 'tags': ['c'], 'likes': [('liker', None)]},
+            {'username': self._uploader.username, 'title': 'second', 'description': 'text',
+             'begin_time': datetime(2017, 1, 1), 'data': 'some, "quoted"\ndata'},
+        ]
+        self.assertEqual(functions.import_papers(self._conn, papers), (0, (2, 2, 1, 1)))
+        first, second = models.Paper.objects.order_by('pid')
+        self.assertEqual(first.title, 'first')
+        self.assertEqual(functions.get_paper_tags(self._conn, first.pid), (0, ['a', 'b']))
+        self.assertEqual(functions.get_likes(self._conn, first.pid), (0, 1))
+        self.assertEqual(second.data, 'some, "quoted"\ndata')
+        self.assertEqual(second.begin_time.replace(tzinfo=None), datetime(2017, 1, 1))
+        self.assertEqual(functions.check_like_counts(self._conn), (0, 0))
+        self.assertEqual(functions.get_most_popular_tag_pairs(self._conn, count=5), (0, [('a', 'b', 1)]))
+        # Staging tables are emptied by the commit.
+        self.assertEqual(functions.import_papers(self._conn, []), (0, (0, 0, 0, 0)))
+
+        self.assertEqual(functions.import_papers(self._conn, papers[1:2], create_users=True), (0, (1, 1, 1, 0)))
+        self.assertTrue(models.User.objects.filter(username='nobody').exists())
+
+    def test_most_popular_papers_across_days(self):
+        """The per-day leaderboard gives the same order as ranking all papers in the window."""
+        self._uploader.save()
+        likers = [
+            models.User.objects.create(username='liker%d' % i, password='liker')
+            for i in range(5)
+        ]
+        now = timezone.now()
+        papers = []
+        for i in range(12):
+            paper = models.Paper.objects.create(
+                title=str(i),
+                username=self._uploader,
+                begin_time=now - timedelta(days=i // 3, hours=i % 3)
+            )
+            papers.append(paper)
+            for liker in likers[:(i * 7) % 6]:
+                models.Like.objects.create(pid=paper, username=liker, like_time=now)
+
+        for days, count in ((0.5, 10), (2, 3), (3, 10), (10, 4)):
+            begin_time = (now - timedelta(days=days)).replace(tzinfo=None)
+            expected = sorted(
+                (p for p in papers if p.begin_time.replace(tzinfo=None) > begin_time and p.like_set.count()),
+                key=lambda p: (-p.like_set.count(), p.pid)
+            )[:count]
+            return_status, returned_papers = functions.get_most_popular_papers(
+                self._conn, begin_time=begin_time, count=count
+            )
+            self.assertEqual(return_status, 0)
+            self.assertEqual([paper[0] for paper in returned_papers], [p.pid for p in expected])
+
+    def test_paging(self):
+        """Walking all pages yields the same papers as one big listing."""
+        self._uploader.save()
+        now = timezone.now()
+        tag = models.TagName.objects.create(tagname='tag')
+        for i in range(11):
+            paper = models.Paper.objects.create(
+                title='paper %d' % i,
+                username=self._uploader,
+                description='database ' * (i % 4 + 1),
+                # Several papers share a begin_time, so ties must be broken by pid.
+                begin_time=now - timedelta(minutes=i // 3)
+            )
+            models.Tag.objects.create(pid=paper, tagname=tag)
+
+        def walk(function, **kwargs):
+            papers = []
+            cursor = None
+            while True:
+                return_status, (page, cursor) = function(self._conn, count=3, cursor=cursor, **kwargs)
+                self.assertEqual(return_status, 0)
+                self.assertLessEqual(len(page), 3)
+                papers.extend(page)
+                if cursor is None:
+                    return papers
+
+        uname = self._uploader.username
+        self.assertEqual(
+            walk(functions.get_timeline_page, uname=uname),
+            functions.get_timeline(self._conn, uname, count=100)[1]
+        )
+        self.assertEqual(
+            walk(functions.get_papers_by_tag_page, tag=tag.tagname),
+            functions.get_papers_by_tag(self._conn, tag.tagname, count=100)[1]
+        )
+        self.assertEqual(
+            walk(functions.get_papers_by_keyword_page, keyword='database'),
+            functions.get_papers_by_keyword(self._conn, 'database', count=100)[1]
+        )
+
+        # Papers mentioning the keyword more often rank higher.
+        ranked = walk(functions.get_papers_by_keyword_page, keyword='database', ranked=True)
+        self.assertEqual(len(ranked), 11)
+        self.assertEqual([paper[2] for paper in ranked[:2]], ['paper 3', 'paper 7'])
+
+        # Cursors are only valid for the ordering they were made for.
+        cursor = functions.get_papers_by_keyword_page(self._conn, 'database', count=3)[1][1]
+        self.assertEqual(
+            functions.get_papers_by_keyword_page(self._conn, 'database', count=3, cursor=cursor, ranked=True),
+            (1, None)
+        )
+        self.assertEqual(functions.get_timeline_page(self._conn, uname, cursor='garbage'), (1, None))
+        # So are cursors whose values have the wrong type.
+        for key, value in (('begin_time', 5), ('relevance', '2024-01-01')):
+            cursor = base64.urlsafe_b64encode(json.dumps([key, value, 1]).encode()).decode()
+            with self.assertRaises(ValueError):
+                functions._page_seek(cursor, key)
+
+    def test_extraction_status(self):
+        self.assertEqual(functions.get_extraction_status(self._conn, 100), (1, None))
+        self._uploader.save()
+        self._paper.save()
+        pid = self._paper.pid
+        # Papers added with their text need no extraction.
+        self.assertEqual(functions.get_extraction_status(self._conn, pid), (0, ('done', 0, None)))
+
+        self.assertEqual(functions.queue_extraction(self._conn, pid), (0, None))
+        self.assertEqual(functions.get_extraction_status(self._conn, pid), (0, ('pending', 0, None)))
+        self.assertEqual(functions.get_pending_extractions(self._conn), (0, [pid]))
+
+        self.assertEqual(functions.record_extraction_failure(self._conn, pid, 'oops', False), (0, None))
+        self.assertEqual(functions.get_extraction_status(self._conn, pid), (0, ('pending', 1, 'oops')))
+        self.assertEqual(functions.record_extraction_failure(self._conn, pid, 'oops again', True), (0, None))
+        self.assertEqual(functions.get_extraction_status(self._conn, pid), (0, ('failed', 2, 'oops again')))
+        self.assertEqual(functions.get_pending_extractions(self._conn), (0, []))
+        self.assertEqual(functions.get_pending_extractions(self._conn, include_failed=True), (0, [pid]))
+
+        self.assertEqual(functions.save_extracted_text(self._conn, pid, 'pineapple'), (0, None))
+        self.assertEqual(functions.get_extraction_status(self._conn, pid), (0, ('done', 3, None)))
+        self.assertEqual(functions.get_papers_by_keyword(self._conn, 'pineapple')[1][0][0], pid)
+
+        # The paper is gone by the time its text is ready.
+        self.assertEqual(functions.save_extracted_text(self._conn, 100, 'text'), (1, None))
+
+        # Papers added without their text are queued by the same statement.
+        status, pid = functions.add_new_paper(self._conn, self._uploader.username, 'title', None, None, ['a'])
+        self.assertEqual(status, 0)
+        self.assertEqual(functions.get_extraction_status(self._conn, pid), (0, ('pending', 0, None)))
+        self.assertEqual(functions.get_pending_extractions(self._conn), (0, [pid]))
+        # Papers without text that were never queued haven't been extracted.
+        paper = models.Paper.objects.create(title='no text', username=self._uploader, begin_time=timezone.now())
+        self.assertEqual(functions.get_extraction_status(self._conn, paper.pid),
+                         (0, ('failed', 0, 'Never queued for extraction')))
+
+    def test_extraction_pool(self):
+        self._uploader.save()
+        papers = [
+            models.Paper.objects.create(title=str(i), username=self._uploader, begin_time=timezone.now())
+            for i in range(3)
+        ]
+        attempts = {}
+
+        def extract(path):
+            attempts[path] = attempts.get(path, 0) + 1
+            # The first paper only extracts on the second attempt, the second never does.
+            if path == '0' and attempts[path] == 1 or path == '1':
+                raise IOError('cannot read ' + path)
+            return 'text of ' + path
+
+        pool = ExtractionPool(
+            queue_size=2, max_attempts=2, retry_delay=0, extract=extract,
+            executor=ThreadPoolExecutor(1),
+            call=lambda function, argdict: function(self._conn, **argdict)
+        )
+        for paper in papers[:2]:
+            functions.queue_extraction(self._conn, paper.pid)
+        self.assertTrue(pool.submit(papers[0].pid, '0'))
+        self.assertTrue(pool.submit(papers[1].pid, '1'))
+        # The queue is full.
+        self.assertFalse(pool.submit(papers[2].pid, '2'))
+
+        self.assertTrue(pool.join(timeout=10))
+        pool.shutdown()
+
+        self.assertEqual(functions.get_extraction_status(self._conn, papers[0].pid), (0, ('done', 2, None)))
+        self.assertEqual(
+            functions.get_extraction_status(self._conn, papers[1].pid),
+            (0, ('failed', 2, 'OSError: cannot read 1'))
+        )
+        self.assertEqual(models.Paper.objects.get(pid=papers[0].pid).data, 'text of 0')
+
     def test_statistics(self):
         """Test stats-related APIs on empty tables."""
         self._uploader.save()
@@ -246,6 +613,118 @@ class DbApiEmptyTableTestCase(DbApiTestCase):
         self.assertEqual(functions.get_papers_by_tag(self._conn, test_tag.tagname), (0, []))
 
 
+class PartitionedDbApiEmptyTableTestCase(DbApiEmptyTableTestCase):
+    """The same tests on papers and likes partitioned by month."""
+    partitioned = True
+
+    def test_importing_papers(self):
+        # Papers of months without a partition are rejected, so the ones of
+        # 2017 need one first.
+        self.assertEqual(functions.maintain_partitions(self._conn, since=datetime(2017, 1, 1))[0], 0)
+        super().test_importing_papers()
+
+    def test_plan_cache_mode(self):
+        cursor = self._conn.cursor()
+        cursor.execute('SHOW plan_cache_mode')
+        self.assertEqual(cursor.fetchone(), ('force_generic_plan',))
+        # The setting is the connection's, not the database's.
+        cursor.execute("SELECT setconfig FROM pg_db_role_setting "
+                       "WHERE setdatabase = (SELECT oid FROM pg_database WHERE datname = current_database())")
+        self.assertFalse(any('plan_cache_mode' in setting for config, in cursor.fetchall() for setting in config))
+        self._conn.commit()
+
+    def test_checking_tags(self):
+        self._uploader.save()
+        status, pid = functions.add_new_paper(self._conn, self._uploader.username, 'title', 'desc', 'text', ['a'])
+        self.assertEqual(status, 0)
+        cursor = self._conn.cursor()
+        # Tags can only refer to existing papers, like with a foreign key.
+        with self.assertRaises(psycopg.errors.ForeignKeyViolation):
+            cursor.execute("INSERT INTO tags (pid, tagname) VALUES (%s, 'a')", (pid + 1,))
+        self._conn.rollback()
+
+    def test_maintaining_in_background(self):
+        this_month = functions._month_start(datetime.now())
+        maintainer = PartitionMaintainer(
+            interval=60, maintain=lambda: functions.maintain_partitions(self._conn, premake=4))
+        maintainer.start()
+        try:
+            for _ in range(100):
+                if maintainer.get_stats()['runs']:
+                    break
+                time.sleep(0.01)
+        finally:
+            maintainer.stop()
+        stats = maintainer.get_stats()
+        self.assertEqual((stats['runs'], stats['run_errors'], stats['partitions_archived']), (1, 0, 0))
+        # Months 3 and 4 from now are new, the earlier ones came with reset_db.
+        self.assertEqual(stats['partitions_created'], 4)
+        cursor = self._conn.cursor()
+        cursor.execute('SELECT to_regclass(%s) IS NOT NULL',
+                       (functions._partition_name('likes', functions._add_months(this_month, 4)),))
+        self.assertTrue(cursor.fetchone()[0])
+        self._conn.commit()
+
+    def test_maintaining_partitions(self):
+        self._uploader.save()
+        uname = self._uploader.username
+        liker = models.User.objects.create(username='liker', password='liker')
+        early_liker = models.User.objects.create(username='early', password='early')
+        now = datetime(2024, 6, 15)
+        status, (created, archived) = functions.maintain_partitions(
+            self._conn, premake=1, since=datetime(2024, 1, 20), now=now)
+        self.assertEqual(status, 0)
+        self.assertEqual(archived, [])
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT to_regclass('papers_p202401') IS NOT NULL, to_regclass('likes_p202407') IS NOT NULL")
+        self.assertEqual(cursor.fetchone(), (True, True))
+        self._conn.commit()
+
+        papers = [
+            {'username': uname, 'title': str(month), 'begin_time': datetime(2024, month, 3),
+             'tags': ['a', 'b%d' % month], 'likes': [(liker.username, like_time)]}
+            for month, like_time in ((1, datetime(2024, 1, 5)), (2, None), (5, datetime(2024, 5, 5)))
+        ]
+        # A like older than its paper, in a month that is archived below
+        papers[2]['likes'].append((early_liker.username, datetime(2024, 2, 5)))
+        self.assertEqual(functions.import_papers(self._conn, papers), (0, (3, 6, 4, 0)))
+        pids = [pid for pid, *_ in reversed(functions.get_timeline_all(self._conn)[1])]
+        # Liked again, and liking a paper that doesn't exist
+        self.assertEqual(functions.like_paper(self._conn, liker.username, pids[0])[0], 1)
+        self.assertEqual(functions.like_paper(self._conn, liker.username, max(pids) + 1)[0], 1)
+
+        # January and February are archived, with the like of February that
+        # is in the partition of the current month.
+        status, (created, archived) = functions.maintain_partitions(self._conn, premake=1, retain=3, now=now)
+        self.assertEqual(status, 0)
+        self.assertEqual(created, [])
+        self.assertLessEqual({'likes_p202401', 'likes_p202402', 'papers_p202401', 'papers_p202402'}, set(archived))
+        self.assertNotIn('papers_p202403', archived)
+        # The rows of the archived papers are kept along with them.
+        cursor.execute(
+            "SELECT relname FROM pg_class WHERE relnamespace = 'archive'::regnamespace AND relkind = 'r' "
+            "AND relname NOT LIKE ALL('{tags_%, extractions_%, paper_likes_%}')")
+        self.assertEqual(sorted(name for name, in cursor.fetchall()), sorted(archived))
+        cursor.execute('SELECT pid, tagname FROM archive.tags_p202401 UNION ALL '
+                       'SELECT pid, tagname FROM archive.tags_p202402 ORDER BY pid, tagname')
+        self.assertEqual(cursor.fetchall(), [(pids[0], 'a'), (pids[0], 'b1'), (pids[1], 'a'), (pids[1], 'b2')])
+        cursor.execute('SELECT pid FROM archive.paper_likes_p202402 UNION ALL SELECT pid FROM archive.likes_p202401')
+        self.assertEqual(cursor.fetchall(), [(pids[1],), (pids[0],)])
+        cursor.execute('SELECT pid, username FROM archive.likes_p202402')
+        self.assertEqual(cursor.fetchall(), [(pids[2], early_liker.username)])
+        self._conn.commit()
+
+        self.assertEqual([paper[0] for paper in functions.get_timeline_all(self._conn)[1]], [pids[2]])
+        self.assertEqual(functions.get_number_papers_user(self._conn, uname), (0, 1))
+        self.assertEqual(functions.get_number_tags_user(self._conn, uname), (0, 2))
+        self.assertEqual(functions.get_number_liked_user(self._conn, liker.username), (0, 1))
+        self.assertEqual(functions.get_number_liked_user(self._conn, early_liker.username), (0, 0))
+        self.assertEqual(functions.get_most_popular_tag_pairs(self._conn, count=5), (0, [('a', 'b5', 1)]))
+        self.assertEqual(functions.check_user_stats(self._conn), (0, 0))
+        self.assertEqual(functions.check_like_counts(self._conn), (0, 0))
+        self.assertEqual(functions.check_tag_pair_counts(self._conn), (0, 0))
+
+
 class DbApiAnalyticsTestCase(DbApiTestCase):
     """Test (read-only) analytics APIs."""
     _papers = None
@@ -304,6 +783,24 @@ class DbApiAnalyticsTestCase(DbApiTestCase):
 
     def test_get_likes(self):
         self.assertEqual(functions.get_likes(self._conn, self._papers[0].pid), (0, 3))
+        self.assertEqual(functions.check_like_counts(self._conn), (0, 0))
+
+    def test_get_likes_of_papers(self):
+        pids = [paper.pid for paper in self._papers] + [self._paper.pid]
+        self.assertEqual(
+            functions.get_likes_of_papers(self._conn, pids),
+            (0, dict(zip(pids, (3, 2, 1, 2, 0))))
+        )
+        self.assertEqual(functions.get_likes_of_papers(self._conn, []), (0, {}))
+
+    def test_get_tags_of_papers(self):
+        pids = [paper.pid for paper in self._papers] + [self._paper.pid]
+        # Tags of each paper are sorted as in get_paper_tags().
+        self.assertEqual(
+            functions.get_tags_of_papers(self._conn, pids),
+            (0, {pid: functions.get_paper_tags(self._conn, pid)[1] for pid in pids})
+        )
+        self.assertEqual(functions.get_tags_of_papers(self._conn, [pids[1]])[1][pids[1]], ['0', '1', '2'])
 
     def test_timeline(self):
         return_status, returned_papers = functions.get_timeline(
@@ -357,6 +854,35 @@ class DbApiAnalyticsTestCase(DbApiTestCase):
         self.assertEqual(returned_papers[1][2], self._papers[1].title)
         self.assertEqual(returned_papers[2][2], self._papers[0].title)
 
+    def test_keyword_search_plan(self):
+        """No branch of the keyword search should force a sequential scan on papers."""
+        cursor = self._conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM pg_extension WHERE extname = 'pg_trgm'")
+        if not cursor.fetchone()[0]:
+            self._conn.rollback()
+            self.skipTest('pg_trgm is not installed')
+        self._conn.rollback()
+        # The queries of get_papers_by_keyword() and of the first and a later
+        # page of get_papers_by_keyword_page() in either order
+        keyword = '1'
+        queries = [(functions._GET_PAPERS_BY_KEYWORD, {'keyword': keyword, 'count': 10})]
+        for ranked in (False, True):
+            status, (_, next_cursor) = functions.get_papers_by_keyword_page(self._conn, keyword, 1, ranked=ranked)
+            self.assertIsNotNone(next_cursor)
+            for page_cursor in (None, next_cursor):
+                seek, params = functions._page_seek(page_cursor, 'relevance' if ranked else 'begin_time')
+                queries.append((functions._keyword_page_query(seek, ranked),
+                                {'keyword': keyword, 'limit': 11, **params}))
+        for query, params in queries:
+            try:
+                # The table is tiny, so make the planner prefer any index it can use.
+                cursor.execute('SET LOCAL enable_seqscan = off')
+                cursor.execute('EXPLAIN ' + query, params)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            finally:
+                self._conn.rollback()
+            self.assertNotIn('Seq Scan on papers', plan)
+
     def test_get_papers_by_liked(self):
         return_status, returned_papers = functions.get_papers_by_liked(
             self._conn, self._eve.username, count=2
@@ -398,3 +924,759 @@ class DbApiAnalyticsTestCase(DbApiTestCase):
 
     def test_get_number_tags_user(self):
         self.assertEqual(functions.get_number_tags_user(self._conn, self._uploader.username), (0, 3))
+
+    def test_get_home_bundle(self):
+        for user in (self._uploader, self._alice, self._bob, self._cindy, self._eve):
+            uname = user.username
+            self.assertEqual(
+                functions.get_home_bundle(self._conn, uname, count=3),
+                (0, (
+                    functions.get_timeline(self._conn, uname, count=3)[1],
+                    functions.get_papers_by_liked(self._conn, uname, count=3)[1],
+                    functions.get_recommend_papers(self._conn, uname, count=3)[1],
+                    functions.get_number_papers_user(self._conn, uname)[1],
+                    functions.get_number_liked_user(self._conn, uname)[1],
+                    functions.get_number_tags_user(self._conn, uname)[1],
+                ))
+            )
+
+    async def test_async_functions(self):
+        pids = [paper.pid for paper in self._papers] + [self._paper.pid]
+        uname = self._uploader.username
+        begin_time = datetime.now() - timedelta(days=7)
+        calls = [
+            ('get_likes_of_papers', {'pids': pids}),
+            ('get_tags_of_papers', {'pids': pids}),
+            ('get_timeline_all', {'count': 3}),
+            ('get_most_popular_papers', {'begin_time': begin_time, 'count': 3}),
+            ('get_papers_by_tag_page', {'tag': self._tags[0].tagname, 'count': 2}),
+            ('get_papers_by_tag_page', {'tag': self._tags[0].tagname, 'cursor': 'malformed'}),
+            ('get_papers_by_keyword_page', {'keyword': '3', 'count': 2, 'ranked': True}),
+            ('get_home_bundle', {'uname': self._eve.username, 'count': 3}),
+            ('get_home_bundle', {'uname': self._alice.username, 'recommended': [self._papers[3].pid]}),
+            ('get_most_active_users', {'count': 3}),
+            ('get_most_popular_tags', {'count': 3}),
+            ('get_most_popular_tag_pairs', {'count': 3}),
+        ]
+        conn = await connect_async('dbname=' + settings.DATABASES['default']['NAME'])
+        try:
+            for name, args in calls:
+                self.assertEqual(await getattr(async_functions, name)(conn, **args),
+                                 getattr(functions, name)(self._conn, **args))
+            self.assertFalse(conn.read_only)
+        finally:
+            await conn.close()
+
+    @mock.patch('paper.database_wrapper.get_cache', return_value=None)
+    async def test_async_view(self, get_cache):
+        request = RequestFactory().get('/tag_view/%s' % self._tags[1].tagname)
+        request.COOKIES['uname'] = self._alice.username
+        with mock.patch('paper.database_wrapper.DB_DESC', 'dbname=' + settings.DATABASES['default']['NAME']), \
+                mock.patch.object(instrumentation, 'enabled', True):
+            try:
+                async def view(request):
+                    return await views.tag_view_async(request, self._tags[1].tagname)
+
+                response = await QueryInstrumentationMiddleware(view)(request)
+            finally:
+                await close_async_pool()
+        self.assertEqual(response.status_code, 200)
+        for paper in self._papers[:2]:
+            self.assertContains(response, '%s>%s</a>' % (reverse('paper:view_paper', args=(paper.pid,)), paper.title))
+        # Like counts and tags are filled in.
+        self.assertContains(response, '3 likes')
+        self.assertContains(response, '#%s&nbsp' % self._tags[2].tagname)
+        self.assertRegex(response['Server-Timing'], r'^db;dur=[0-9.]+;desc="3 calls, 3 queries", ')
+        self.assertIn('get_tags_of_papers', response['Server-Timing'])
+
+    @mock.patch('paper.database_wrapper.get_cache', return_value=None)
+    def test_routing_reads_to_replicas(self, get_cache):
+        # The test database stands in for both the primary and the replica,
+        # told apart by the application name of their connections.
+        dsn = 'dbname=' + settings.DATABASES['default']['NAME']
+        primary, replica = dsn + ' application_name=primary', dsn + ' application_name=replica'
+        unreachable = dsn + ' host=/nonexistent'
+        router = Router([unreachable, replica], check=check_connection)
+
+        def server(**kwargs):
+            status, conn = get_db_connection(**kwargs)
+            self.assertEqual(status, 0)
+            try:
+                return conn.execute('SHOW application_name').fetchone()[0]
+            finally:
+                close_db_connection(conn)
+
+        def cleanup():
+            for name in (primary, replica):
+                pool = database_wrapper._pools.pop(name, None)
+                if pool is not None:
+                    pool.close()
+
+        self.addCleanup(cleanup)
+        timeline = functions.get_timeline(self._conn, self._uploader.username)
+        with mock.patch('paper.database_wrapper.DB_DESC', primary), \
+                mock.patch('paper.database_wrapper.get_router', return_value=router):
+            # The unreachable replica is marked down and the primary takes the read.
+            self.assertEqual(server(read_only=True), 'primary')
+            self.assertFalse(router.replicas[0].up)
+            self.assertEqual(server(read_only=True), 'replica')
+            self.assertEqual(server(), 'primary')
+            self.assertEqual(call_db(functions.get_timeline, {'uname': self._uploader.username}), timeline)
+            self.assertEqual(router.replicas[1].reads, 2)
+
+            # After a write, the reads of its user stick to the primary for a while.
+            pid = self._paper.pid
+            self.assertEqual(call_db(functions.like_paper, {'uname': self._alice.username, 'pid': pid}), (0, None))
+            self.assertEqual(call_db(functions.unlike_paper, {'uname': self._alice.username, 'pid': pid}), (0, None))
+            self.assertEqual(server(read_only=True, user=self._alice.username), 'primary')
+            self.assertEqual(server(read_only=True, user=self._bob.username), 'replica')
+            self.assertEqual(router.get_stats()['writes'], 2)
+
+            # A read whose replica connection is lost runs again on the primary.
+            self._conn.execute("SELECT pg_terminate_backend(pid, 1000) FROM pg_stat_activity "
+                               "WHERE application_name = 'replica'")
+            self._conn.commit()
+            self.assertEqual(call_db(functions.get_timeline, {'uname': self._uploader.username}), timeline)
+            self.assertFalse(router.replicas[1].up)
+            self.assertEqual(server(read_only=True), 'primary')
+
+            # The health checks bring the replica back.
+            self.assertEqual(router.check_replicas(), 1)
+            self.assertEqual(server(read_only=True), 'replica')
+        stats = router.get_stats()
+        self.assertEqual([r['failures'] for r in stats['replicas']], [2, 1])
+        self.assertEqual(stats['sticky_reads'], 1)
+
+    def test_prepared_statements(self):
+        uname = self._uploader.username
+        calls = [
+            (functions.login, {'uname': self._alice.username, 'pwd': self._alice.password}),
+            (functions.get_likes, {'pid': self._papers[0].pid}),
+            (functions.get_paper_tags, {'pid': self._papers[1].pid}),
+            # A paper without tags, whose existence is checked
+            (functions.get_paper_tags, {'pid': self._paper.pid}),
+            (functions.get_timeline, {'uname': uname, 'count': 3}),
+            (functions.get_timeline_all, {'count': 3}),
+            (functions.get_papers_by_tag, {'tag': self._tags[1].tagname, 'count': 3}),
+            (functions.get_number_papers_user, {'uname': uname}),
+            (functions.get_number_liked_user, {'uname': self._cindy.username}),
+            (functions.get_number_tags_user, {'uname': uname}),
+            (functions.get_likes_of_papers, {'pids': [paper.pid for paper in self._papers]}),
+            (functions.get_tags_of_papers, {'pids': [paper.pid for paper in self._papers]}),
+            (functions.get_most_popular_papers, {'begin_time': datetime.now() - timedelta(days=7), 'count': 3}),
+            (functions.get_most_active_users, {'count': 3}),
+            (functions.get_most_popular_tags, {'count': 3}),
+            (functions.get_most_popular_tag_pairs, {'count': 3}),
+        ]
+        with mock.patch.object(functions, 'prepare_statements', False):
+            expected = [function(self._conn, **args) for function, args in calls]
+
+        conn = connect('dbname=' + settings.DATABASES['default']['NAME'])
+        try:
+            # The second round runs the statements prepared by the first.
+            for _ in range(2):
+                self.assertEqual([function(conn, **args) for function, args in calls], expected)
+            status, pid = functions.add_new_paper(conn, uname, 'A Paper', None, None, [self._tags[0].tagname])
+            self.assertEqual(status, 0)
+            self.assertEqual(functions.delete_paper(conn, pid), (0, None))
+            like = {'uname': self._alice.username, 'pid': self._papers[2].pid}
+            self.assertEqual(functions.like_paper(conn, **like), (0, None))
+            self.assertEqual(functions.get_likes(conn, self._papers[2].pid), (0, 2))
+            self.assertEqual(functions.unlike_paper(conn, **like), (0, None))
+            self.assertEqual(functions.get_likes(conn, self._papers[2].pid), (0, 1))
+
+            # Every registered statement has been prepared on first use.
+            numbered = (re.sub('%s', lambda _, n=iter(range(1, 10)): '$%d' % next(n), query)
+                        for query in functions.PREPARED_STATEMENTS.values())
+            cursor = conn.cursor()
+            cursor.execute('SELECT statement FROM pg_prepared_statements')
+            self.assertEqual({row[0] for row in cursor.fetchall()}, set(numbered))
+        finally:
+            conn.close()
+
+    def test_co_like_graph(self):
+        graph = CoLikeGraph(functions.get_like_pairs(self._conn)[1])
+        for user in (self._uploader, self._alice, self._bob, self._cindy, self._eve):
+            uname = user.username
+            papers = functions.get_recommend_papers(self._conn, uname, count=3)[1]
+            self.assertEqual(graph.recommend(uname, 3), [paper[0] for paper in papers])
+            self.assertEqual(
+                functions.get_home_bundle(self._conn, uname, count=3, recommended=graph.recommend(uname, 3)),
+                functions.get_home_bundle(self._conn, uname, count=3)
+            )
+        self.assertEqual(graph.recommend('nobody'), [])
+
+    @mock.patch('paper.database_wrapper.get_cache', return_value=None)
+    def test_instrumentation(self, get_cache):
+        instrumentation.reset()
+        with mock.patch.object(instrumentation, 'enabled', True):
+            status, bundle = call_db_with_conn(self._conn, functions.get_home_bundle, {'uname': self._alice.username})
+            self.assertEqual(status, 0)
+
+            def view(request):
+                call_db_with_conn(self._conn, functions.get_timeline_all, {'count': 2})
+                call_db_with_conn(self._conn, functions.get_likes, {'pid': self._papers[0].pid})
+                return HttpResponse()
+
+            middleware = QueryInstrumentationMiddleware(view)
+            response = middleware(RequestFactory().get('/home/'))
+
+        stats = instrumentation.get_stats()
+        home_bundle = stats['functions']['get_home_bundle']
+        self.assertEqual(home_bundle['calls'], 1)
+        self.assertEqual(home_bundle['queries'], 1)
+        self.assertEqual(home_bundle['commits'], 1)
+        self.assertEqual(home_bundle['rows'], sum(map(len, bundle[:3])) + 1)
+        self.assertEqual(sum(home_bundle['histogram'].values()), 1)
+        self.assertEqual(stats['functions']['get_timeline_all']['rows'], 2)
+
+        request, = stats['recent_requests']
+        self.assertEqual(request['path'], '/home/')
+        self.assertEqual(request['calls'], 2)
+        self.assertEqual(set(request['functions']), {'get_timeline_all', 'get_likes'})
+        self.assertRegex(
+            response['Server-Timing'],
+            r'^db;dur=[0-9.]+;desc="2 calls, 2 queries", get_timeline_all;dur=[0-9.]+, get_likes;dur=[0-9.]+$'
+        )
+
+        # The counters are only shown to logged-in users.
+        with mock.patch.object(instrumentation, 'enabled', True):
+            request = RequestFactory().get('/debug/db_stats/')
+            self.assertNotEqual(views.db_stats(request)['Content-Type'], 'application/json')
+            request.COOKIES['uname'] = self._alice.username
+            response = views.db_stats(request)
+        self.assertEqual(response['Content-Type'], 'application/json')
+
+        # Nothing is recorded while instrumentation is off.
+        instrumentation.reset()
+        response = QueryInstrumentationMiddleware(view)(RequestFactory().get('/home/'))
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(instrumentation.get_stats()['functions'], {})
+
+
+class CacheTestCase(SimpleTestCase):
+    """Test serving and invalidating cached pages."""
+    def setUp(self):
+        self.calls = []
+
+    def run_api(self, function, args):
+        self.calls.append(function.__name__)
+        if function is functions.get_paper_author_and_tags:
+            return 0, ('alice', ['a', 'b'])
+        return 0, len(self.calls)
+
+    def check_invalidation(self, cache):
+        def get(function, **args):
+            return cache.call(function, args, self.run_api)
+
+        timeline_all = get(functions.get_timeline_all, count=10)
+        alice = get(functions.get_timeline, uname='alice', count=10)
+        bob = get(functions.get_timeline, uname='bob', count=10)
+        tag_a = get(functions.get_papers_by_tag_page, tag='a', count=10, cursor=None)
+        tag_c = get(functions.get_papers_by_tag_page, tag='c', count=10, cursor=None)
+        self.assertEqual(get(functions.get_timeline_all, count=10), timeline_all)
+        self.assertNotEqual(get(functions.get_timeline_all, count=5), timeline_all)
+        self.assertEqual(len(self.calls), 6)
+
+        # Likes don't change the cached lists.
+        get(functions.like_paper, uname='bob', pid=1)
+        get(functions.unlike_paper, uname='bob', pid=1)
+        self.assertEqual(get(functions.get_timeline, uname='alice', count=10), alice)
+
+        # Deleting a paper of alice tagged a and b
+        get(functions.delete_paper, pid=1)
+        self.assertEqual(self.calls[-2:], ['get_paper_author_and_tags', 'delete_paper'])
+        self.assertNotEqual(get(functions.get_timeline_all, count=10), timeline_all)
+        self.assertNotEqual(get(functions.get_timeline, uname='alice', count=10), alice)
+        self.assertNotEqual(get(functions.get_papers_by_tag_page, tag='a', count=10, cursor=None), tag_a)
+        self.assertEqual(get(functions.get_timeline, uname='bob', count=10), bob)
+        self.assertEqual(get(functions.get_papers_by_tag_page, tag='c', count=10, cursor=None), tag_c)
+
+        get(functions.add_new_paper, uname='bob', title='', desc=None, text=None, tags=['c'])
+        self.assertNotEqual(get(functions.get_timeline, uname='bob', count=10), bob)
+        self.assertNotEqual(get(functions.get_papers_by_tag_page, tag='c', count=10, cursor=None), tag_c)
+
+        alice = get(functions.get_timeline, uname='alice', count=10)
+        get(functions.reset_db)
+        self.assertNotEqual(get(functions.get_timeline, uname='alice', count=10), alice)
+        self.assertEqual(cache.get_stats()['get_timeline'], {'hits': 3, 'misses': 5})
+        self.assertEqual(cache.get_stats()['like_paper'], {'invalidations': 1})
+
+    def test_local_cache(self):
+        self.check_invalidation(Cache(LocalCache()))
+
+    def test_django_cache(self):
+        self.check_invalidation(Cache(caches['default'], prefix='test_django_cache'))
+
+    def test_archiving_partitions(self):
+        cache = Cache(LocalCache())
+        timeline_all = cache.call(functions.get_timeline_all, {}, self.run_api)
+        maintain = lambda archived: lambda function, args: (0, (['papers_p202407'], archived))
+        cache.call(functions.maintain_partitions, {}, maintain([]))
+        self.assertEqual(cache.call(functions.get_timeline_all, {}, self.run_api), timeline_all)
+        cache.call(functions.maintain_partitions, {}, maintain(['papers_p202401']))
+        self.assertNotEqual(cache.call(functions.get_timeline_all, {}, self.run_api), timeline_all)
+
+    def test_failures_are_not_cached(self):
+        cache = Cache(LocalCache())
+        run = lambda function, args: (1, None)
+        self.assertEqual(cache.call(functions.get_timeline_all, {}, run), (1, None))
+        self.assertEqual(cache.call(functions.get_timeline_all, {}, self.run_api), (0, 1))
+
+    def test_storing_lagging_results(self):
+        cache = Cache(LocalCache())
+        now = 1000.0
+
+        def get(function, stale=0.0, **args):
+            with mock.patch('time.time', lambda: now):
+                return cache.call(function, args, self.run_api, stale=stale)
+
+        # Results up to 5 seconds behind are stored once their group has been
+        # left alone for that long.
+        self.assertEqual(get(functions.get_timeline_all, stale=5), (0, 1))
+        now += 5
+        self.assertEqual(get(functions.get_timeline_all, stale=5), (0, 2))
+        self.assertEqual(get(functions.get_timeline_all, stale=5), (0, 2))
+        get(functions.add_new_paper, uname='alice', title='', desc=None, text=None, tags=[])
+        now += 1
+        self.assertEqual(get(functions.get_timeline_all, stale=5), (0, 4))
+        self.assertEqual(get(functions.get_timeline_all, stale=5), (0, 5))
+        # Up-to-date results are stored right away.
+        self.assertEqual(get(functions.get_timeline_all), (0, 6))
+        self.assertEqual(get(functions.get_timeline_all, stale=5), (0, 6))
+        self.assertEqual(cache.get_stats()['get_timeline_all'], {'hits': 2, 'misses': 5, 'unsettled': 3})
+
+    def test_local_cache_expiry_and_eviction(self):
+        local = LocalCache(max_entries=2)
+        local.set('a', 1, timeout=60)
+        local.set('b', 2, timeout=0)
+        self.assertIsNone(local.get('b'))
+        local.set('c', 3)
+        local.get('a')
+        local.set('d', 4)
+        self.assertEqual(local.get_many(['a', 'c', 'd']), {'a': 1, 'd': 4})
+        self.assertFalse(local.add('a', 5))
+        self.assertTrue(local.add('c', 5))
+
+
+class RecommenderTestCase(SimpleTestCase):
+    """Test how the like graph snapshot is refreshed."""
+    def setUp(self):
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return CoLikeGraph([(self.loads, 'a'), (self.loads + 1, 'a'), (self.loads + 1, 'b'), (100, 'b')])
+
+    def test_serving_fresh_graph(self):
+        recommender = Recommender(max_age=60, load=self.load)
+        self.assertEqual(recommender.recommend('a'), [100])
+        self.assertEqual(recommender.recommend('b'), [1])
+        self.assertEqual(self.loads, 1)
+
+    def test_refreshing_stale_graph(self):
+        recommender = Recommender(max_age=0, load=self.load)
+        # The first graph is served while the second one is being built.
+        self.assertEqual(recommender.recommend('b'), [1])
+        for _ in range(100):
+            if recommender.recommend('b') != [1]:
+                break
+            time.sleep(0.01)
+        self.assertGreater(recommender.recommend('b')[0], 1)
+
+    def test_keeping_graph_when_load_fails(self):
+        recommender = Recommender(max_age=60, load=lambda: None)
+        self.assertIsNone(recommender.recommend('a'))
+        recommender = Recommender(max_age=60, load=self.load)
+        recommender.get_graph()
+        recommender._load = lambda: None
+        self.assertEqual(recommender.refresh().recommend('a'), [100])
+
+
+class StatsRefresherTestCase(SimpleTestCase):
+    """Test the background refresh of the popular papers page statistics."""
+    def setUp(self):
+        self.loads = 0
+
+    def load(self):
+        self.loads += 1
+        return Snapshot(['user%d' % self.loads], [('tag', self.loads)], [], taken_at=time.monotonic())
+
+    def test_refreshing_in_background(self):
+        refresher = StatsRefresher(interval=0.01, max_staleness=60, load=self.load)
+        self.assertIsNone(refresher.get_snapshot())
+        refresher.start()
+        try:
+            for _ in range(100):
+                snapshot = refresher.get_snapshot()
+                if snapshot is not None and self.loads > 1:
+                    break
+                time.sleep(0.01)
+        finally:
+            refresher.stop()
+        self.assertGreater(self.loads, 1)
+        self.assertEqual(refresher.get_snapshot().active_users, ['user%d' % self.loads])
+        stats = refresher.get_stats()
+        self.assertEqual(stats['refreshes'], self.loads)
+        self.assertEqual(stats['refresh_errors'], 0)
+        # Reads before the first refresh find no snapshot.
+        self.assertGreaterEqual(stats['stale_reads'], 1)
+        self.assertGreaterEqual(stats['refresh_ms_max'], stats['refresh_ms_mean'])
+
+    def test_falling_back_when_stale(self):
+        refresher = StatsRefresher(interval=60, max_staleness=0.05, load=self.load)
+        self.assertEqual(refresher.refresh().active_users, ['user1'])
+        self.assertEqual(refresher.get_snapshot().active_users, ['user1'])
+        # A failed refresh keeps the snapshot until it gets too stale to serve.
+        refresher._load = lambda: None
+        self.assertEqual(refresher.refresh().active_users, ['user1'])
+        time.sleep(0.06)
+        self.assertIsNone(refresher.get_snapshot())
+        stats = refresher.get_stats()
+        self.assertEqual((stats['refreshes'], stats['refresh_errors']), (2, 1))
+        self.assertEqual((stats['snapshot_reads'], stats['stale_reads']), (1, 1))
+
+    def test_loading_snapshot(self):
+        results = {
+            functions.get_most_active_users: ['alice'],
+            functions.get_most_popular_tags: [('x', 2)],
+            functions.get_most_popular_tag_pairs: [('x', 'y', 1)],
+        }
+        snapshot = load_snapshot(lambda function, argdict: (0, results[function]))
+        self.assertEqual((snapshot.active_users, snapshot.popular_tags, snapshot.popular_tag_pairs),
+                         (['alice'], [('x', 2)], [('x', 'y', 1)]))
+        self.assertIsNone(load_snapshot(lambda function, argdict: (1, None)))
+
+
+class RouterTestCase(SimpleTestCase):
+    """Test the choice of replica for reads and the read-your-writes window."""
+    def setUp(self):
+        self.now = 0.0
+        self.down = set()
+        self.router = Router(['dbname=a', 'dbname=b', 'dbname=c'], check_interval=0.01, sticky_window=5,
+                             check=self.check, clock=lambda: self.now)
+
+    def check(self, dsn):
+        if dsn in self.down:
+            raise psycopg.OperationalError('%s is down' % dsn)
+
+    def choices(self, n, user=None):
+        # The index of the replica of each read, None for the primary
+        return [self.router.replicas.index(replica) if replica is not None else None
+                for replica in (self.router.choose(user) for _ in range(n))]
+
+    def test_round_robin(self):
+        self.assertEqual(self.choices(4), [0, 1, 2, 0])
+        self.router.mark_down(self.router.replicas[1], psycopg.OperationalError('lost'))
+        self.assertEqual(self.choices(3), [2, 0, 2])
+        for replica in self.router.replicas:
+            self.router.mark_down(replica, psycopg.OperationalError('lost'))
+        # With no replica up, reads go to the primary.
+        self.assertEqual(self.choices(2), [None, None])
+        stats = self.router.get_stats()
+        self.assertEqual(stats['primary_reads'], 2)
+        self.assertEqual([replica['reads'] for replica in stats['replicas']], [3, 1, 3])
+        self.assertEqual(stats['replicas'][1]['last_error'], 'lost')
+
+    def test_health_checks(self):
+        self.down = {'dbname=b'}
+        self.assertEqual(self.router.check_replicas(), 2)
+        self.assertEqual(self.choices(2), [0, 2])
+        self.down = set()
+        self.router.start()
+        try:
+            for _ in range(100):
+                if self.router.replicas[1].up:
+                    break
+                time.sleep(0.01)
+        finally:
+            self.router.stop()
+        self.assertTrue(self.router.replicas[1].up)
+        self.assertEqual(self.router.get_stats()['replicas'][1]['last_error'], 'dbname=b is down')
+
+    def test_read_your_writes(self):
+        self.router.note_write('alice')
+        self.router.note_write(None)
+        self.now = 3
+        self.router.note_write('bob')
+        self.assertEqual(self.choices(1, 'alice') + self.choices(1, 'bob') + self.choices(1, 'eve'), [None, None, 0])
+        # Each window lasts sticky_window seconds from the user's last write.
+        self.now = 5
+        self.assertEqual(self.choices(1, 'alice') + self.choices(1, 'bob'), [1, None])
+        self.now = 8
+        self.assertEqual(self.choices(1, 'bob'), [2])
+        stats = self.router.get_stats()
+        self.assertEqual((stats['writes'], stats['sticky_reads'], stats['recent_writers']), (3, 3, 0))
+
+    def test_caching_around_writes(self):
+        cache = Cache(LocalCache())
+        reads = []
+
+        def get_db_connection(read_only=False, user=None):
+            replica = self.router.choose(user) if read_only else None
+            return 0, 'replica' if replica is not None else 'primary'
+
+        def invoke(conn, function, args):
+            reads.append(conn)
+            return 0, '%s %d' % (conn, len(reads))
+
+        def call(function, user=None, **args):
+            with mock.patch('time.time', lambda: 1000 + self.now):
+                return call_db(function, args, user=user)
+
+        with mock.patch('paper.database_wrapper.get_router', return_value=self.router), \
+                mock.patch('paper.database_wrapper.get_cache', return_value=cache), \
+                mock.patch('paper.database_wrapper.get_db_connection', get_db_connection), \
+                mock.patch('paper.database_wrapper._invoke', invoke), \
+                mock.patch('paper.database_wrapper.close_db_connection'):
+            self.assertEqual(call(functions.add_new_paper, uname='alice', title='', desc=None, text=None, tags=[]),
+                             (0, 'primary 1'))
+            # The replicas may not have the paper yet: what they return isn't
+            # stored, and alice reads from the primary past the cache.
+            self.assertEqual(call(functions.get_timeline_all, count=10), (0, 'replica 2'))
+            self.assertEqual(call(functions.get_timeline_all, 'alice', count=10), (0, 'primary 3'))
+            self.assertEqual(call(functions.get_timeline_all, count=10), (0, 'replica 4'))
+            self.now = 5
+            self.assertEqual(call(functions.get_timeline_all, count=10), (0, 'replica 5'))
+            self.assertEqual(call(functions.get_timeline_all, 'alice', count=10), (0, 'replica 5'))
+        self.assertEqual(cache.get_stats()['get_timeline_all'], {'hits': 1, 'misses': 3, 'unsettled': 2})
+
+    def test_hiding_password(self):
+        router = Router(['host=replica dbname=paper password=secret'])
+        dsn = router.get_stats()['replicas'][0]['dsn']
+        self.assertIn('host=replica', dsn)
+        self.assertNotIn('secret', dsn)
+
+
+class PartitionMaintainerTestCase(SimpleTestCase):
+    """Test the periodic maintenance of the monthly partitions."""
+    def test_counting_runs(self):
+        results = iter([(0, (['papers_p202401', 'likes_p202401'], [])), (1, None), (0, ([], ['papers_p202301']))])
+        maintainer = PartitionMaintainer(interval=60, maintain=lambda: next(results))
+        self.assertEqual([maintainer.maintain() for _ in range(3)], [True, False, True])
+        # Errors raised by a run count as failed runs too.
+        self.assertFalse(maintainer.maintain())
+        stats = maintainer.get_stats()
+        self.assertEqual((stats['runs'], stats['run_errors']), (4, 2))
+        self.assertEqual((stats['partitions_created'], stats['partitions_archived']), (2, 1))
+
+
+class BenchmarkHelpersTestCase(SimpleTestCase):
+    """Test the latency summaries and the synthetic datasets of the benchmarks."""
+    def test_summarize(self):
+        summary = summarize([float(ms) for ms in range(100, 0, -1)], errors=2, elapsed=4.0)
+        self.assertEqual(summary['count'], 100)
+        self.assertEqual(summary['errors'], 2)
+        self.assertEqual(summary['throughput_per_s'], 25.0)
+        self.assertEqual(summary['latency_ms'], {'mean': 50.5, 'p50': 50.0, 'p95': 95.0, 'p99': 99.0, 'max': 100.0})
+        self.assertEqual(summarize([]), {'count': 0, 'errors': 0})
+
+    def test_synthetic_dataset(self):
+        config = DatasetConfig(users=20, papers=50, likes=300, tags=10, words=100, words_per_paper=5)
+        now = datetime(2017, 4, 1)
+        papers = list(SyntheticDataset(config).papers(now))
+        self.assertEqual(papers, list(SyntheticDataset(config).papers(now)))
+        self.assertEqual(len(papers), 50)
+        for paper in papers:
+            self.assertEqual(len(set(paper['tags'])), len(paper['tags']))
+            self.assertEqual(len({liker for liker, _ in paper['likes']}), len(paper['likes']))
+        # Likes are skewed towards a few papers.
+        like_counts = sorted((len(paper['likes']) for paper in papers), reverse=True)
+        self.assertGreater(sum(like_counts[:5]), sum(like_counts[-25:]))
+
+    def test_flagging_plans(self):
+        explained = {'Planning Time': 0.1, 'Execution Time': 2.0, 'Plan': {
+            'Node Type': 'Limit', 'Plans': [
+                {'Node Type': 'Seq Scan', 'Relation Name': 'papers'},
+                {'Node Type': 'Index Scan', 'Relation Name': 'likes', 'Index Name': 'likes_pkey'},
+            ]}}
+        statement = describe_plan('SELECT 1', explained)
+        self.assertEqual(statement['plan'], 'Limit(Seq Scan on papers, Index Scan using likes_pkey)')
+        self.assertEqual(statement['seq_scans'], ['papers'])
+
+        def report(plan, p50):
+            statements = [dict(statement, plan=plan, seq_scans=[])]
+            return {'scales': {'1000': {'functions': {'get_timeline': {
+                'statements': statements, 'timing': {'latency_ms': {'p50': p50}}}}}}}
+
+        self.assertEqual(BenchFunctionsCommand.flag(report('a', 1.0), report('a', 1.0), 0.5), [])
+        self.assertEqual(BenchFunctionsCommand.flag(report('b', 2.0), report('a', 1.0), 0.5), [
+            'plan changed: get_timeline at 1000 papers',
+            'slower: get_timeline at 1000 papers, p50 1.00 ms -> 2.00 ms',
+        ])
+
+    def test_suggesting_indexes(self):
+        explained = {'Plan': {
+            'Node Type': 'Limit', 'Plans': [{
+                'Node Type': 'Sort', 'Sort Key': ['papers.begin_time DESC', 'papers.pid'], 'Plans': [{
+                    'Node Type': 'Seq Scan', 'Relation Name': 'papers', 'Alias': 'papers',
+                    'Filter': '((username)::text = $1)',
+                }]}]}}
+        scan, = describe_plan('SELECT 1', explained)['scans']
+        self.assertEqual(scan, {'relation': 'papers', 'alias': 'papers', 'filter': '((username)::text = $1)',
+                                'order': ['papers.begin_time DESC', 'papers.pid']})
+
+        columns = {'pid', 'username', 'title', 'begin_time'}
+        suggestion = suggest_index(scan, columns)
+        self.assertEqual(suggestion, IndexSuggestion('papers', ('username', 'begin_time DESC', 'pid')))
+        self.assertEqual(suggestion.sql, 'CREATE INDEX advisor_papers_username_begin_time_pid_idx '
+                                         'ON papers (username, begin_time DESC, pid)')
+        # Only the keys of the scanned relation lead the order.
+        self.assertEqual(suggest_index(dict(scan, filter=None, order=['count(*) DESC', 'papers.pid']), columns),
+                         None)
+        self.assertEqual(suggest_index(dict(scan, filter='(pid = ANY ($1))', order=None), columns),
+                         IndexSuggestion('papers', ('pid',)))
+
+        self.assertEqual(covering_index(suggestion, {'papers_pkey': ['pid']}), None)
+        self.assertEqual(covering_index(suggestion, {
+            'papers_pkey': ['pid'], 'papers_username_idx': ['username DESC', 'begin_time', 'pid DESC', 'title'],
+        }), 'papers_username_idx')
+
+
+class ConnectionPoolTestCase(SimpleTestCase):
+    """Test checkout, reuse and replacement of pooled connections."""
+    def setUp(self):
+        self.pool = ConnectionPool(
+            'dbname=' + settings.DATABASES['default']['NAME'],
+            min_size=1, max_size=2, timeout=0.1
+        )
+
+    def tearDown(self):
+        self.pool.close()
+
+    def test_reusing_connection(self):
+        conn = self.pool.getconn()
+        self.pool.putconn(conn)
+        self.assertIs(self.pool.getconn(), conn)
+        self.assertEqual(self.pool.get_stats()['connections_num'], 1)
+
+    def test_timeout_when_exhausted(self):
+        conns = [self.pool.getconn() for _ in range(self.pool.max_size)]
+        with self.assertRaises(PoolTimeout):
+            self.pool.getconn()
+        stats = self.pool.get_stats()
+        self.assertEqual(stats['pool_used'], 2)
+        self.assertEqual(stats['requests_errors'], 1)
+
+        # Returning a connection twice is harmless.
+        self.pool.putconn(conns[0])
+        self.pool.putconn(conns[0])
+        self.assertEqual(self.pool.get_stats()['pool_available'], 1)
+        self.pool.putconn(conns[1])
+
+    def test_rolling_back_returned_connection(self):
+        conn = self.pool.getconn()
+        conn.cursor().execute('SELECT 1')
+        self.pool.putconn(conn)
+        self.assertEqual(conn.info.transaction_status, TransactionStatus.IDLE)
+
+    def test_replacing_broken_connection(self):
+        conn = self.pool.getconn()
+        conn.close()
+        self.pool.putconn(conn)
+        self.assertEqual(self.pool.get_stats()['returns_bad'], 1)
+
+        conn = self.pool.getconn()
+        self.assertFalse(conn.closed)
+        self.pool.putconn(conn)
+
+    def test_reaping_idle_connections(self):
+        self.pool.max_idle = 0
+        conns = [self.pool.getconn() for _ in range(self.pool.max_size)]
+        for conn in conns:
+            self.pool.putconn(conn)
+        # Connections idle for longer than max_idle are closed down to min_size.
+        self.assertEqual(self.pool.size, self.pool.min_size)
+        self.assertEqual(self.pool.get_stats()['connections_reaped'], 1)
+
+
+class AsyncConnectionPoolTestCase(SimpleTestCase):
+    """Test checkout, reuse and replacement of connections in the async pool."""
+    def setUp(self):
+        self.pool = AsyncConnectionPool(
+            'dbname=' + settings.DATABASES['default']['NAME'],
+            min_size=1, max_size=2, timeout=0.1
+        )
+
+    async def test_checkout(self):
+        try:
+            conn = await self.pool.getconn()
+            await conn.execute('SELECT 1')
+            await self.pool.putconn(conn)
+            # The returned connection has been rolled back and is reused.
+            self.assertEqual(conn.info.transaction_status, TransactionStatus.IDLE)
+            self.assertIs(await self.pool.getconn(), conn)
+
+            other = await self.pool.getconn()
+            with self.assertRaises(PoolTimeout):
+                await self.pool.getconn()
+            # A waiting checkout gets the connection returned in the meantime.
+            waiting = asyncio.ensure_future(self.pool.getconn(timeout=1))
+            await asyncio.sleep(0)
+            await self.pool.putconn(other)
+            self.assertIs(await waiting, other)
+
+            await conn.close()
+            await self.pool.putconn(conn)
+            stats = self.pool.get_stats()
+            self.assertEqual(stats['connections_num'], 2)
+            self.assertEqual(stats['requests_errors'], 1)
+            self.assertEqual(stats['requests_waiting'], 2)
+            self.assertEqual(stats['returns_bad'], 1)
+            self.assertEqual(stats['pool_used'], 1)
+            await self.pool.putconn(other)
+        finally:
+            await self.pool.close()
+
+
+class ViewPaperTestCase(SimpleTestCase):
+    """Test streaming, revalidation and partial downloads of paper files."""
+    _content = bytes(range(256)) * 1000
+
+    def setUp(self):
+        self._base_dir = tempfile.TemporaryDirectory()
+        os.mkdir(os.path.join(self._base_dir.name, 'media'))
+        with open(os.path.join(self._base_dir.name, 'media', '1.pdf'), 'wb') as f:
+            f.write(self._content)
+        settings_override = override_settings(BASE_DIR=self._base_dir.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client.cookies['uname'] = 'reader'
+
+    def tearDown(self):
+        self._base_dir.cleanup()
+
+    def test_whole_file(self):
+        response = self.client.get('/view_paper/1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Length'], str(len(self._content)))
+        self.assertEqual(b''.join(response.streaming_content), self._content)
+        self.assertEqual(self.client.get('/view_paper/2').status_code, 404)
+
+    def test_conditional_get(self):
+        response = self.client.get('/view_paper/1')
+        etag = response['ETag']
+        response.close()
+        self.assertEqual(self.client.get('/view_paper/1', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(
+            self.client.get('/view_paper/1', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code,
+            304
+        )
+
+    def test_range(self):
+        response = self.client.get('/view_paper/1', HTTP_RANGE='bytes=1000-1999')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], 'bytes 1000-1999/%d' % len(self._content))
+        self.assertEqual(response['Content-Length'], '1000')
+        self.assertEqual(b''.join(response.streaming_content), self._content[1000:2000])
+
+        response = self.client.get('/view_paper/1', HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), self._content[-10:])
+
+        response = self.client.get('/view_paper/1', HTTP_RANGE='bytes=%d-' % len(self._content))
+        self.assertEqual(response.status_code, 416)
+
+        # A range of an outdated version of the file gets the whole file.
+        response = self.client.get('/view_paper/1', HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"outdated"')
+        self.assertEqual(response.status_code, 200)
+        response.close()
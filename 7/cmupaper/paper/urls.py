@@ -1,21 +1,29 @@
 from django.urls import re_path
 
 from . import views
+from .constants import ASYNC_VIEWS
+
+home = views.home_async if ASYNC_VIEWS else views.home
+popular_papers = views.popular_papers_async if ASYNC_VIEWS else views.popular_papers
+search_view = views.search_view_async if ASYNC_VIEWS else views.search_view
+tag_view = views.tag_view_async if ASYNC_VIEWS else views.tag_view
 
 app_name = 'paper'
 urlpatterns = [
-    re_path(r'^$', views.home, name='index'),
+    re_path(r'^$', home, name='index'),
     re_path(r'^login/$', views.login, name='login'),
     re_path(r'^logout/$', views.logout, name='logout'),
-    re_path(r'^home/$', views.home, name='home'),
+    re_path(r'^home/$', home, name='home'),
     re_path(r'^signup/$', views.signup, name='signup'),
-    re_path(r'^popular_papers/$', views.popular_papers, name='popular_papers'),
+    re_path(r'^popular_papers/$', popular_papers, name='popular_papers'),
     re_path(r'^new_paper/$', views.new_paper, name='new_paper'),
     re_path(r'^like/(?P<paper_id>[0-9]+)/(?P<source>\w+)/$', views.like, name='like'),
     re_path(r'^unlike/(?P<paper_id>[0-9]+)/(?P<source>\w+)/$', views.unlike, name='unlike'),
     re_path(r'^delete_paper/(?P<paper_id>[0-9]+)$', views.delete_paper, name='delete_paper'),
     re_path(r'^view_paper/(?P<paper_id>[0-9]+)$', views.view_paper, name='view_paper'),
-    re_path(r'^search_view/$', views.search_view, name='search_view'),
-    re_path(r'^tag_view/(?P<tag_name>\w+)$', views.tag_view, name='tag_view'),
+    re_path(r'^extraction_status/(?P<paper_id>[0-9]+)$', views.extraction_status, name='extraction_status'),
+    re_path(r'^search_view/$', search_view, name='search_view'),
+    re_path(r'^tag_view/(?P<tag_name>\w+)$', tag_view, name='tag_view'),
     re_path(r'^reset/$', views.reset, name='reset'),
+    re_path(r'^debug/db_stats/$', views.db_stats, name='db_stats'),
 ]
\ No newline at end of file
@@ -2,19 +2,31 @@ from django.shortcuts import render
 
 # Create your views here.
 from django.shortcuts import render
-from django.http import HttpResponse, HttpResponseRedirect
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect, JsonResponse, \
+    StreamingHttpResponse
 from django.urls import reverse
 from django.conf import settings
 from django.core.files.storage import FileSystemStorage
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+from asgiref.sync import sync_to_async
 
 from pytz import timezone
 from datetime import timedelta
 from datetime import datetime
-import textract
+from urllib.parse import urlencode
 
 from .constants import *
 from .database_wrapper import *
+from . import async_functions
+from .extraction import get_extraction_pool
+from . import global_stats
+from . import instrumentation
+from .partitions import get_maintainer
+from .recommend import get_recommender
+from .routing import get_router
 from . import functions
+import asyncio
 import tempfile
 
 """
@@ -80,27 +92,51 @@ def valid_login(request):
 
 def append_likes_tags(conn, posts):
     """
-    Utility to append like counts and tags of a given paper
-    """
-    likes = list()
-    tag_lists = list()
+    Utility to append like counts and tags of the given papers.
+    Like counts and tags of all papers are each fetched with a single query.
+    """
+    pids = [int(post['pid']) for post in posts]
+    if not pids:
+        return
+    status, likes = call_db_with_conn(conn, functions.get_likes_of_papers, {'pids':pids})
+    if status != SUCCESS:
+        likes = dict()
+    status, tag_lists = call_db_with_conn(conn, functions.get_tags_of_papers, {'pids':pids})
+    if status != SUCCESS:
+        tag_lists = dict()
+    set_likes_tags(posts, likes, tag_lists)
+
+
+async def append_likes_tags_async(posts, user=None):
+    """
+    Like append_likes_tags(), with the like counts and tags fetched concurrently
+    for $user
+    """
+    pids = [int(post['pid']) for post in posts]
+    if not pids:
+        return
+    (status, likes), (status2, tag_lists) = await asyncio.gather(
+        call_db_async(async_functions.get_likes_of_papers, {'pids':pids}, user=user),
+        call_db_async(async_functions.get_tags_of_papers, {'pids':pids}, user=user),
+    )
+    if status != SUCCESS:
+        likes = dict()
+    if status2 != SUCCESS:
+        tag_lists = dict()
+    set_likes_tags(posts, likes, tag_lists)
+
+
+def set_likes_tags(posts, likes, tag_lists):
     for post in posts:
-        # get like count for the post
-        status, likec = call_db_with_conn(conn, functions.get_likes, {'pid':int(post['pid'])})
-        if status == SUCCESS:
-            likes.append(int(likec))
-        else:
-            likes.append(0)
-        # get all the tags for the post
-        status, tags = call_db_with_conn(conn, functions.get_paper_tags, {'pid':int(post['pid'])})
-        if status == SUCCESS:
-            tag_lists.append(tags)
-        else:
-            tag_lists.append(list())
+        pid = int(post['pid'])
+        post['like'] = int(likes.get(pid, 0))
+        post['tags'] = tag_lists.get(pid, list())
+
 
-    for i in range(len(posts)):
-        posts[i]['like'] = likes[i]
-        posts[i]['tags'] = tag_lists[i]
+def set_global_stats(context, active_users, popular_tags, popular_tag_pairs):
+    context['active_user'] = active_users[0] if active_users else ""
+    context['popular_tag'] = popular_tags[0] if popular_tags else ""
+    context['popular_pair'] = popular_tag_pairs[0][0] + ", " + popular_tag_pairs[0][1] if popular_tag_pairs else ""
 
 
 def get_paper_dict(paper_list):
@@ -208,53 +244,39 @@ def home(request, err_msg = None):
     context['source'] = 'home'
     context['header_text'] = "Hello " + uname + "!"
 
+    # Rank recommendations from the like graph snapshot, before taking a
+    # connection since building the snapshot takes one of its own. Ask for
+    # spare ones in case the user has liked some of them since.
+    recommender = get_recommender()
+    recommended = recommender.recommend(uname, 20) if recommender is not None else None
+
     # Setup connection
     conn = None
     try:
-        status, conn = get_db_connection()
+        status, conn = get_db_connection(read_only=True, user=uname)
         if status != SUCCESS:
             context['error_message'] = err_internal
             return render(request, 'paper/base_paper_list.html', context)
 
-        # Get timeline
-        status, timeline_papers = call_db_with_conn(conn, functions.get_timeline, {'uname':uname})
+        # Get timeline, liked and recommended papers and statistics at once
+        status, bundle = call_db_with_conn(conn, functions.get_home_bundle,
+                                           {'uname':uname, 'recommended': recommended})
         if status != SUCCESS:
             context['error_message'] = err_internal
             return render(request, 'paper/base_paper_list.html', context)
+        timeline_papers, liked_papers, recommend_papers, num_post, num_like, num_tag = bundle
 
         if len(timeline_papers) == 0:
             context['error_message'] = "No post posted"
-
-        # Get liked
-        status, liked_papers = call_db_with_conn(conn, functions.get_papers_by_liked, {'uname':uname})
-        if status != SUCCESS:
-            context['error_message'] = err_internal
-            return render(request, 'paper/base_paper_list.html', context)
-
         if len(liked_papers) == 0:
             context['error_message2'] = "Not any liked posts"
-
-        # Get recommendation
-        status, recommend_papers = call_db_with_conn(conn, functions.get_recommend_papers, {'uname':uname})
-        if status != SUCCESS:
-            context['error_message'] = err_internal
-            close_db_connection(conn)
-            return render(request, 'paper/base_paper_list.html', context)
-
         if len(recommend_papers) == 0:
             context['error_message3'] = "Not any recommendation posts"
 
-        # Get statistics
-        status, num_post = call_db_with_conn(conn, functions.get_number_papers_user, {'uname':uname})
-        status, num_like = call_db_with_conn(conn, functions.get_number_liked_user, {'uname':uname})
-        status, num_tag = call_db_with_conn(conn, functions.get_number_tags_user, {'uname':uname})
-
         recommend_paper_dicts = get_paper_dict(recommend_papers)
         liked_paper_dicts = get_paper_dict(liked_papers)
         timeline_paper_dicts = get_paper_dict(timeline_papers)
-        append_likes_tags(conn, recommend_paper_dicts)
-        append_likes_tags(conn, liked_paper_dicts)
-        append_likes_tags(conn, timeline_paper_dicts)
+        append_likes_tags(conn, recommend_paper_dicts + liked_paper_dicts + timeline_paper_dicts)
         context['paper_list'] = timeline_paper_dicts
         context['liked_list'] = liked_paper_dicts
         context['recommend_list'] = recommend_paper_dicts
@@ -286,7 +308,7 @@ def popular_papers(request, err_msg = None):
     # setup connection
     conn = None
     try:
-        status, conn = get_db_connection()
+        status, conn = get_db_connection(read_only=True, user=context['username'])
         if status != SUCCESS:
             context['error_message'] = err_internal
             return render(request, 'paper/base_paper_list.html', context)
@@ -302,7 +324,8 @@ def popular_papers(request, err_msg = None):
             context['error_message'] = "Not any popular papers now, publish your own and become popular!"
 
         # get recent papers
-        status, recent_paper_list = call_db_with_conn(conn, functions.get_timeline_all, {})
+        status, recent_paper_list = call_db_with_conn(conn, functions.get_timeline_all, {},
+                                                      user=context['username'])
 
         if status != SUCCESS:
             context['error_message'] = err_internal
@@ -311,24 +334,22 @@ def popular_papers(request, err_msg = None):
         if len(recent_paper_list) == 0:
             context['error_message2'] = "Not any recent papers"
 
-        # Get global statistics
-        status, active_user = call_db_with_conn(conn, functions.get_most_active_users, {})
-        status, popular_tag = call_db_with_conn(conn, functions.get_most_popular_tags, {})
-        status, popular_tag_pair = call_db_with_conn(conn, functions.get_most_popular_tag_pairs, {})
-        active_user = active_user[0] if len(active_user) > 0 else ""
-        popular_tag = popular_tag[0] if len(popular_tag) > 0 else ""
-        popular_tag_pair = popular_tag_pair[0][0] + ", " + popular_tag_pair[0][1] if len(popular_tag_pair) > 0 else ""
+        # Get global statistics, from the background snapshot unless it is too stale
+        snapshot = global_stats.get_snapshot()
+        if snapshot is not None:
+            set_global_stats(context, snapshot.active_users, snapshot.popular_tags, snapshot.popular_tag_pairs)
+        else:
+            status, active_user = call_db_with_conn(conn, functions.get_most_active_users, {})
+            status, popular_tag = call_db_with_conn(conn, functions.get_most_popular_tags, {})
+            status, popular_tag_pair = call_db_with_conn(conn, functions.get_most_popular_tag_pairs, {})
+            set_global_stats(context, active_user, popular_tag, popular_tag_pair)
 
         popular_papers_dicts = get_paper_dict(popular_paper_list)
         recent_papers_dicts = get_paper_dict(recent_paper_list)
-        append_likes_tags(conn, popular_papers_dicts)
-        append_likes_tags(conn, recent_papers_dicts)
+        append_likes_tags(conn, popular_papers_dicts + recent_papers_dicts)
 
         context['paper_list'] = popular_papers_dicts
         context['recent_list'] = recent_papers_dicts
-        context['active_user'] = active_user
-        context['popular_tag'] = popular_tag
-        context['popular_pair'] = popular_tag_pair
         response = render(request, 'paper/base_paper_list.html', context)
 
         return response
@@ -339,14 +360,17 @@ def popular_papers(request, err_msg = None):
 
 def search_view(request):
     """
-    Search result page
+    Search result page. The first page is requested with a POST from the
+    search form, following pages with a GET carrying the page cursor.
     """
     # Verify login
     if not valid_login(request):
         return render(request, 'paper/login.html', {'error_message': err_login})
 
-    if request.method == 'POST' and request.POST['keywords'] != "":
-        keywords = request.POST['keywords']
+    params = request.POST if request.method == 'POST' else request.GET
+    keywords = params.get('keywords', "")
+    if keywords != "":
+        ranked = params.get('order') == 'rank'
         # Init context
         context = dict()
         context['username'] = get_current_user(request)
@@ -356,16 +380,18 @@ def search_view(request):
         # Setup connection
         conn = None
         try:
-            status, conn = get_db_connection()
+            status, conn = get_db_connection(read_only=True, user=context['username'])
             if status != SUCCESS:
                 context['error_message'] = err_internal
                 return render(request, 'paper/base_paper_list.html', context)
 
             # Get search result
-            status, res_paper_list = call_db_with_conn(conn, functions.get_papers_by_keyword, {'keywords':keywords})
+            status, page = call_db_with_conn(conn, functions.get_papers_by_keyword_page, {
+                'keyword':keywords, 'cursor':request.GET.get('cursor'), 'ranked':ranked})
             if status != SUCCESS:
                 context['error_message'] = err_internal
                 return render(request, 'paper/base_paper_list.html', context)
+            res_paper_list, next_cursor = page
 
             if len(res_paper_list) == 0:
                 context['error_message'] = "No post posted"
@@ -374,6 +400,11 @@ def search_view(request):
             res_paper_dicts = get_paper_dict(res_paper_list)
             append_likes_tags(conn, res_paper_dicts)
             context['paper_list'] = res_paper_dicts
+            if next_cursor is not None:
+                query = {'keywords':keywords, 'cursor':next_cursor}
+                if ranked:
+                    query['order'] = 'rank'
+                context['next_page_url'] = reverse('paper:search_view') + '?' + urlencode(query)
             response = render(request, 'paper/base_paper_list.html', context)
             return response
         finally:
@@ -398,16 +429,19 @@ def tag_view(request, tag_name):
     # Setup connection
     conn = None
     try:
-        status, conn = get_db_connection()
+        status, conn = get_db_connection(read_only=True, user=context['username'])
         if status != SUCCESS:
             context['error_message'] = err_internal
             return render(request, 'paper/base_paper_list.html', context)
 
         # Get search result
-        status, res_paper_list = call_db_with_conn(conn, functions.get_papers_by_tag, {'tag':tag_name})
+        status, page = call_db_with_conn(conn, functions.get_papers_by_tag_page,
+                                         {'tag':tag_name, 'cursor':request.GET.get('cursor')},
+                                         user=context['username'])
         if status != SUCCESS:
             context['error_message'] = err_internal
             return render(request, 'paper/base_paper_list.html', context)
+        res_paper_list, next_cursor = page
 
         if len(res_paper_list) == 0:
             context['error_message'] = "No post posted"
@@ -416,6 +450,9 @@ def tag_view(request, tag_name):
         res_paper_dicts = get_paper_dict(res_paper_list)
         append_likes_tags(conn, res_paper_dicts)
         context['paper_list'] = res_paper_dicts
+        if next_cursor is not None:
+            context['next_page_url'] = reverse('paper:tag_view', args=(tag_name,)) + '?' + \
+                urlencode({'cursor':next_cursor})
         response = render(request, 'paper/base_paper_list.html', context)
         return response
     finally:
@@ -423,6 +460,190 @@ def tag_view(request, tag_name):
             close_db_connection(conn)
 
 
+"""
+Async views
+
+The async variants of the read-heavy views render the same pages, with the
+independent db API calls awaited concurrently, each on a connection of its
+own. urls.py serves them instead of the sync views if ASYNC_VIEWS is on. They
+are meant to run under ASGI (see hw7proj/asgi.py), where one event loop and
+its connection pool serve all requests.
+"""
+
+
+async def home_async(request, err_msg = None):
+    """
+    Show the home page
+    """
+    if not valid_login(request):
+        return render(request, 'paper/login.html', {'error_message': err_login})
+    uname = get_current_user(request)
+
+    context = dict()
+    context['username'] = uname
+    context['error_message'] = err_msg
+    context['home'] = True
+    context['source'] = 'home'
+    context['header_text'] = "Hello " + uname + "!"
+
+    # The first recommendation builds the like graph snapshot synchronously.
+    recommender = get_recommender()
+    recommended = await sync_to_async(recommender.recommend, thread_sensitive=False)(uname, 20) \
+        if recommender is not None else None
+
+    # Timeline, liked and recommended papers and statistics come from one
+    # statement already.
+    status, bundle = await call_db_async(async_functions.get_home_bundle,
+                                         {'uname':uname, 'recommended': recommended})
+    if status != SUCCESS:
+        context['error_message'] = err_internal
+        return render(request, 'paper/base_paper_list.html', context)
+    timeline_papers, liked_papers, recommend_papers, num_post, num_like, num_tag = bundle
+
+    if len(timeline_papers) == 0:
+        context['error_message'] = "No post posted"
+    if len(liked_papers) == 0:
+        context['error_message2'] = "Not any liked posts"
+    if len(recommend_papers) == 0:
+        context['error_message3'] = "Not any recommendation posts"
+
+    recommend_paper_dicts = get_paper_dict(recommend_papers)
+    liked_paper_dicts = get_paper_dict(liked_papers)
+    timeline_paper_dicts = get_paper_dict(timeline_papers)
+    await append_likes_tags_async(recommend_paper_dicts + liked_paper_dicts + timeline_paper_dicts, uname)
+    context['paper_list'] = timeline_paper_dicts
+    context['liked_list'] = liked_paper_dicts
+    context['recommend_list'] = recommend_paper_dicts
+    context['num_post'] = num_post
+    context['num_like'] = num_like
+    context['num_tag'] = num_tag
+    return render(request, 'paper/base_paper_list.html', context)
+
+
+async def popular_papers_async(request, err_msg = None):
+    """
+    The popular paper page
+    """
+    if not valid_login(request):
+        return render(request, 'paper/login.html', {'error_message': "Please login."})
+    context = dict()
+    context['username'] = get_current_user(request)
+    context['error_message'] = err_msg
+    context['popular'] = True
+    context['source'] = 'popular'
+    context['header_text'] = "What's new"
+
+    # Popular and recent papers and global statistics are independent. The
+    # statistics come from the background snapshot unless it is too stale.
+    uname = context['username']
+    snapshot = global_stats.get_snapshot()
+    stats_calls = () if snapshot is not None else (
+        call_db_async(async_functions.get_most_active_users, {}, user=uname),
+        call_db_async(async_functions.get_most_popular_tags, {}, user=uname),
+        call_db_async(async_functions.get_most_popular_tag_pairs, {}, user=uname),
+    )
+    (status, popular_paper_list), (status2, recent_paper_list), *stats = await asyncio.gather(
+        call_db_async(async_functions.get_most_popular_papers,
+                      {'begin_time':get_datetime(timedelta(days=-14))}, user=uname),
+        call_db_async(async_functions.get_timeline_all, {}, user=uname),
+        *stats_calls,
+    )
+    if status != SUCCESS or status2 != SUCCESS:
+        context['error_message'] = err_internal
+        return render(request, 'paper/base_paper_list.html', context)
+
+    if len(popular_paper_list) == 0:
+        context['error_message'] = "Not any popular papers now, publish your own and become popular!"
+    if len(recent_paper_list) == 0:
+        context['error_message2'] = "Not any recent papers"
+
+    if snapshot is not None:
+        set_global_stats(context, snapshot.active_users, snapshot.popular_tags, snapshot.popular_tag_pairs)
+    else:
+        set_global_stats(context, *(result for _, result in stats))
+
+    popular_papers_dicts = get_paper_dict(popular_paper_list)
+    recent_papers_dicts = get_paper_dict(recent_paper_list)
+    await append_likes_tags_async(popular_papers_dicts + recent_papers_dicts, uname)
+
+    context['paper_list'] = popular_papers_dicts
+    context['recent_list'] = recent_papers_dicts
+    return render(request, 'paper/base_paper_list.html', context)
+
+
+async def search_view_async(request):
+    """
+    Search result page, see search_view()
+    """
+    if not valid_login(request):
+        return render(request, 'paper/login.html', {'error_message': err_login})
+
+    params = request.POST if request.method == 'POST' else request.GET
+    keywords = params.get('keywords', "")
+    if keywords == "":
+        return HttpResponseRedirect(request.META.get('HTTP_REFERER'))
+    ranked = params.get('order') == 'rank'
+    context = dict()
+    context['username'] = get_current_user(request)
+    context['search'] = True
+    context['source'] = 'search'
+    context['header_text'] = 'Search results for \"' + keywords + "\""
+
+    status, page = await call_db_async(async_functions.get_papers_by_keyword_page, {
+        'keyword':keywords, 'cursor':request.GET.get('cursor'), 'ranked':ranked}, user=context['username'])
+    if status != SUCCESS:
+        context['error_message'] = err_internal
+        return render(request, 'paper/base_paper_list.html', context)
+    res_paper_list, next_cursor = page
+
+    if len(res_paper_list) == 0:
+        context['error_message'] = "No post posted"
+        return render(request, 'paper/base_paper_list.html', context)
+
+    res_paper_dicts = get_paper_dict(res_paper_list)
+    await append_likes_tags_async(res_paper_dicts, context['username'])
+    context['paper_list'] = res_paper_dicts
+    if next_cursor is not None:
+        query = {'keywords':keywords, 'cursor':next_cursor}
+        if ranked:
+            query['order'] = 'rank'
+        context['next_page_url'] = reverse('paper:search_view') + '?' + urlencode(query)
+    return render(request, 'paper/base_paper_list.html', context)
+
+
+async def tag_view_async(request, tag_name):
+    """
+    Result page when clicking a  tag
+    """
+    if not valid_login(request):
+        return render(request, 'paper/login.html', {'error_message': err_login})
+    context = dict()
+    context['username'] = get_current_user(request)
+    context['tag_view'] = True
+    context['source'] = 'tag_view'
+    context['header_text'] = 'Posts with #' + tag_name
+
+    status, page = await call_db_async(async_functions.get_papers_by_tag_page,
+                                       {'tag':tag_name, 'cursor':request.GET.get('cursor')},
+                                       user=context['username'])
+    if status != SUCCESS:
+        context['error_message'] = err_internal
+        return render(request, 'paper/base_paper_list.html', context)
+    res_paper_list, next_cursor = page
+
+    if len(res_paper_list) == 0:
+        context['error_message'] = "No post posted"
+        return render(request, 'paper/base_paper_list.html', context)
+
+    res_paper_dicts = get_paper_dict(res_paper_list)
+    await append_likes_tags_async(res_paper_dicts, context['username'])
+    context['paper_list'] = res_paper_dicts
+    if next_cursor is not None:
+        context['next_page_url'] = reverse('paper:tag_view', args=(tag_name,)) + '?' + \
+            urlencode({'cursor':next_cursor})
+    return render(request, 'paper/base_paper_list.html', context)
+
+
 def new_paper(request):
     """
     Create a new paper
@@ -462,15 +683,19 @@ def new_paper(request):
             filename = fs.save(pdf_file.name, pdf_file)
             file_path = get_upload_dir_path()
             file_uploaded = file_path + "/" + filename
-            # extract text from pdf
-            text = textract.process(file_uploaded)
-            status, pid = call_db_with_conn(
-                    conn, functions.add_new_paper, {'uname':uname, 'title':title, 'desc':desc, 'text':text, 'tags':tags})
+            # add the paper now, queued for its text to be extracted from the pdf in the background
+            status, pid = call_db_with_conn(conn, functions.add_new_paper,
+                                            {'uname':uname, 'title':title, 'desc':desc, 'text':None, 'tags':tags})
             if status == SUCCESS:
                 try:
                     os.rename(file_uploaded, get_upload_file_path(pid))
+                    file_uploaded = get_upload_file_path(pid)
                 except:
                     print("[Error] Can not move file")
+                if not get_extraction_pool().submit(pid, file_uploaded):
+                    print("[Warning] Extraction queue is full, paper %d stays pending" % pid)
+                close_db_connection(conn)
+                conn = None
                 return home(request)
             else:
                 context['error_message'] = "Can not upload, try again"
@@ -493,7 +718,7 @@ def delete_paper(request, paper_id):
     """
     if not valid_login(request):
         return render(request, 'paper/login.html', {'error_message': err_login})
-    status, res = call_db(functions.delete_paper, {'pid':int(paper_id)})
+    status, res = call_db(functions.delete_paper, {'pid':int(paper_id)}, user=get_current_user(request))
     if status == SUCCESS:
         filename = str(os.path.join(settings.BASE_DIR, 'media')) + "/" + paper_id + ".pdf"
         try:
@@ -503,17 +728,131 @@ def delete_paper(request, paper_id):
     return home(request)
 
 
+def parse_range(header, size):
+    """
+    Parse the value of a Range header against a file of $size bytes.
+    Return (start, end) of the requested byte range with end inclusive, None if
+    the header should be ignored, or False if the range can't be satisfied.
+    Only single ranges are supported; a request for several is served whole.
+    """
+    unit, _, spec = header.partition('=')
+    if unit.strip() != 'bytes' or ',' in spec:
+        return None
+    first, sep, last = spec.strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if first == '':
+            # The last $last bytes
+            length = int(last)
+            if length <= 0:
+                return False
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last != '' else size - 1
+    except ValueError:
+        return None
+    if start >= size:
+        return False
+    if end < start:
+        return None
+    return start, min(end, size - 1)
+
+
+def read_file_range(filename, start, length, chunk_size=64 * 1024):
+    """
+    Generate $length bytes of a file from offset $start in chunks
+    """
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
 def view_paper(request, paper_id):
     """
-    View the pdf file of a paper
+    View the pdf file of a paper.
+    The file is streamed rather than read into memory, and clients can revalidate
+    it (ETag, Last-Modified) or fetch a part of it (Range).
     """
     if not valid_login(request):
         return render(request, 'paper/login.html', {'error_message': err_login})
     filename = get_upload_file_path(paper_id)
-    with open(filename, 'r') as pdf:
-        response = HttpResponse(pdf.read(), content_type="application/pdf")
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        raise Http404("No such paper")
+    etag = '"%x-%x"' % (stat.st_mtime_ns, stat.st_size)
+    last_modified = int(stat.st_mtime)
+
+    response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if response is None:
+        byte_range = None
+        range_header = request.META.get('HTTP_RANGE')
+        if_range = request.META.get('HTTP_IF_RANGE')
+        # A stale If-Range means the client wants the whole new file.
+        if range_header and (if_range is None or if_range in (etag, http_date(last_modified))):
+            byte_range = parse_range(range_header, stat.st_size)
+
+        if byte_range is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = 'bytes */%d' % stat.st_size
+        elif byte_range is not None:
+            start, end = byte_range
+            response = StreamingHttpResponse(
+                read_file_range(filename, start, end - start + 1),
+                status=206, content_type="application/pdf")
+            response['Content-Range'] = 'bytes %d-%d/%d' % (start, end, stat.st_size)
+            response['Content-Length'] = str(end - start + 1)
+        else:
+            # FileResponse hands the file to the server's wsgi.file_wrapper,
+            # which can use sendfile, and sets Content-Length.
+            response = FileResponse(open(filename, 'rb'), content_type="application/pdf")
         response['Content-Disposition'] = 'filename=' + paper_id + ".pdf"
-        return response
+        response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    response['Last-Modified'] = http_date(last_modified)
+    return response
+
+
+def extraction_status(request, paper_id):
+    """
+    Report whether the text of an uploaded paper has been extracted yet
+    """
+    if not valid_login(request):
+        return render(request, 'paper/login.html', {'error_message': err_login})
+    status, extraction = call_db(functions.get_extraction_status, {'pid':int(paper_id)})
+    if status != SUCCESS:
+        raise Http404("No such paper")
+    state, attempts, error = extraction
+    return JsonResponse({'pid':int(paper_id), 'status':state, 'attempts':attempts, 'error':error})
+
+
+def db_stats(request):
+    """
+    Report the db API counters collected while DB_INSTRUMENTATION is on, along
+    with the pool, cache, global statistics refresh, partition maintenance and
+    replica counters
+    """
+    if not valid_login(request):
+        return render(request, 'paper/login.html', {'error_message': err_login})
+    if not instrumentation.enabled:
+        raise Http404("Instrumentation is disabled")
+    stats = instrumentation.get_stats()
+    stats['pool'] = get_pool_stats()
+    cache = get_cache()
+    stats['cache'] = cache.get_stats() if cache is not None else None
+    refresher = global_stats.get_refresher()
+    stats['global_stats'] = refresher.get_stats() if refresher is not None else None
+    maintainer = get_maintainer()
+    stats['partitions'] = maintainer.get_stats() if maintainer is not None else None
+    router = get_router()
+    stats['replicas'] = router.get_stats() if router is not None else None
+    return JsonResponse(stats)
 
 
 def like(request, paper_id, source):